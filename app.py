@@ -1,87 +1,1894 @@
 import os
+import math
 import uuid
 import json
+import re
 import time
-import google.generativeai as genai
-from flask import Flask, request, jsonify, render_template
-from pymongo import MongoClient
+import random
+import base64
+import hashlib
+import functools
+import itertools
+import importlib.util
+import threading
+import mmap
+import multiprocessing
+import tempfile
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from bson import ObjectId
-import PyPDF2
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 import datetime
 
+try:
+    import orjson    # Optional: several times faster JSON encoding for list endpoints
+except ImportError:
+    orjson = None
+
 # --- Initialization ---
 load_dotenv()
 
-app = Flask(__name__)
+app = Flask(__name__)
+
+# --- Configuration ---
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+MAX_PDF_PAGES = 100
+SCORING_BATCH_ITEMS = 24      # Free-text answers evaluated per Gemini call
+SCORING_CONCURRENCY = 4       # Scoring calls in flight at once for class batches
+# Background ingestion needs a long-lived process, so it is off by default on Vercel
+ASYNC_INGESTION = os.getenv("ASYNC_INGESTION", "0" if os.getenv("VERCEL") else "1") == "1"
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", str(os.cpu_count() or 1)))
+# A queued/processing job that hasn't reported progress for this long died with its worker
+UPLOAD_JOB_STALE_SECONDS = int(os.getenv("UPLOAD_JOB_STALE_SECONDS", "600"))
+PDF_EXTRACTOR = os.getenv("PDF_EXTRACTOR", "pypdf2")   # pypdf2, pdfium or pdfminer
+# Build each PDF's quiz bank in the background right after ingestion (same constraint as above)
+QUIZ_BANK_BACKGROUND = os.getenv("QUIZ_BANK_BACKGROUND", "1" if ASYNC_INGESTION else "0") == "1"
+QUIZ_BANK_SECTIONS = 6        # Document sections the bank is generated from, one Gemini call each
+QUIZ_BANK_CLAIM_SECONDS = 300  # A build that hasn't finished a section for this long is taken over
+QUIZ_BANK_RETRY_SECONDS = 600  # Wait before rebuilding a failed bank, doubling with each failure
+QUIZ_BANK_MAX_FAILURES = 3     # Failed builds after which only an explicit request retries
+# Fold long chat histories into their summary after the turn, in the background (same constraint as above)
+CHAT_SUMMARY_BACKGROUND = os.getenv("CHAT_SUMMARY_BACKGROUND", "1" if ASYNC_INGESTION else "0") == "1"
+# Add PDFs stored before library search existed to its index, in the background (same constraint as above)
+SEARCH_BACKFILL = os.getenv("SEARCH_BACKFILL", "1" if ASYNC_INGESTION else "0") == "1"
+
+# --- Gemini AI and MongoDB Setup ---
+# Clients are created on first use, not at import, so cold starts for "/" and static
+# routes don't pay for the Gemini SDK, pymongo or a database handshake. Each is a
+# process-wide singleton reused across requests (and warm serverless invocations).
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# Cheaper, faster tier for low-stakes endpoints, and the fallback when the primary is overloaded
+GEMINI_FAST_MODEL_NAME = os.getenv("GEMINI_FAST_MODEL", "gemini-2.5-flash-lite")
+_clients_lock = threading.Lock()
+_mongo_client = None
+_gemini_models = {}
+
+def get_mongo_client():
+    """Returns the shared MongoClient, creating it on first use"""
+    global _mongo_client
+    if _mongo_client is None:
+        with _clients_lock:
+            if _mongo_client is None:
+                from pymongo import MongoClient
+                # Small pools and short timeouts: serverless instances are many and short-lived
+                _mongo_client = MongoClient(
+                    os.getenv("MONGO_URI"),
+                    maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "10")),
+                    minPoolSize=0,
+                    maxIdleTimeMS=60000,
+                    serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+                    connectTimeoutMS=5000
+                )
+                # Index builds are idempotent; keep them off the first request's critical path
+                threading.Thread(target=ensure_indexes, args=(_mongo_client.school_reviser_db,), daemon=True).start()
+    return _mongo_client
+
+def get_db():
+    """Returns the application database"""
+    return get_mongo_client().school_reviser_db
+
+def get_model(name=None):
+    """Returns the shared Gemini model with this name (default: GEMINI_MODEL), loading the SDK on first use"""
+    name = name or GEMINI_MODEL_NAME
+    if name not in _gemini_models:
+        with _clients_lock:
+            if name not in _gemini_models:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                _gemini_models[name] = genai.GenerativeModel(name)
+    return _gemini_models[name]
+
+def ensure_indexes(db):
+    """Creates the indexes every collection relies on"""
+    try:
+        db.pdfs.create_index([("uploaded_at", -1), ("_id", -1)])
+        # Partial so documents uploaded before hashing was added don't collide on a missing field
+        db.pdfs.create_index("content_hash", unique=True,
+                             partialFilterExpression={"content_hash": {"$exists": True}})
+        db.quiz_attempts.create_index([("pdfId", 1), ("timestamp", -1)])
+        db.quiz_attempts.create_index([("timestamp", -1)])
+        db.pdf_pages.create_index([("pdfId", 1), ("page", 1)], unique=True)
+        db.pdf_chunks.create_index([("pdfId", 1), ("position", 1)])
+        db.quiz_questions.create_index([("pdfId", 1), ("type", 1)])
+        db.upload_jobs.create_index([("content_hash", 1), ("status", 1)])
+        db.llm_cache.create_index("expires_at", expireAfterSeconds=0)
+        db.llm_leases.create_index("expires_at", expireAfterSeconds=0)
+        db.chat_sessions.create_index("expires_at", expireAfterSeconds=0)
+        db.search_postings.create_index([("term", 1), ("weight", -1)])
+        db.search_postings.create_index("pdfId")
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+
+    if SEARCH_BACKFILL:
+        try:
+            backfilled = backfill_search_index()
+            if backfilled:
+                print(f"Added {backfilled} PDFs to the search index")
+        except Exception as e:
+            print(f"Search backfill error: {e}")
+
+
+class LazyCollection:
+    """Stands in for a MongoDB collection, connecting on first attribute access"""
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_db()[self.name], attr)
+
+
+class LazyModel:
+    """Stands in for a Gemini model, loading the SDK on first attribute access"""
+    def __init__(self, name=None):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_model(self.name), attr)
+
+
+model = LazyModel()
+fast_model = LazyModel(GEMINI_FAST_MODEL_NAME)
+pdfs_collection = LazyCollection("pdfs")
+quiz_attempts_collection = LazyCollection("quiz_attempts")
+pdf_pages_collection = LazyCollection("pdf_pages")
+pdf_chunks_collection = LazyCollection("pdf_chunks")
+quiz_questions_collection = LazyCollection("quiz_questions")
+upload_jobs_collection = LazyCollection("upload_jobs")
+chat_sessions_collection = LazyCollection("chat_sessions")
+search_postings_collection = LazyCollection("search_postings")
+
+# --- JSON Serialization ---
+class MongoJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that encodes ObjectId and datetime itself, so MongoDB documents are returned as-is.
+
+    Uses orjson when it is installed and the standard library encoder
+    otherwise. Datetimes are ISO 8601 either way (Flask's default is an HTTP
+    date).
+    """
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, datetime.date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and set(kwargs) <= {"separators", "indent"}:
+            option = orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get("indent"):
+                option |= orjson.OPT_INDENT_2
+            try:
+                return orjson.dumps(obj, default=self.default, option=option).decode()
+            except orjson.JSONEncodeError:
+                pass  # e.g. integers wider than 64 bits; the standard encoder handles them
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+
+app.json = MongoJSONProvider(app)
+
+JSON_STREAM_CHUNK = 64 * 1024    # Bytes of encoded documents buffered per streamed chunk
+
+def json_list_response(key, docs, fields=None, limit=None, after=None):
+    """
+    Streams a JSON object whose `key` list is encoded as documents come off a cursor.
+
+    The first document is fetched before returning, so query errors still
+    surface as the endpoint's error response rather than a truncated stream.
+
+    Args:
+        key: Name of the list field
+        docs: Iterable of documents, typically a MongoDB cursor
+        fields: Other top-level fields
+        limit: Send at most this many documents; fetch one more to learn whether more remain
+        after: Called with (last document sent, whether more remain) once the list is
+            written; returns further top-level fields, e.g. the next page cursor
+
+    Returns:
+        A streamed application/json Response
+    """
+    dumps = app.json.dumps
+    docs = iter(docs)
+    first = next(docs, None)
+    if first is not None:
+        docs = itertools.chain((first,), docs)
+
+    def generate():
+        parts, size, sent, last, more = [f"{{{dumps(key)}:["], 0, 0, None, False
+        try:
+            for doc in docs:
+                if limit is not None and sent >= limit:
+                    more = True
+                    break
+                encoded = dumps(doc)
+                parts.append(f",{encoded}" if sent else encoded)
+                size += len(encoded)
+                sent, last = sent + 1, doc
+                if size >= JSON_STREAM_CHUNK:
+                    yield "".join(parts)
+                    parts, size = [], 0
+            tail = dict(fields or {})
+            if after:
+                tail.update(after(last, more))
+            rest = dumps(tail)[1:-1]
+            parts.append(f"],{rest}}}\n" if rest else "]}\n")
+            yield "".join(parts)
+        except Exception as e:
+            # Headers are already sent; a truncated body is the only signal left
+            print(f"Streamed {key} list error: {e}")
+
+    return Response(stream_with_context(generate()), mimetype=app.json.mimetype)
+
+# --- Metrics ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOG_REQUESTS = os.getenv("LOG_REQUESTS", "1") == "1"
+
+
+class Metrics:
+    """
+    Process-wide counters and latency histograms, rendered in Prometheus text format.
+
+    Histograms also keep a window of recent samples so the health check can
+    report percentiles without a metrics backend.
+    """
+    def __init__(self, window=1024):
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> {"buckets", "sum", "count", "recent"}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0,
+                    "recent": deque(maxlen=self.window)
+                }
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            histogram["recent"].append(seconds)
+
+    def percentiles(self, name, quantiles=(50, 95, 99), min_samples=1, **labels):
+        """Returns {"p50": ms, ...} over recent samples of every series matching the labels, or None"""
+        wanted = set(labels.items())
+        with self._lock:
+            samples = sorted(
+                sample
+                for (series, series_labels), histogram in self._histograms.items()
+                if series == name and wanted <= set(series_labels)
+                for sample in histogram["recent"]
+            )
+        if len(samples) < max(min_samples, 1):
+            return None
+        return {
+            f"p{q}": round(samples[min(len(samples) - 1, math.ceil(q / 100 * len(samples)) - 1)] * 1000, 1)
+            for q in quantiles
+        }
+
+    def counter_values(self, name):
+        """Returns {labels: value} for every series of a counter"""
+        with self._lock:
+            return {labels: value for (series, labels), value in self._counters.items() if series == name}
+
+    def render(self, extra_counters=(), gauges=()):
+        """
+        Renders every series in Prometheus text exposition format.
+
+        Args:
+            extra_counters: (name, labels, value) tuples computed at scrape time
+            gauges: (name, labels, value) tuples computed at scrape time
+        """
+        with self._lock:
+            counters = [(name, dict(labels), value) for (name, labels), value in self._counters.items()]
+            histograms = [(name, dict(labels), dict(h, buckets=list(h["buckets"])))
+                          for (name, labels), h in self._histograms.items()]
+        counters.extend(extra_counters)
+
+        lines = []
+        typed = set()
+        for kind, series_list in (("counter", counters), ("gauge", list(gauges))):
+            for name, labels, value in sorted(series_list, key=lambda series: series[0]):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} {kind}")
+                    typed.add(name)
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, labels, histogram in sorted(histograms, key=lambda series: series[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                lines.append(f"{name}_bucket{format_labels(dict(labels, le=str(bound)))} {count}")
+            lines.append(f"{name}_bucket{format_labels(dict(labels, le='+Inf'))} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    """Formats a label dict as {key="value",...} with Prometheus escaping"""
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in sorted(labels.items()))
+    return "{" + ",".join(escaped) + "}"
+
+
+metrics = Metrics()
+# Per-request timing state; worker threads that should report into it run in a copy of the context
+_request_state = contextvars.ContextVar("request_state", default=None)
+_active_stages = threading.local()
+
+
+def current_endpoint():
+    """Endpoint the current work is attributed to; "background" outside a request"""
+    state = _request_state.get()
+    return state["endpoint"] if state else "background"
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of the current request (db_fetch, prompt_build, llm, parse, db_write).
+
+    Nested uses of the same stage are only counted once, by the outermost one.
+    """
+    active = _active_stages.__dict__.setdefault("names", set())
+    if name in active:
+        yield
+        return
+    active.add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        active.discard(name)
+        elapsed = time.perf_counter() - started
+        metrics.observe("stage_duration_seconds", elapsed, endpoint=current_endpoint(), stage=name)
+        state = _request_state.get()
+        if state:
+            state["stages"][name] = state["stages"].get(name, 0.0) + elapsed
+
+
+def timed(stage_name):
+    """Decorator form of stage() for helpers that are always one stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_usage(response):
+    """Counts prompt/response tokens from a Gemini response's usage metadata, if it has any"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    endpoint = current_endpoint()
+    state = _request_state.get()
+    for kind, field in (("prompt", "prompt_token_count"), ("response", "candidates_token_count")):
+        tokens = getattr(usage, field, 0) or 0
+        metrics.inc("llm_tokens_total", tokens, endpoint=endpoint, kind=kind)
+        if state:
+            state["tokens"][kind] = state["tokens"].get(kind, 0) + tokens
+
+
+@app.before_request
+def start_request_metrics():
+    _request_state.set({
+        "endpoint": request.endpoint or "unmatched",
+        "started": time.perf_counter(),
+        "stages": {},
+        "tokens": {},
+        "status": None
+    })
+
+
+@app.after_request
+def note_response_status(response):
+    state = _request_state.get()
+    if state:
+        state["status"] = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    # Runs after a streamed body has been fully sent, so durations cover the whole stream
+    state = _request_state.get()
+    if not state:
+        return
+    _request_state.set(None)
+    elapsed = time.perf_counter() - state["started"]
+    status = state["status"] or 500
+    metrics.observe("request_duration_seconds", elapsed, endpoint=state["endpoint"], method=request.method)
+    metrics.inc("requests_total", endpoint=state["endpoint"], method=request.method, status=status)
+
+    if LOG_REQUESTS and state["endpoint"] != "static":
+        print(json.dumps({
+            "event": "request",
+            "endpoint": state["endpoint"],
+            "method": request.method,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 1),
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in state["stages"].items()},
+            "tokens": state["tokens"]
+        }), flush=True)
+
+
+# --- Gemini Rate Limiting ---
+# GEMINI_RPM is the project's quota; each worker process takes an equal share of it.
+# gunicorn.conf.py exports its worker count as WEB_CONCURRENCY; other servers run one process.
+WEB_WORKERS = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_PROCESS_RPM = GEMINI_RPM / WEB_WORKERS
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "5"))
+GEMINI_MAX_WAITERS = int(os.getenv("GEMINI_MAX_WAITERS", "32"))        # Requests allowed to queue for a token
+GEMINI_DEADLINE = float(os.getenv("GEMINI_DEADLINE", "45"))            # Seconds one call may spend queued and retrying
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+RETRY_BACKOFF_CAP = 20.0
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling Gemini when the limiter or circuit breaker says it would not help"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Client-side rate limiter with a bounded queue of waiting requests.
+
+    The rate adapts: a 429 halves it and pauses the bucket for the server's
+    retry-after hint, and each success recovers it a little (AIMD), so a
+    worker settles just under the quota it actually gets.
+    """
+    def __init__(self, rate_per_minute, burst, max_waiters):
+        self.max_rate = rate_per_minute / 60.0
+        self.rate = self.max_rate
+        self.burst = burst
+        self.max_waiters = max_waiters
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiters = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, deadline):
+        """
+        Takes one token, waiting until the deadline (a time.monotonic() value).
+
+        Raises:
+            UpstreamUnavailable: If the wait queue is full or the deadline passes
+        """
+        with self._cond:
+            if self.waiters >= self.max_waiters:
+                raise UpstreamUnavailable("Too many requests are waiting for the AI service.", retry_after=5)
+            self.waiters += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now >= self.paused_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    ready_at = max(self.paused_until, now + (1 - self.tokens) / self.rate)
+                    if ready_at > deadline:
+                        raise UpstreamUnavailable("The AI service is busy.", retry_after=math.ceil(ready_at - now))
+                    self._cond.wait(ready_at - now)
+            finally:
+                self.waiters -= 1
+
+    def try_acquire(self):
+        """Takes a token only if one is free right now; never waits"""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def throttled(self, retry_after=None):
+        """Backs off after a 429: halves the rate and pauses for the hinted delay"""
+        with self._cond:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self._cond:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker:
+    """
+    Fails fast while Gemini is down instead of queueing requests behind doomed calls.
+
+    Opens after `failure_threshold` consecutive upstream failures, rejects calls
+    for `cooldown` seconds, then lets one trial call through (half-open).
+    """
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.cooldown else "half_open"
+
+    def before_call(self):
+        """
+        Checks whether a call may be attempted.
+
+        Returns:
+            True if this call took the half-open trial slot; it must then end in
+            record_success(), record_failure() or release_trial()
+
+        Raises:
+            UpstreamUnavailable: If the call should not be attempted
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            remaining = max(self.cooldown - (time.monotonic() - self.opened_at), 1)
+        metrics.inc("llm_rejected_total", reason="breaker_open")
+        raise UpstreamUnavailable("The AI service is temporarily unavailable.", retry_after=math.ceil(remaining))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        """Gives the trial slot back when the trial call never reached upstream"""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    metrics.inc("llm_breaker_opened_total")
+                self.opened_at = time.monotonic()
+
+
+class GeminiGuard:
+    """Rate limiter and circuit breaker for one Gemini model; quotas and outages are per model"""
+    def __init__(self, rate_per_minute, burst=GEMINI_BURST, max_waiters=GEMINI_MAX_WAITERS,
+                 failure_threshold=GEMINI_BREAKER_FAILURES, cooldown=GEMINI_BREAKER_COOLDOWN):
+        self.limiter = TokenBucket(rate_per_minute, burst, max_waiters) if rate_per_minute > 0 else None
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+
+    def status(self):
+        return {
+            "breaker": self.breaker.state,
+            "rate_per_minute": round(self.limiter.rate * 60, 1) if self.limiter else None,
+            "waiting": self.limiter.waiters if self.limiter else 0
+        }
+
+
+# Per-process share of each model's quota; the fast tier has its own (GEMINI_FAST_RPM)
+MODEL_PROCESS_RPM = {
+    GEMINI_FAST_MODEL_NAME: float(os.getenv("GEMINI_FAST_RPM", str(GEMINI_RPM))) / WEB_WORKERS
+}
+gemini_guards = {}
+_guards_lock = threading.Lock()
+
+def model_label(model):
+    """Short model name, e.g. gemini-2.5-flash for models/gemini-2.5-flash"""
+    return str(getattr(model, "model_name", type(model).__name__)).split("/")[-1]
+
+def guard_for(model):
+    """Returns the GeminiGuard for a model, creating it on first use"""
+    label = model_label(model)
+    with _guards_lock:
+        if label not in gemini_guards:
+            gemini_guards[label] = GeminiGuard(MODEL_PROCESS_RPM.get(label, GEMINI_PROCESS_RPM))
+        return gemini_guards[label]
+
+
+def classify_error(error):
+    """
+    Sorts a Gemini failure into "rate_limited", "unavailable" or "client".
+
+    Only the first two are worth retrying; client errors (bad request, blocked
+    prompt, bad key) fail the same way every time.
+    """
+    code = getattr(error, "code", None)
+    code = code if isinstance(code, int) else None
+    message = str(error)
+    if code == 429 or re.search(r"\b429\b", message) or "Resource has been exhausted" in message or "quota" in message.lower():
+        return "rate_limited"
+    if (code is not None and code >= 500) or re.search(r"\b50[0234]\b", message) \
+            or isinstance(error, (TimeoutError, ConnectionError)) or "Deadline" in message or "unavailable" in message.lower():
+        return "unavailable"
+    return "client"
+
+
+RETRY_HINT_PATTERNS = (
+    re.compile(r"retry in (\d+(?:\.\d+)?)\s*s", re.IGNORECASE),
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),
+    re.compile(r"retry[- ]after:?\s*(\d+(?:\.\d+)?)", re.IGNORECASE),
+)
+
+def retry_after_hint(error):
+    """Returns the server's suggested wait in seconds, if the error carries one"""
+    hint = getattr(error, "retry_after", None)
+    if isinstance(hint, (int, float)):
+        return float(hint)
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None and getattr(retry_delay, "seconds", None) is not None:
+            return retry_delay.seconds + getattr(retry_delay, "nanos", 0) / 1e9
+    message = str(error)
+    for pattern in RETRY_HINT_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+# --- Model Routing and Hedging ---
+MODEL_FALLBACK = os.getenv("MODEL_FALLBACK", "1") == "1"
+# Endpoints whose tail latency is worth an occasional duplicate call (streaming calls are never hedged)
+HEDGE_ENDPOINTS = set(filter(None, os.getenv("HEDGE_ENDPOINTS", "handle_chat,score_quiz,score_quiz_batch").split(",")))
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))   # Hedge calls slower than this percentile
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))    # Never hedge sooner than this (seconds)
+HEDGE_MIN_SAMPLES = 20                                           # Calls needed before the percentile is trusted
+_hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_POOL_SIZE", "64")), thread_name_prefix="hedge")
+
+def fallback_model(primary):
+    """The other tier to try when a model is overloaded, or None"""
+    if not MODEL_FALLBACK:
+        return None
+    if getattr(primary, "cached_content", None):
+        return None  # The other tier can't see this model's cached document context
+    label = model_label(primary)
+    if label == GEMINI_MODEL_NAME:
+        return fast_model
+    if label == GEMINI_FAST_MODEL_NAME:
+        return model
+    return None
+
+def hedge_delay(endpoint):
+    """Seconds to wait before hedging a call from this endpoint, or None to not hedge"""
+    if endpoint not in HEDGE_ENDPOINTS:
+        return None
+    observed = metrics.percentiles("llm_call_seconds", quantiles=(HEDGE_PERCENTILE,),
+                                   min_samples=HEDGE_MIN_SAMPLES, endpoint=endpoint, outcome="ok")
+    if observed is None:
+        return None
+    return max(HEDGE_MIN_DELAY, next(iter(observed.values())) / 1000)
+
+def count_hedge_waste(future, endpoint):
+    """Records the tokens a losing hedge (or primary) spent, once it finishes"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    usage = getattr(future.result(), "usage_metadata", None)
+    if usage is not None:
+        tokens = (getattr(usage, "prompt_token_count", 0) or 0) + (getattr(usage, "candidates_token_count", 0) or 0)
+        metrics.inc("llm_hedge_wasted_tokens_total", tokens, endpoint=endpoint)
+
+def run_hedged(send, guard, endpoint):
+    """
+    Runs send(), starting a duplicate if it is slower than usual, and returns whichever succeeds first.
+
+    The hedge is only sent when the limiter has a token free right now and the
+    breaker is closed, so hedging never adds load to an overloaded upstream.
+    The slower call can't be cancelled; its tokens are counted as hedge waste.
+    """
+    delay = hedge_delay(endpoint)
+    if delay is None:
+        return send()
+
+    primary = _hedge_pool.submit(contextvars.copy_context().run, send)
+    done, _ = wait([primary], timeout=delay)
+    if done or guard.breaker.state != "closed" or (guard.limiter and not guard.limiter.try_acquire()):
+        return primary.result()
+
+    hedge = _hedge_pool.submit(contextvars.copy_context().run, send)
+    metrics.inc("llm_hedges_total", endpoint=endpoint)
+    for future in as_completed([primary, hedge]):
+        if future.exception() is None:
+            loser = primary if future is hedge else hedge
+            metrics.inc("llm_hedge_wins_total", endpoint=endpoint, winner="hedge" if future is hedge else "primary")
+            loser.add_done_callback(lambda f: count_hedge_waste(f, endpoint))
+            return future.result()
+    return primary.result()  # Both failed: raise the primary's error
+
+def call_model(target, send, label, retries=3, delay=2, hedge=True):
+    """
+    Runs one Gemini request through the model's rate limiter and circuit breaker, retrying upstream failures.
+
+    Backoff is "full jitter" (a random wait up to delay * 2^i) so workers don't
+    retry in lockstep, and never shorter than the server's retry-after hint. All
+    waiting, queued or backing off, shares one GEMINI_DEADLINE budget.
+
+    Args:
+        target: The Gemini model instance
+        send: Callable taking the model, making the request and returning its result
+        label: What is being called, for log messages
+        retries: Number of attempts
+        delay: Base backoff delay in seconds
+        hedge: Allow a duplicate call when this one is slow; off for streams, whose
+            losing copy would hold its connection open and never report its usage
+
+    Returns:
+        The result of send(target)
+
+    Raises:
+        UpstreamUnavailable: If the limiter, breaker or deadline rules out another attempt
+        Exception: The last error, for client errors or once retries are exhausted
+    """
+    endpoint = current_endpoint()
+    guard = guard_for(target)
+    deadline = time.monotonic() + GEMINI_DEADLINE
+    for i in range(retries):
+        trial = guard.breaker.before_call()
+        if guard.limiter:
+            queued = time.perf_counter()
+            try:
+                guard.limiter.acquire(deadline)
+            except UpstreamUnavailable:
+                metrics.inc("llm_rejected_total", reason="limiter")
+                if trial:
+                    # Otherwise the breaker would wait forever for a trial that never ran
+                    guard.breaker.release_trial()
+                raise
+            finally:
+                metrics.observe("llm_limiter_wait_seconds", time.perf_counter() - queued, endpoint=endpoint)
+
+        started = time.perf_counter()
+        try:
+            result = run_hedged(lambda: send(target), guard, endpoint) if hedge else send(target)
+        except Exception as e:
+            kind = classify_error(e)
+            metrics.observe("llm_call_seconds", time.perf_counter() - started, endpoint=endpoint, outcome=kind)
+            metrics.inc("llm_calls_total", endpoint=endpoint, outcome=kind, model=model_label(target))
+            if kind == "client":
+                guard.breaker.record_success()  # The service answered; it just didn't like the request
+                raise e
+            guard.breaker.record_failure()
+            hint = retry_after_hint(e)
+            if kind == "rate_limited" and guard.limiter:
+                guard.limiter.throttled(hint)
+
+            wait_time = max(random.uniform(0, min(RETRY_BACKOFF_CAP, delay * 2 ** i)), hint or 0)
+            if i == retries - 1:
+                print(f"{label} failed after {retries} attempts: {e}")
+                raise e
+            if time.monotonic() + wait_time > deadline:
+                print(f"{label} failed (attempt {i+1}/{retries}): {e}. No time left to retry.")
+                raise UpstreamUnavailable("The AI service is busy.", retry_after=math.ceil(wait_time)) from e
+            metrics.inc("llm_retries_total", endpoint=endpoint, reason=kind)
+            print(f"{label} failed (attempt {i+1}/{retries}): {e}. Retrying in {wait_time:.1f}s...")
+            time.sleep(wait_time)
+        else:
+            metrics.observe("llm_call_seconds", time.perf_counter() - started, endpoint=endpoint, outcome="ok")
+            metrics.inc("llm_calls_total", endpoint=endpoint, outcome="ok", model=model_label(target))
+            guard.breaker.record_success()
+            if guard.limiter:
+                guard.limiter.succeeded()
+            return result
+
+def call_gemini(target, send, label, retries=3, delay=2, hedge=True):
+    """
+    Calls a model via call_model, switching to the other model tier if it is overloaded.
+
+    Client errors (bad request, blocked prompt) are not retried on the other tier.
+    The fallback gets a single attempt so an outage of both tiers fails quickly.
+    """
+    try:
+        return call_model(target, send, label, retries, delay, hedge)
+    except Exception as e:
+        alternate = fallback_model(target)
+        if alternate is None or (not isinstance(e, UpstreamUnavailable) and classify_error(e) == "client"):
+            raise
+        metrics.inc("llm_fallbacks_total", endpoint=current_endpoint(), to_model=model_label(alternate))
+        print(f"{label} on {model_label(target)} failed ({e}); falling back to {model_label(alternate)}")
+        return call_model(alternate, send, label, retries=1, delay=delay, hedge=hedge)
+
+
+def busy_response(error):
+    """503 response telling the client when to try again"""
+    response = jsonify({"error": f"{error} Please try again shortly."})
+    response.headers["Retry-After"] = str(error.retry_after or 5)
+    return response, 503
+
+
+# --- Gemini API Retry Logic ---
+def generate_with_retry(model, prompt, retries=3, delay=2, generation_config=None):
+    """
+    Calls the Gemini API through the rate limiter, with jittered backoff retries.
+    
+    Args:
+        model: The Gemini model instance
+        prompt: The prompt to send
+        retries: Number of retry attempts
+        delay: Base backoff delay in seconds (the jitter window doubles with each retry)
+        generation_config: Optional Gemini generation config (e.g. JSON output)
+    
+    Returns:
+        The API response
+    
+    Raises:
+        UpstreamUnavailable: If Gemini is overloaded or down and waiting would not help
+        Exception: If the request is rejected or all retries fail
+    """
+    def send(target):
+        if generation_config:
+            return target.generate_content(prompt, generation_config=generation_config)
+        return target.generate_content(prompt)
+
+    with stage("llm"):
+        response = call_gemini(model, send, "API call", retries, delay)
+    record_usage(response)
+    return response
+
+# --- Response Cache ---
+class CachedResponse:
+    """Stand-in for a Gemini response served from the cache or shared by a coalesced request"""
+    def __init__(self, text):
+        self.text = text
+
+
+class ResponseCache:
+    """
+    Two-tier cache for generated text.
+
+    An in-process LRU answers repeat prompts within a worker; the optional
+    MongoDB tier shares entries across workers and serverless instances,
+    with a TTL index removing expired documents.
+    """
+    def __init__(self, max_entries=256, default_ttl=3600):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.collection = None
+        self._entries = OrderedDict()  # key -> (expires_at, text)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def use_collection(self, collection):
+        """Enables the MongoDB tier backed by the given collection (TTL-indexed on expires_at)"""
+        self.collection = collection
+
+    def _count(self, namespace, field):
+        with self._lock:
+            counters = self._stats.setdefault(namespace, {"hits": 0, "mongo_hits": 0, "misses": 0, "stores": 0})
+            counters[field] += 1
+
+    def get(self, key, namespace="default"):
+        """Returns the cached text for key, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+            elif entry:
+                del self._entries[key]
+                entry = None
+        if entry:
+            self._count(namespace, "hits")
+            return entry[1]
+
+        if self.collection is not None:
+            try:
+                doc = self.collection.find_one({"_id": key})
+            except Exception as e:
+                print(f"Response cache lookup error: {e}")
+                doc = None
+            # The TTL monitor only runs periodically, so check expiry here too
+            if doc and doc["expires_at"] > datetime.datetime.utcnow():
+                ttl = (doc["expires_at"] - datetime.datetime.utcnow()).total_seconds()
+                self._store_local(key, doc["text"], ttl)
+                self._count(namespace, "mongo_hits")
+                return doc["text"]
+
+        self._count(namespace, "misses")
+        return None
+
+    def _store_local(self, key, text, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def set(self, key, text, ttl=None, namespace="default"):
+        """Stores text under key in every enabled tier"""
+        ttl = ttl or self.default_ttl
+        self._store_local(key, text, ttl)
+        self._count(namespace, "stores")
+        if self.collection is not None:
+            try:
+                self.collection.replace_one({"_id": key}, {
+                    "text": text,
+                    "namespace": namespace,
+                    "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+                }, upsert=True)
+            except Exception as e:
+                print(f"Response cache store error: {e}")
+
+    def stats(self):
+        """Returns per-namespace hit/miss counters and the hit rate"""
+        with self._lock:
+            namespaces = {name: dict(counters) for name, counters in self._stats.items()}
+            size = len(self._entries)
+        for counters in namespaces.values():
+            lookups = counters["hits"] + counters["mongo_hits"] + counters["misses"]
+            counters["hit_rate"] = round((counters["hits"] + counters["mongo_hits"]) / lookups, 3) if lookups else 0.0
+        return {
+            "entries": size,
+            "max_entries": self.max_entries,
+            "mongo_tier": self.collection is not None,
+            "namespaces": namespaces
+        }
+
+
+def cache_key(model, prompt, params=None):
+    """Content address for a generation: hash of model name (and cached context), prompt and generation params"""
+    key_fields = {
+        "model": getattr(model, "model_name", type(model).__name__),
+        "prompt": prompt,
+        "params": params or {}
+    }
+    # Models bound to cached content answer from context that isn't in the prompt
+    cached_content = getattr(model, "cached_content", None)
+    if cached_content:
+        key_fields["cached_content"] = str(getattr(cached_content, "name", cached_content))
+    payload = json.dumps(key_fields, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "256")),
+    default_ttl=int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+)
+if os.getenv("RESPONSE_CACHE_MONGO", "1") == "1":
+    response_cache.use_collection(LazyCollection("llm_cache"))
+
+
+def generate_cached(model, prompt, namespace, ttl=None):
+    """
+    Calls generate_with_retry through the response cache.
+
+    Args:
+        model: The Gemini model instance
+        prompt: The prompt to send
+        namespace: Endpoint name the hit/miss counters are recorded under
+        ttl: Seconds to keep the response (defaults to the cache's TTL)
+
+    Returns:
+        A CachedResponse with the generated, cached or coalesced text
+    """
+    key = cache_key(model, prompt)
+    cached_text = response_cache.get(key, namespace)
+    if cached_text is not None:
+        return CachedResponse(cached_text)
+
+    def generate():
+        text = generate_with_retry(model, prompt).text
+        response_cache.set(key, text, ttl, namespace)
+        return text
+
+    # Identical prompts already being generated elsewhere share that generation
+    return CachedResponse(single_flight.do((namespace, key), generate, namespace))
+
+
+# --- Request Coalescing ---
+SINGLE_FLIGHT_MONGO = os.getenv("SINGLE_FLIGHT_MONGO", "1") == "1"
+# Long enough for a generation plus one repair call, each within its own deadline
+SINGLE_FLIGHT_LEASE_SECONDS = 2 * GEMINI_DEADLINE + 10
+SINGLE_FLIGHT_POLL_SECONDS = 0.25
+
+
+class _Flight:
+    """One in-progress execution that other callers can wait on"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution.
+
+    Within a process, followers wait on the leader's thread. With a lease
+    collection, one worker across the deployment holds a lease document per
+    key and stores its result there; other workers poll the lease instead of
+    calling Gemini themselves. Shared results must be strings.
+    """
+    def __init__(self, lease_collection=None, lease_seconds=60):
+        self.lease_collection = lease_collection
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, namespace="default", shared=True):
+        """
+        Returns fn(), or the result of an identical call already in flight.
+
+        Args:
+            key: What makes two calls identical (endpoint, document and prompt hash)
+            fn: Callable producing the result
+            namespace: Endpoint name for the coalescing counters
+            shared: Also coalesce across workers through the lease collection (fn must return text)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            metrics.inc("single_flight_total", namespace=namespace, role="follower")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        metrics.inc("single_flight_total", namespace=namespace, role="leader")
+        try:
+            if shared and self.lease_collection is not None:
+                flight.result = self._run_with_lease(key, fn, namespace)
+            else:
+                flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _run_with_lease(self, key, fn, namespace):
+        from pymongo.errors import PyMongoError
+
+        lease_id = hashlib.sha256(str(key).encode("utf-8")).hexdigest()
+        started = datetime.datetime.utcnow()
+        give_up = time.monotonic() + self.lease_seconds
+        while time.monotonic() < give_up:
+            try:
+                leading, current = self._acquire_lease(lease_id, started)
+            except PyMongoError as e:
+                # Coalescing is an optimization; never fail the request because the lease store is down
+                print(f"Single-flight lease error: {e}")
+                return fn()
+            if leading:
+                return self._lead(lease_id, fn)
+            if current is None:
+                continue  # The lease changed hands meanwhile; look again
+            if current["status"] == "done":
+                metrics.inc("single_flight_total", namespace=namespace, role="remote_follower")
+                return current["text"]
+            time.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+        # The leader is taking too long; stop waiting and do the work ourselves
+        return fn()
+
+    def _acquire_lease(self, lease_id, started):
+        """
+        Takes the lease for a key, or reads the one another worker holds.
+
+        Returns:
+            A (leading, current) tuple: (True, None) once this worker holds the lease,
+            otherwise the current lease (running, or done since started), or None if it just changed hands
+        """
+        from pymongo.errors import DuplicateKeyError
+
+        now = datetime.datetime.utcnow()
+        lease = {"_id": lease_id, "owner": self.owner, "status": "running",
+                 "expires_at": now + datetime.timedelta(seconds=self.lease_seconds)}
+        try:
+            self.lease_collection.insert_one(lease)
+            return True, None
+        except DuplicateKeyError:
+            pass
+
+        current = self.lease_collection.find_one({"_id": lease_id})
+        if current is None:
+            return False, None  # Released between our insert and read
+        if current["status"] == "done" and current.get("completed_at", now) >= started:
+            return False, current
+        if current["status"] == "done" or current["expires_at"] < now:
+            # A stale result or an abandoned lease: take it over, unless another worker just did
+            taken = self.lease_collection.find_one_and_replace(
+                {"_id": lease_id, "owner": current["owner"], "expires_at": current["expires_at"]}, lease
+            )
+            return taken is not None, None
+        return False, current
+
+    def _lead(self, lease_id, fn):
+        from pymongo.errors import PyMongoError
+
+        try:
+            text = fn()
+        except Exception:
+            # Release the lease so waiting workers retry instead of sitting out the timeout
+            try:
+                self.lease_collection.delete_one({"_id": lease_id, "owner": self.owner})
+            except PyMongoError as e:
+                print(f"Single-flight lease error: {e}")
+            raise
+        # Keep the result briefly so workers still polling can pick it up; the text is ours either way
+        try:
+            self.lease_collection.update_one({"_id": lease_id, "owner": self.owner}, {"$set": {
+                "status": "done",
+                "text": text,
+                "completed_at": datetime.datetime.utcnow(),
+                "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+            }})
+        except PyMongoError as e:
+            print(f"Single-flight lease error: {e}")
+        return text
+
+
+single_flight = SingleFlight(
+    LazyCollection("llm_leases") if SINGLE_FLIGHT_MONGO else None,
+    lease_seconds=SINGLE_FLIGHT_LEASE_SECONDS
+)
+
+
+# --- Structured Output ---
+QUIZ_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "mcqs": {"type": "ARRAY", "items": {
+            "type": "OBJECT",
+            "properties": {
+                "question": {"type": "STRING"},
+                "options": {"type": "ARRAY", "items": {"type": "STRING"}},
+                "correctAnswer": {"type": "STRING"}
+            },
+            "required": ["question", "options", "correctAnswer"]
+        }},
+        "saqs": {"type": "ARRAY", "items": {
+            "type": "OBJECT",
+            "properties": {"question": {"type": "STRING"}, "idealAnswer": {"type": "STRING"}},
+            "required": ["question", "idealAnswer"]
+        }},
+        "laqs": {"type": "ARRAY", "items": {
+            "type": "OBJECT",
+            "properties": {"question": {"type": "STRING"}, "idealAnswer": {"type": "STRING"}},
+            "required": ["question", "idealAnswer"]
+        }}
+    },
+    "required": ["mcqs", "saqs", "laqs"]
+}
+
+# Bank questions also carry a topic tag
+BANK_QUIZ_SCHEMA = json.loads(json.dumps(QUIZ_SCHEMA))
+for _key in ("mcqs", "saqs", "laqs"):
+    BANK_QUIZ_SCHEMA["properties"][_key]["items"]["properties"]["topic"] = {"type": "STRING"}
+
+RECOMMENDATIONS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "recommendations": {"type": "ARRAY", "items": {
+            "type": "OBJECT",
+            "properties": {"title": {"type": "STRING"}, "url": {"type": "STRING"}},
+            "required": ["title", "url"]
+        }}
+    },
+    "required": ["recommendations"]
+}
+
+SCORING_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "results": {"type": "ARRAY", "items": {
+            "type": "OBJECT",
+            "properties": {
+                "id": {"type": "STRING"},
+                "credit": {"type": "NUMBER"},
+                "feedback": {"type": "STRING"}
+            },
+            "required": ["id", "credit", "feedback"]
+        }},
+        "overallFeedback": {"type": "ARRAY", "items": {
+            "type": "OBJECT",
+            "properties": {"submission": {"type": "STRING"}, "feedback": {"type": "STRING"}},
+            "required": ["submission", "feedback"]
+        }}
+    },
+    "required": ["results", "overallFeedback"]
+}
+
+_structured_stats_lock = threading.Lock()
+structured_output_stats = {}
+
+def count_structured(namespace, outcome):
+    """Records how a structured response was obtained: clean, local_repair, model_repair or failed"""
+    with _structured_stats_lock:
+        counters = structured_output_stats.setdefault(
+            namespace, {"clean": 0, "local_repair": 0, "model_repair": 0, "failed": 0}
+        )
+        counters[outcome] += 1
+
+def schema_errors(value, schema, path="$"):
+    """Validates value against a Gemini-style schema, returning a list of problems"""
+    expected = schema.get("type", "").upper()
+    if expected == "OBJECT":
+        if not isinstance(value, dict):
+            return [f"{path} should be an object"]
+        errors = [f"{path}.{key} is missing" for key in schema.get("required", []) if key not in value]
+        for key, subschema in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(schema_errors(value[key], subschema, f"{path}.{key}"))
+        return errors
+    if expected == "ARRAY":
+        if not isinstance(value, list):
+            return [f"{path} should be an array"]
+        errors = []
+        for i, item in enumerate(value):
+            errors.extend(schema_errors(item, schema.get("items", {}), f"{path}[{i}]"))
+        return errors
+    if expected == "STRING" and not isinstance(value, str):
+        return [f"{path} should be a string"]
+    if expected in ("NUMBER", "INTEGER") and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        return [f"{path} should be a number"]
+    if expected == "BOOLEAN" and not isinstance(value, bool):
+        return [f"{path} should be a boolean"]
+    return []
+
+def tolerant_json_loads(text):
+    """
+    Parses JSON, falling back to cheap local fixes for common model mistakes.
+
+    Returns:
+        A (value, repaired) tuple; repaired is True when a fix was needed
+
+    Raises:
+        json.JSONDecodeError: If the text can't be parsed even after fixing
+    """
+    cleaned = text.strip()
+    try:
+        return json.loads(cleaned), False
+    except json.JSONDecodeError:
+        pass
+
+    # Markdown fences, prose around the JSON, trailing commas and smart quotes
+    cleaned = cleaned.replace("```json", "").replace("```", "").strip()
+    starts = [i for i in (cleaned.find("{"), cleaned.find("[")) if i != -1]
+    if starts:
+        start = min(starts)
+        end = max(cleaned.rfind("}"), cleaned.rfind("]"))
+        cleaned = cleaned[start:end + 1]
+    cleaned = re.sub(r",\s*([}\]])", r"\1", cleaned)
+    cleaned = cleaned.replace("\u201c", '"').replace("\u201d", '"')
+    return json.loads(cleaned), True
+
+def json_generation_config(schema):
+    """Gemini generation config asking for JSON that matches schema"""
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+def generate_structured(model, prompt, schema, namespace, cache_ttl=None):
+    """
+    Generates a JSON response constrained to schema and returns it parsed.
+
+    Uses Gemini's JSON output mode, validates the result locally, and on failure
+    tries a tolerant local parse and then one small "fix this JSON" call before
+    giving up, so malformed output rarely costs a full regeneration.
+    Concurrent identical calls are coalesced into one generation.
+
+    Args:
+        model: The Gemini model instance
+        prompt: The prompt to send
+        schema: Gemini-style response schema the result must match
+        namespace: Endpoint name for parse/repair and cache counters
+        cache_ttl: Cache validated results for this many seconds (None disables caching)
+
+    Returns:
+        The parsed JSON value
+
+    Raises:
+        ValueError: If no valid JSON could be obtained
+    """
+    generation_config = json_generation_config(schema)
+    key = cache_key(model, prompt, generation_config) if cache_ttl else None
+    if key:
+        cached_text = response_cache.get(key, namespace)
+        if cached_text is not None:
+            return json.loads(cached_text)
+
+    def produce():
+        text = generate_with_retry(model, prompt, generation_config=generation_config).text
+        outcome = "clean"
+        with stage("parse"):
+            try:
+                value, repaired = tolerant_json_loads(text)
+                errors = schema_errors(value, schema)
+                if repaired:
+                    outcome = "local_repair"
+            except json.JSONDecodeError as e:
+                errors = [f"invalid JSON: {e}"]
+
+        if errors:
+            repair_prompt = f"""
+            The text below was meant to be JSON matching this schema, but it has problems.
+            Fix it with as few changes as possible and return ONLY the corrected JSON.
+
+            Problems: {"; ".join(errors[:10])}
+
+            Schema: {json.dumps(schema, separators=(",", ":"))}
+
+            Text:
+            {text}
+            """
+            try:
+                value, _ = tolerant_json_loads(
+                    generate_with_retry(model, repair_prompt, generation_config=generation_config).text
+                )
+                errors = schema_errors(value, schema)
+            except json.JSONDecodeError as e:
+                errors = [f"invalid JSON: {e}"]
+            outcome = "model_repair"
+
+        if errors:
+            count_structured(namespace, "failed")
+            print(f"Structured output failed for {namespace}: {errors[:3]}; response was: {text[:500]}")
+            raise ValueError(f"Invalid structured response for {namespace}")
+
+        count_structured(namespace, outcome)
+        value_text = json.dumps(value)
+        if key:
+            response_cache.set(key, value_text, cache_ttl, namespace)
+        return value_text
+
+    # Concurrent identical requests share one generation; each caller gets its own parsed copy
+    flight_key = (namespace, key or cache_key(model, prompt, generation_config))
+    return json.loads(single_flight.do(flight_key, produce, namespace))
+
+def chunk_text(chunk):
+    """Returns the text of a streamed response chunk, or "" if it has none"""
+    try:
+        return chunk.text
+    except (ValueError, AttributeError):
+        # Chunks without text parts (e.g. safety or finish metadata) raise on .text
+        return ""
+
+def open_stream_with_retry(model, prompt, retries=3, delay=2):
+    """
+    Starts a streaming Gemini call, retrying only until the first chunk arrives.
+
+    Once a chunk has been received it may already be on its way to the client,
+    so failures after that point are not retried.
+
+    Args:
+        model: The Gemini model instance
+        prompt: The prompt to send
+        retries: Number of retry attempts
+        delay: Base backoff delay in seconds (the jitter window doubles with each retry)
+
+    Returns:
+        A (first_chunk, chunk_iterator) tuple; first_chunk is None for an empty stream
+
+    Raises:
+        UpstreamUnavailable: If Gemini is overloaded or down and waiting would not help
+        Exception: If all retries fail before the first chunk
+    """
+    def send(target):
+        # Timed to the first chunk; the rest of the stream is timed by the caller
+        chunks = iter(target.generate_content(prompt, stream=True))
+        return next(chunks, None), chunks
+
+    with stage("llm"):
+        return call_gemini(model, send, "Streaming API call", retries, delay, hedge=False)
+
+def sse_event(data, event=None):
+    """Formats a JSON payload as a Server-Sent Events message"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+# --- Page Storage ---
+@timed("db_fetch")
+def find_pdf(pdf_id_obj):
+    """Fetches a PDF's metadata without any of its text; None if missing or empty"""
+    # A class opening the same PDF at once shares one query
+    pdf_doc = single_flight.do(
+        ("find_pdf", pdf_id_obj),
+        lambda: pdfs_collection.find_one({"_id": pdf_id_obj}, {"extracted_text": 0}),
+        namespace="find-pdf", shared=False
+    )
+    # Legacy documents have no word_count, but they were only stored when text was extracted
+    if pdf_doc and pdf_doc.get("word_count", 1) > 0:
+        return dict(pdf_doc)
+    return None
+
+@timed("db_fetch")
+def get_pdf_pages(pdf_id_obj, first_page=None, last_page=None):
+    """Fetches page records in order, limited to an inclusive page range"""
+    query = {"pdfId": pdf_id_obj}
+    if first_page is not None or last_page is not None:
+        query["page"] = {}
+        if first_page is not None:
+            query["page"]["$gte"] = first_page
+        if last_page is not None:
+            query["page"]["$lte"] = last_page
+    return list(pdf_pages_collection.find(
+        query, {"_id": 0, "page": 1, "text": 1, "word_count": 1}
+    ).sort("page", 1))
+
+@timed("db_fetch")
+def load_page_texts(pdf_id_obj):
+    """
+    Returns all page texts of a PDF for (re)indexing.
+
+    Returns:
+        A (page_texts, paged) tuple; paged is False for legacy single-blob documents
+    """
+    pages = get_pdf_pages(pdf_id_obj)
+    if pages:
+        page_texts = [""] * pages[-1]["page"]
+        for page in pages:
+            page_texts[page["page"] - 1] = page["text"]
+        return page_texts, True
+    legacy_doc = pdfs_collection.find_one({"_id": pdf_id_obj}, {"extracted_text": 1})
+    if legacy_doc and legacy_doc.get("extracted_text"):
+        return [legacy_doc["extracted_text"]], False
+    return [], False
+
+# --- Retrieval Index ---
+CHUNK_WORDS = 200      # Words per retrievable passage
+CHUNK_OVERLAP = 40     # Words shared between neighbouring passages on a page
+CHUNK_INDEX_CLAIM_SECONDS = 120  # An indexing claim older than this belongs to a dead request
+CHUNK_INDEX_WAIT_SECONDS = 10    # How long a request waits for another one's indexing to finish
+CHAT_PASSAGE_WORD_BUDGET = 6 * CHUNK_WORDS   # Passage words per chat prompt, however many PDFs are selected
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+    a an and are as at be but by can do does for from has have how i if in into is it its
+    me my of on or so that the their them then there these they this to was we what when
+    where which who why will with you your about explain tell please give
+""".split())
+
+def tokenize(text):
+    """Lowercases text and splits it into index terms, dropping stopwords"""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+def split_into_chunks(page_texts, paged=True):
+    """
+    Splits page texts into overlapping word windows that never cross a page boundary.
 
-# --- Configuration ---
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    Args:
+        page_texts: List of page strings in document order
+        paged: False when the texts are not real pages (legacy documents)
 
-# --- Gemini AI and MongoDB Setup ---
-try:
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    client = MongoClient(os.getenv("MONGO_URI"))
-    db = client.school_reviser_db
-    pdfs_collection = db.pdfs
-    quiz_attempts_collection = db.quiz_attempts
-    print("Successfully connected to MongoDB and configured Gemini API.")
-except Exception as e:
-    print(f"Error during setup: {e}")
-
-# --- Helper for JSON serialization ---
-def serialize_doc(doc):
-    """Recursively converts a MongoDB doc to a JSON-serializable format."""
-    if isinstance(doc, list):
-        return [serialize_doc(item) for item in doc]
-    if isinstance(doc, dict):
-        serialized = {}
-        for key, value in doc.items():
-            if isinstance(value, ObjectId):
-                serialized[key] = str(value)
-            elif isinstance(value, datetime.datetime):
-                serialized[key] = value.isoformat()
-            elif isinstance(value, (dict, list)):
-                serialized[key] = serialize_doc(value)
-            else:
-                serialized[key] = value
-        return serialized
-    if isinstance(doc, ObjectId):
-        return str(doc)
-    if isinstance(doc, datetime.datetime):
-        return doc.isoformat()
-    return doc
+    Returns:
+        List of {"page", "text"} dicts in document order
+    """
+    chunks = []
+    step = CHUNK_WORDS - CHUNK_OVERLAP
+    for page_number, text in enumerate(page_texts, start=1):
+        words = text.split()
+        for start in range(0, max(len(words) - CHUNK_OVERLAP, 1), step):
+            window = words[start:start + CHUNK_WORDS]
+            if window:
+                chunks.append({"page": page_number if paged else None, "text": " ".join(window)})
+    return chunks
 
-# --- Gemini API Retry Logic ---
-def generate_with_retry(model, prompt, retries=3, delay=2):
+def claim_chunk_indexing(pdf_id_obj):
+    """Claims a PDF's chunk indexing, so concurrent requests don't store its passages twice"""
+    now = datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=CHUNK_INDEX_CLAIM_SECONDS)
+    return pdfs_collection.find_one_and_update(
+        {"_id": pdf_id_obj, "$or": [
+            {"chunk_index_status": {"$ne": "building"}},
+            {"chunk_index_claimed_at": {"$not": {"$gte": stale}}}
+        ]},
+        {"$set": {"chunk_index_status": "building", "chunk_index_claimed_at": now}},
+        projection={"_id": 1}
+    ) is not None
+
+def wait_for_chunk_index(pdf_id_obj):
+    """Waits (up to CHUNK_INDEX_WAIT_SECONDS) for another request to finish indexing a PDF"""
+    deadline = time.monotonic() + CHUNK_INDEX_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        pdf_doc = pdfs_collection.find_one({"_id": pdf_id_obj}, {"chunk_index_status": 1})
+        if not pdf_doc or pdf_doc.get("chunk_index_status") != "building":
+            return
+        time.sleep(0.1)
+
+def index_pdf_chunks(pdf_id_obj, page_texts, paged=True):
     """
-    Calls the Gemini API with exponential backoff retry logic.
-    
+    Stores the retrievable passages of a PDF with their term frequencies.
+
+    Returns:
+        Number of passages stored; 0 if another request is indexing (or has indexed) the PDF
+    """
+    if not claim_chunk_indexing(pdf_id_obj):
+        return 0
+    try:
+        # A request holding the claim before us may already have stored them
+        if pdf_chunks_collection.find_one({"pdfId": pdf_id_obj}, {"_id": 1}):
+            pdfs_collection.update_one({"_id": pdf_id_obj}, {"$set": {"chunk_index_status": "ready"}})
+            return 0
+        stored = store_pdf_chunks(pdf_id_obj, page_texts, paged)
+        pdfs_collection.update_one({"_id": pdf_id_obj}, {"$set": {"chunk_index_status": "ready"}})
+        return stored
+    except Exception:
+        # Leave no passages without postings: the next use re-indexes from scratch and backfill retries search
+        try:
+            pdf_chunks_collection.delete_many({"pdfId": pdf_id_obj})
+            search_postings_collection.delete_many({"pdfId": pdf_id_obj})
+        finally:
+            pdfs_collection.update_one({"_id": pdf_id_obj}, {"$set": {
+                "chunk_index_status": "failed", "search_index_status": "failed"
+            }})
+        raise
+
+def store_pdf_chunks(pdf_id_obj, page_texts, paged):
+    """Splits pages into passages and writes them with the PDF's search postings"""
+    chunk_docs = []
+    for position, chunk in enumerate(split_into_chunks(page_texts, paged)):
+        terms = {}
+        tokens = tokenize(chunk["text"])
+        for token in tokens:
+            terms[token] = terms.get(token, 0) + 1
+        chunk_docs.append({
+            "pdfId": pdf_id_obj,
+            "position": position,
+            "page": chunk["page"],
+            "text": chunk["text"],
+            "terms": terms,
+            "length": len(tokens)
+        })
+    if chunk_docs:
+        pdf_chunks_collection.insert_many(chunk_docs)
+    index_pdf_terms(pdf_id_obj, chunk_docs)
+    return len(chunk_docs)
+
+def bm25_scores(chunk_docs, query, k1=1.5, b=0.75):
+    """Scores chunks against a query with Okapi BM25, vectorized over chunks"""
+    import numpy as np
+
+    query_terms = list(dict.fromkeys(tokenize(query)))
+    if not query_terms or not chunk_docs:
+        return np.zeros(len(chunk_docs))
+
+    tf = np.array([[doc["terms"].get(t, 0) for t in query_terms] for doc in chunk_docs], dtype=float)
+    lengths = np.array([doc["length"] for doc in chunk_docs], dtype=float)
+    n = len(chunk_docs)
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+    avgdl = lengths.mean() or 1.0
+    norm = k1 * (1 - b + b * lengths / avgdl)
+    return (tf * (k1 + 1) / (tf + norm[:, None])) @ idf
+
+def spread_positions(n, k, sample=False):
+    """Picks k chunk positions spread evenly across a document of n chunks"""
+    import numpy as np
+
+    if n <= k:
+        return np.arange(n)
+    bounds = np.linspace(0, n, k + 1).astype(int)
+    if sample:
+        # One random chunk from each stratum, so repeated quizzes see different passages
+        return np.array([np.random.randint(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])])
+    return (bounds[:-1] + bounds[1:]) // 2
+
+@timed("db_fetch")
+def ensure_chunk_index(pdf_id_obj, projection=None):
+    """
+    Returns a PDF's chunk records in document order, indexing it first if needed.
+
     Args:
-        model: The Gemini model instance
-        prompt: The prompt to send
-        retries: Number of retry attempts
-        delay: Initial delay in seconds (doubles with each retry)
-    
+        pdf_id_obj: The PDF's ObjectId
+        projection: Fields to fetch; by default everything except the passage text
+    """
+    projection = projection or {"text": 0}
+    chunk_docs = list(pdf_chunks_collection.find({"pdfId": pdf_id_obj}, projection).sort("position", 1))
+
+    if not chunk_docs:
+        # Documents uploaded before the index existed are indexed on first use
+        page_texts, paged = load_page_texts(pdf_id_obj)
+        if page_texts:
+            if not index_pdf_chunks(pdf_id_obj, page_texts, paged=paged):
+                wait_for_chunk_index(pdf_id_obj)
+            chunk_docs = list(pdf_chunks_collection.find({"pdfId": pdf_id_obj}, projection).sort("position", 1))
+    return chunk_docs
+
+def retrieve_context(pdf_doc, query=None, top_k=6, sample=False):
+    """
+    Returns the most relevant passages of a PDF as prompt-ready text.
+
+    With a query, passages are ranked by BM25; without one (or when nothing
+    matches) they are spread across the whole document for coverage.
+
+    Args:
+        pdf_doc: The PDF document from the pdfs collection
+        query: Question or topic to rank passages against
+        top_k: Maximum number of passages to return
+        sample: Randomize which passages are picked for coverage
+
     Returns:
-        The API response
-    
-    Raises:
-        Exception: If all retries fail
+        Passages in document order, each prefixed with its page number
     """
-    for i in range(retries):
+    import numpy as np
+
+    chunk_docs = ensure_chunk_index(pdf_doc["_id"])
+    if not chunk_docs:
+        return ""
+
+    with stage("prompt_build"):
+        positions = None
+        if query:
+            scores = bm25_scores(chunk_docs, query)
+            ranked = np.argsort(-scores, kind="stable")[:top_k]
+            ranked = ranked[scores[ranked] > 0]
+            if len(ranked):
+                positions = ranked
+        if positions is None:
+            positions = spread_positions(len(chunk_docs), top_k, sample)
+        selected_ids = [chunk_docs[i]["_id"] for i in sorted(set(positions.tolist()))]
+
+    with stage("db_fetch"):
+        passages = list(pdf_chunks_collection.find({"_id": {"$in": selected_ids}}).sort("position", 1))
+    return "\n\n".join(
+        f"[Page {chunk['page']}]\n{chunk['text']}" if chunk.get("page") else chunk["text"]
+        for chunk in passages
+    )
+
+# --- Library Search ---
+# Inverted index over all PDFs: one posting per (term, PDF), written when the PDF's chunks are indexed
+SEARCH_AVG_DOC_TERMS = 3000   # Typical indexed terms per PDF, for BM25 length normalization of postings
+SEARCH_CANDIDATES = 200       # Highest-weighted postings read per query term
+SEARCH_MAX_TERMS = 8          # Query terms beyond this are ignored
+SEARCH_POSTING_CHUNKS = 3     # Densest passages remembered per term and PDF, for snippets
+SNIPPET_WORDS = 40
+
+def index_pdf_terms(pdf_id_obj, chunk_docs, k1=1.5, b=0.75):
+    """
+    Adds a PDF to the library-wide inverted index.
+
+    Each posting holds the term's BM25 weight in this PDF (idf is applied at
+    query time, since it changes as the library grows) and the passages where
+    the term is densest, so a search reads a few postings per term in index
+    order and never scans chunks.
+
+    Returns:
+        Number of postings written
+    """
+    term_freqs = {}
+    term_hits = {}
+    length = 0
+    for chunk in chunk_docs:
+        length += chunk["length"]
+        for term, count in chunk["terms"].items():
+            term_freqs[term] = term_freqs.get(term, 0) + count
+            term_hits.setdefault(term, []).append((-count, chunk["position"], chunk["page"]))
+
+    norm = k1 * (1 - b + b * length / SEARCH_AVG_DOC_TERMS)
+    postings = []
+    for term, tf in term_freqs.items():
+        densest = sorted(term_hits[term])[:SEARCH_POSTING_CHUNKS]
+        postings.append({
+            "term": term,
+            "pdfId": pdf_id_obj,
+            "weight": round(tf * (k1 + 1) / (tf + norm), 4),
+            "chunks": [position for _, position, _ in densest],
+            "pages": sorted({page for _, _, page in densest if page})
+        })
+
+    # Re-indexing replaces the PDF's postings rather than adding to them
+    search_postings_collection.delete_many({"pdfId": pdf_id_obj})
+    if postings:
+        search_postings_collection.insert_many(postings, ordered=False)
+    pdfs_collection.update_one({"_id": pdf_id_obj}, {"$set": {"search_index_status": "ready"}})
+    return len(postings)
+
+def backfill_search_index():
+    """
+    Indexes PDFs stored before library search existed, and PDFs whose indexing failed.
+
+    Each PDF is claimed first, so several workers can run this at once.
+
+    Returns:
+        Number of PDFs indexed
+    """
+    indexed = 0
+    pending = {"search_index_status": {"$in": [None, "failed"]}}
+    for pdf_doc in pdfs_collection.find(pending, {"_id": 1}):
+        claimed = pdfs_collection.find_one_and_update(
+            dict(pending, _id=pdf_doc["_id"]),
+            {"$set": {"search_index_status": "building"}}
+        )
+        if not claimed:
+            continue
         try:
-            return model.generate_content(prompt)
-        except Exception as e:
-            if i < retries - 1:
-                wait_time = delay ** (i + 1)
-                print(f"API call failed (attempt {i+1}/{retries}): {e}. Retrying in {wait_time}s...")
-                time.sleep(wait_time)
+            chunk_docs = list(pdf_chunks_collection.find({"pdfId": pdf_doc["_id"]}, {"text": 0}))
+            if chunk_docs:
+                index_pdf_terms(pdf_doc["_id"], chunk_docs)
             else:
-                print(f"API call failed after {retries} attempts: {e}")
-                raise e
+                ensure_chunk_index(pdf_doc["_id"])  # Builds the chunks and their postings
+            indexed += 1
+        except Exception as e:
+            print(f"Search backfill error for {pdf_doc['_id']}: {e}")
+            pdfs_collection.update_one({"_id": pdf_doc["_id"]}, {"$set": {"search_index_status": "failed"}})
+    return indexed
+
+def make_snippet(text, terms):
+    """A window of the passage around the first query term it contains"""
+    words = text.split()
+    first = next((i for i, word in enumerate(words) if set(tokenize(word)) & terms), 0)
+    start = max(0, first - SNIPPET_WORDS // 3)
+    snippet = " ".join(words[start:start + SNIPPET_WORDS])
+    return ("…" if start else "") + snippet + ("…" if start + SNIPPET_WORDS < len(words) else "")
+
+@timed("db_fetch")
+def search_library(query, limit=10):
+    """
+    Ranks all uploaded PDFs against a query with BM25 over the inverted index.
+
+    Only each term's top SEARCH_CANDIDATES postings are read, so cost depends
+    on the number of query terms, not on the size of the library.
+
+    Returns:
+        Up to limit results, best first, each with the PDF's id and filename,
+        its score, the pages where the terms are densest and a snippet
+    """
+    terms = list(dict.fromkeys(tokenize(query)))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return []
+
+    library_size = max(pdfs_collection.estimated_document_count(), 1)
+    scores = {}
+    postings_by_pdf = {}
+    for term in terms:
+        postings = list(search_postings_collection.find(
+            {"term": term}, {"_id": 0, "pdfId": 1, "weight": 1, "chunks": 1, "pages": 1}
+        ).sort("weight", -1).limit(SEARCH_CANDIDATES))
+        if not postings:
+            continue
+        # A short posting list is its own document frequency; only common terms need a count
+        df = len(postings) if len(postings) < SEARCH_CANDIDATES else \
+            search_postings_collection.count_documents({"term": term})
+        idf = math.log(1 + (library_size - df + 0.5) / (df + 0.5))
+        for posting in postings:
+            scores[posting["pdfId"]] = scores.get(posting["pdfId"], 0.0) + idf * posting["weight"]
+            postings_by_pdf.setdefault(posting["pdfId"], []).append(posting)
+
+    top_ids = sorted(scores, key=lambda pdf_id: -scores[pdf_id])[:limit]
+    if not top_ids:
+        return []
+
+    # The passage listed under the most query terms makes the snippet
+    snippet_keys = []
+    for pdf_id in top_ids:
+        votes = {}
+        for posting in postings_by_pdf[pdf_id]:
+            for rank, position in enumerate(posting["chunks"]):
+                votes[position] = votes.get(position, 0) + SEARCH_POSTING_CHUNKS - rank
+        snippet_keys.append({"pdfId": pdf_id, "position": max(votes, key=lambda position: (votes[position], -position))})
+
+    filenames = {doc["_id"]: doc.get("filename", "")
+                 for doc in pdfs_collection.find({"_id": {"$in": top_ids}}, {"filename": 1})}
+    passages = {chunk["pdfId"]: chunk for chunk in pdf_chunks_collection.find(
+        {"$or": snippet_keys}, {"pdfId": 1, "page": 1, "text": 1})}
+
+    term_set = set(terms)
+    results = []
+    for pdf_id in top_ids:
+        if pdf_id not in filenames:
+            continue  # Deleted since it was indexed
+        passage = passages.get(pdf_id)
+        results.append({
+            "pdf_id": str(pdf_id),
+            "filename": filenames[pdf_id],
+            "score": round(scores[pdf_id], 3),
+            "pages": sorted({page for posting in postings_by_pdf[pdf_id] for page in posting["pages"]}),
+            "snippet": {"page": passage.get("page"), "text": make_snippet(passage["text"], term_set)} if passage else None
+        })
+    return results
+
+def retrieve_library_context(pdf_docs, query, budget_words=CHAT_PASSAGE_WORD_BUDGET):
+    """
+    Returns the most relevant passages across several PDFs as prompt-ready text.
+
+    Chunks of all the PDFs are ranked together with BM25, so the prompt holds
+    the same number of passages however many PDFs are selected. When nothing
+    matches, the same number of passages is spread across the PDFs in order.
+
+    Args:
+        pdf_docs: PDF documents from the pdfs collection
+        query: Question to rank passages against
+        budget_words: Passage words allowed in the prompt
+
+    Returns:
+        Passages grouped by PDF in document order, each prefixed with its filename and page
+    """
+    import numpy as np
+
+    chunk_docs = []
+    for pdf_doc in pdf_docs:
+        chunk_docs.extend(ensure_chunk_index(pdf_doc["_id"]))
+    if not chunk_docs:
+        return ""
+
+    passage_count = max(1, budget_words // CHUNK_WORDS)
+    with stage("prompt_build"):
+        scores = bm25_scores(chunk_docs, query)
+        ranked = np.argsort(-scores, kind="stable")[:passage_count]
+        selected_ids = [chunk_docs[i]["_id"] for i in ranked[scores[ranked] > 0].tolist()]
+        if not selected_ids:
+            # Spread over the PDFs back to back, so the budget holds however many are selected
+            selected_ids = [chunk_docs[i]["_id"] for i in spread_positions(len(chunk_docs), passage_count).tolist()]
+
+    with stage("db_fetch"):
+        passages = list(pdf_chunks_collection.find({"_id": {"$in": selected_ids}}))
+    order = {pdf_doc["_id"]: index for index, pdf_doc in enumerate(pdf_docs)}
+    filenames = {pdf_doc["_id"]: pdf_doc.get("filename", "") for pdf_doc in pdf_docs}
+    passages.sort(key=lambda chunk: (order[chunk["pdfId"]], chunk["position"]))
+    return "\n\n".join(
+        f"[{filenames[chunk['pdfId']]}, Page {chunk['page']}]\n{chunk['text']}" if chunk.get("page")
+        else f"[{filenames[chunk['pdfId']]}]\n{chunk['text']}"
+        for chunk in passages
+    )
 
 # --- Input Validation Helpers ---
 def validate_object_id(id_string):
@@ -99,6 +1906,572 @@ def sanitize_text(text, max_length=10000):
         return ""
     return text[:max_length].strip()
 
+# --- PDF Extraction ---
+class InvalidPdf(Exception):
+    """Raised by extractors when a file can't be parsed as a PDF"""
+
+
+class PdfExtractor:
+    """
+    Page text extraction from a PDF file on disk, backed by one parsing library.
+
+    Subclasses open the document in __init__ and implement page_count() and
+    page_texts(); parse failures are raised as InvalidPdf. Files are read
+    through a read-only memory map (or the library's own file access), so a
+    large upload is paged in from the spool file instead of held in memory.
+
+    Args:
+        path: Path of the PDF file
+    """
+    name = None
+    module = None     # Import name of the backing library
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise InvalidPdf("Empty file")
+
+    def page_count(self):
+        raise NotImplementedError
+
+    def page_texts(self, start, end):
+        """Returns the text of pages [start, end)"""
+        raise NotImplementedError
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PyPDF2Extractor(PdfExtractor):
+    """Pure-Python default; slowest on large textbooks"""
+    name = "pypdf2"
+    module = "PyPDF2"
+
+    def __init__(self, path):
+        import PyPDF2
+
+        super().__init__(path)
+        try:
+            self._reader = PyPDF2.PdfReader(self._map)
+            self._pages = len(self._reader.pages)
+        except PyPDF2.errors.PdfReadError as e:
+            self.close()
+            raise InvalidPdf(str(e))
+
+    def page_count(self):
+        return self._pages
+
+    def page_texts(self, start, end):
+        return [self._reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+class PdfiumExtractor(PdfExtractor):
+    """PDFium (Chrome's PDF engine) through pypdfium2; much faster, needs `pip install pypdfium2`"""
+    name = "pdfium"
+    module = "pypdfium2"
+    # PDFium isn't thread-safe; worker processes each have their own copy
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        import pypdfium2
+
+        self.path = path
+        try:
+            with self._lock:
+                # PDFium reads the file itself, loading only the objects a page needs
+                self._document = pypdfium2.PdfDocument(path)
+                self._pages = len(self._document)
+        except pypdfium2.PdfiumError as e:
+            raise InvalidPdf(str(e))
+
+    def page_count(self):
+        return self._pages
+
+    def page_texts(self, start, end):
+        texts = []
+        with self._lock:
+            for i in range(start, end):
+                page = self._document[i]
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        return texts
+
+    def close(self):
+        with self._lock:
+            self._document.close()
+
+
+class PdfminerExtractor(PdfExtractor):
+    """pdfminer.six; pure Python with better layout handling than PyPDF2, needs `pip install pdfminer.six`"""
+    name = "pdfminer"
+    module = "pdfminer"
+
+    def __init__(self, path):
+        from pdfminer.pdfdocument import PDFDocument
+        from pdfminer.pdfparser import PDFParser
+        from pdfminer.pdftypes import resolve1
+        from pdfminer.psparser import PSException
+
+        super().__init__(path)
+        try:
+            self._document = PDFDocument(PDFParser(self._map))
+            self._pages = resolve1(resolve1(self._document.catalog["Pages"])["Count"])
+        except (PSException, KeyError, TypeError) as e:
+            self.close()
+            raise InvalidPdf(str(e))
+
+    def page_count(self):
+        return self._pages
+
+    def page_texts(self, start, end):
+        from pdfminer.converter import PDFPageAggregator
+        from pdfminer.layout import LAParams, LTTextContainer
+        from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+        from pdfminer.pdfpage import PDFPage
+
+        resources = PDFResourceManager()
+        device = PDFPageAggregator(resources, laparams=LAParams())
+        interpreter = PDFPageInterpreter(resources, device)
+        texts = []
+        for number, page in enumerate(PDFPage.create_pages(self._document)):
+            if number >= end:
+                break
+            if number >= start:
+                interpreter.process_page(page)
+                texts.append("".join(element.get_text() for element in device.get_result()
+                                     if isinstance(element, LTTextContainer)))
+        return texts + [""] * (end - start - len(texts))
+
+
+PDF_EXTRACTORS = {extractor.name: extractor for extractor in (PyPDF2Extractor, PdfiumExtractor, PdfminerExtractor)}
+
+@functools.lru_cache(maxsize=None)
+def get_extractor(name=None):
+    """
+    Returns the extractor class for a backend name (PDF_EXTRACTOR by default).
+
+    Unknown or uninstalled backends fall back to PyPDF2 with a warning, so a
+    config typo doesn't take uploads down.
+    """
+    name = name or PDF_EXTRACTOR
+    extractor = PDF_EXTRACTORS.get(name)
+    if extractor is None:
+        print(f"Unknown PDF extractor {name!r}; using pypdf2")
+        return PyPDF2Extractor
+    if importlib.util.find_spec(extractor.module) is None:
+        print(f"PDF extractor {name!r} is not installed; using pypdf2")
+        return PyPDF2Extractor
+    return extractor
+
+def spool_upload(stream, block_size=64 * 1024):
+    """
+    Copies an upload to a temporary file in blocks, hashing it on the way.
+
+    Returns:
+        (path, SHA-256 hex digest); the caller deletes the file
+    """
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(prefix="upload-", suffix=".pdf", delete=False) as spool:
+        for block in iter(lambda: stream.read(block_size), b""):
+            digest.update(block)
+            spool.write(block)
+    return spool.name, digest.hexdigest()
+
+def remove_spool(path):
+    """Deletes a spooled upload, ignoring files that are already gone"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# --- PDF Ingestion ---
+_ingestion_lock = threading.Lock()
+_extraction_pool = None
+_job_runner = None
+
+def get_ingestion_executors():
+    """Lazily creates the extraction process pool and the job runner thread pool"""
+    global _extraction_pool, _job_runner
+    with _ingestion_lock:
+        if _extraction_pool is None:
+            # Forking a multithreaded server process can copy a lock some other thread holds;
+            # forkserver (spawn where unavailable) starts workers from a clean process
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _extraction_pool = ProcessPoolExecutor(max_workers=INGESTION_WORKERS,
+                                                   mp_context=multiprocessing.get_context(start_method))
+            _job_runner = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ingestion")
+    return _extraction_pool, _job_runner
+
+def extract_page_range(path, start, end, backend=None):
+    """Extracts the text of pages [start, end); runs in a worker process"""
+    with get_extractor(backend)(path) as extractor:
+        return start, extractor.page_texts(start, end)
+
+def store_pdf(filename, page_texts, content_hash):
+    """
+    Persists extracted pages as a pdfs document and builds its retrieval index.
+
+    Returns:
+        The document's ObjectId (an existing one if the same file was stored
+        concurrently), or None if the pages contain no text
+    """
+    page_records = []
+    total_words = 0
+    for page_number, page_text in enumerate(page_texts, start=1):
+        word_count = len(page_text.split())
+        if word_count:
+            page_records.append({
+                "page": page_number,
+                "text": page_text,
+                "word_count": word_count
+            })
+        total_words += word_count
+
+    if not page_records:
+        return None
+
+    pdf_doc = {
+        "filename": filename,
+        "content_hash": content_hash,
+        "page_count": len(page_texts),
+        "word_count": total_words,
+        "uploaded_at": datetime.datetime.utcnow()
+    }
+    from pymongo.errors import DuplicateKeyError
+
+    try:
+        result = pdfs_collection.insert_one(pdf_doc)
+    except DuplicateKeyError:
+        # Another request stored the same file while we were extracting it
+        return pdfs_collection.find_one({"content_hash": content_hash}, {"_id": 1})["_id"]
+
+    try:
+        for record in page_records:
+            record["pdfId"] = result.inserted_id
+        pdf_pages_collection.insert_many(page_records)
+    except Exception:
+        # Don't leave a document behind that has no pages to serve
+        pdfs_collection.delete_one({"_id": result.inserted_id})
+        pdf_pages_collection.delete_many({"pdfId": result.inserted_id})
+        raise
+
+    try:
+        index_pdf_chunks(result.inserted_id, page_texts)
+    except Exception as e:
+        # Not fatal: the index is rebuilt from the stored pages on first use
+        print(f"Chunk indexing error: {e}")
+
+    if QUIZ_BANK_BACKGROUND:
+        schedule_quiz_bank(result.inserted_id)
+
+    return result.inserted_id
+
+def fail_stale_upload_jobs(query):
+    """
+    Marks matching jobs failed when they stopped reporting progress.
+
+    Jobs run in-process, so a restarted or killed worker leaves its jobs
+    queued/processing forever; without this, uploads of the same file would
+    keep joining the dead job and clients would poll it indefinitely.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=UPLOAD_JOB_STALE_SECONDS)
+    upload_jobs_collection.update_many(
+        dict(query, status={"$in": ["queued", "processing"]}, updated_at={"$lt": cutoff}),
+        {"$set": {
+            "status": "failed",
+            "error": "Processing stopped unexpectedly. Please upload the file again.",
+            "updated_at": datetime.datetime.utcnow()
+        }}
+    )
+
+def run_ingestion_job(job_id, filename, path, content_hash, num_pages):
+    """
+    Extracts pages in parallel across worker processes, merges them in order and stores the PDF.
+
+    Workers open the spooled file themselves (sharing the OS page cache)
+    instead of each being sent a copy of the bytes; the file is deleted when
+    the job ends.
+    """
+    def update_job(fields, inc=None):
+        update = {"$set": dict(fields, updated_at=datetime.datetime.utcnow())}
+        if inc:
+            update["$inc"] = inc
+        upload_jobs_collection.update_one({"_id": job_id}, update)
+
+    try:
+        update_job({"status": "processing"})
+        extraction_pool, _ = get_ingestion_executors()
+
+        # Several small ranges per worker so progress advances steadily
+        range_size = max(1, math.ceil(num_pages / (INGESTION_WORKERS * 2)))
+        futures = [
+            extraction_pool.submit(extract_page_range, path, start, min(start + range_size, num_pages), PDF_EXTRACTOR)
+            for start in range(0, num_pages, range_size)
+        ]
+
+        page_texts = [""] * num_pages
+        for future in as_completed(futures):
+            start, texts = future.result()
+            page_texts[start:start + len(texts)] = texts
+            update_job({}, inc={"pages_done": len(texts)})
+
+        pdf_id = store_pdf(filename, page_texts, content_hash)
+        if pdf_id is None:
+            update_job({"status": "failed", "error": "Could not extract text from PDF. The file may be image-based or corrupted."})
+        else:
+            update_job({"status": "done", "pdf_id": str(pdf_id)})
+    except Exception as e:
+        print(f"Ingestion job {job_id} error: {e}")
+        update_job({"status": "failed", "error": f"Failed to process PDF: {str(e)}"})
+    finally:
+        remove_spool(path)
+
+# --- Quiz Bank ---
+QUIZ_SHAPE = {"mcq": 2, "saq": 2, "laq": 1}           # Questions per served quiz
+BANK_SECTION_SHAPE = {"mcq": 4, "saq": 2, "laq": 1}   # Questions generated per document section
+_bank_runner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quiz-bank")
+
+def fill_quiz_lists(quiz_data):
+    """Ensures a quiz has mcqs, saqs and laqs lists"""
+    for key in ("mcqs", "saqs", "laqs"):
+        if not isinstance(quiz_data.get(key), list):
+            quiz_data[key] = []
+    return quiz_data
+
+_bank_queued = set()
+_bank_queued_lock = threading.Lock()
+
+def schedule_quiz_bank(pdf_id_obj):
+    """Queues a background build of the PDF's quiz bank, unless one is already queued here"""
+    with _bank_queued_lock:
+        if pdf_id_obj in _bank_queued:
+            return
+        _bank_queued.add(pdf_id_obj)
+
+    def run():
+        try:
+            build_quiz_bank(pdf_id_obj)
+        finally:
+            with _bank_queued_lock:
+                _bank_queued.discard(pdf_id_obj)
+
+    _bank_runner.submit(run)
+
+def quiz_bank_due(pdf_doc):
+    """
+    Whether a background build should be queued for this PDF.
+
+    True when there is no bank yet or the last builder stopped heartbeating.
+    Failed builds are retried with exponential backoff, up to
+    QUIZ_BANK_MAX_FAILURES times, and never while Gemini is shedding load.
+    """
+    now = datetime.datetime.utcnow()
+    status = pdf_doc.get("quiz_bank_status")
+    if status == "building":
+        claimed_at = pdf_doc.get("quiz_bank_claimed_at")
+        return claimed_at is None or claimed_at < now - datetime.timedelta(seconds=QUIZ_BANK_CLAIM_SECONDS)
+    if status == "failed":
+        failures = pdf_doc.get("quiz_bank_failures", 1)
+        failed_at = pdf_doc.get("quiz_bank_failed_at") or now
+        if failures >= QUIZ_BANK_MAX_FAILURES:
+            return False
+        if failed_at > now - datetime.timedelta(seconds=QUIZ_BANK_RETRY_SECONDS * 2 ** (failures - 1)):
+            return False
+        return guard_for(model).breaker.state == "closed"
+    return status != "ready"
+
+def build_quiz_bank(pdf_id_obj, max_sections=None):
+    """
+    Generates a pool of questions covering the whole PDF and stores it in quiz_questions.
+
+    The document's chunks are split into contiguous sections and each section
+    gets its own generation call, so questions are tagged with the pages they
+    come from. Only one build runs per PDF; progress is saved after every
+    section, so a build can be spread over several calls (max_sections each)
+    and one abandoned by a dead worker is resumed once its claim goes stale.
+
+    Args:
+        pdf_id_obj: The PDF's ObjectId
+        max_sections: Sections to generate in this call, or None for all that remain
+
+    Returns:
+        Number of questions stored by this call
+    """
+    import numpy as np
+
+    now = datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=QUIZ_BANK_CLAIM_SECONDS)
+    claim = uuid.uuid4().hex
+    claimed = pdfs_collection.find_one_and_update(
+        {"_id": pdf_id_obj, "$or": [
+            {"quiz_bank_status": {"$nin": ["building", "ready"]}},
+            {"quiz_bank_status": "building", "quiz_bank_claimed_at": {"$not": {"$gte": stale}}}
+        ]},
+        {"$set": {"quiz_bank_status": "building", "quiz_bank_claim": claim, "quiz_bank_claimed_at": now}},
+        projection={"quiz_bank_next_section": 1, "quiz_bank_size": 1}
+    )
+    if not claimed:
+        return 0
+
+    stored = 0
+    next_section = claimed.get("quiz_bank_next_section", 0)
+    try:
+        chunk_docs = ensure_chunk_index(pdf_id_obj, {"text": 1, "page": 1})
+        sections = np.array_split(np.arange(len(chunk_docs)), min(QUIZ_BANK_SECTIONS, len(chunk_docs)) or 1)
+        remaining = range(next_section, len(sections))
+        if max_sections is not None:
+            remaining = remaining[:max_sections]
+        for position in remaining:
+            section = sections[position]
+            if not len(section):
+                continue
+            # At most 10 passages per section keeps each prompt small
+            picked = section[spread_positions(len(section), 10)]
+            passages = [chunk_docs[i] for i in picked]
+            pages = sorted({chunk["page"] for chunk in passages if chunk.get("page")})
+            text_content = "\n\n".join(chunk["text"] for chunk in passages)
+
+            prompt = f"""
+            Based on the text from a coursebook, generate {BANK_SECTION_SHAPE["mcq"]} MCQs, {BANK_SECTION_SHAPE["saq"]} SAQs, and {BANK_SECTION_SHAPE["laq"]} LAQ.
+            Return ONLY a single valid JSON object with keys "mcqs", "saqs", and "laqs".
+            For MCQs, include "question", "options" (array of 4 options), "correctAnswer" and "topic".
+            For SAQs/LAQs, include "question", "idealAnswer" and "topic".
+            "topic" is a short (2-5 word) name for the concept the question tests.
+
+            IMPORTANT: 
+            - Return ONLY valid JSON, no markdown formatting, no backticks, no extra text
+            - "correctAnswer" must be copied exactly from "options" (no letter, no added punctuation)
+            - Ensure all strings are properly escaped
+            - All questions must be based on the provided text
+
+            Text content:
+            ---
+            {text_content}
+            ---
+
+            JSON Response:
+            """
+            try:
+                quiz_data = fill_quiz_lists(generate_structured(model, prompt, BANK_QUIZ_SCHEMA, namespace="quiz-bank"))
+                quiz_data["mcqs"] = repair_mcqs(quiz_data["mcqs"])
+            except UpstreamUnavailable:
+                raise
+            except Exception as e:
+                # One bad section shouldn't discard the rest of the bank
+                print(f"Quiz bank section error for {pdf_id_obj}: {e}")
+                quiz_data = fill_quiz_lists({})
+
+            records = []
+            for qtype, key in (("mcq", "mcqs"), ("saq", "saqs"), ("laq", "laqs")):
+                for question in quiz_data[key]:
+                    if not isinstance(question, dict) or not question.get("question"):
+                        continue
+                    record = {
+                        "pdfId": pdf_id_obj,
+                        "type": qtype,
+                        "question": question["question"],
+                        "topic": sanitize_text(question.get("topic"), max_length=100),
+                        "pages": pages,
+                        "created_at": datetime.datetime.utcnow()
+                    }
+                    if qtype == "mcq":
+                        if not isinstance(question.get("options"), list) or not question.get("correctAnswer"):
+                            continue
+                        record["options"] = question["options"]
+                        record["correctAnswer"] = question["correctAnswer"]
+                    else:
+                        record["idealAnswer"] = question.get("idealAnswer", "")
+                    records.append(record)
+            # Advance (and heartbeat) first: a builder whose claim was taken over must not add duplicates
+            advanced = pdfs_collection.update_one(
+                {"_id": pdf_id_obj, "quiz_bank_claim": claim},
+                {"$set": {"quiz_bank_next_section": position + 1, "quiz_bank_claimed_at": datetime.datetime.utcnow()},
+                 "$inc": {"quiz_bank_size": len(records)}}
+            )
+            if not advanced.matched_count:
+                return stored
+            if records:
+                quiz_questions_collection.insert_many(records)
+                stored += len(records)
+
+        next_section = remaining.stop if len(remaining) else next_section
+        if next_section < len(sections):
+            # More sections to go: release the claim so the next call carries on
+            status = "partial"
+        else:
+            size = claimed.get("quiz_bank_size", 0) + stored
+            status = "ready" if size else "failed"
+        if status == "failed":
+            record_quiz_bank_failure(pdf_id_obj, claim, {"quiz_bank_next_section": 0})  # A retry starts over
+        else:
+            update = {"$set": {"quiz_bank_status": status}}
+            if status == "ready":
+                update["$unset"] = {"quiz_bank_failures": "", "quiz_bank_failed_at": ""}
+            pdfs_collection.update_one({"_id": pdf_id_obj, "quiz_bank_claim": claim}, update)
+    except Exception as e:
+        print(f"Quiz bank build error for {pdf_id_obj}: {e}")
+        # Saved sections are kept; the next build resumes after them
+        record_quiz_bank_failure(pdf_id_obj, claim)
+        if isinstance(e, UpstreamUnavailable):
+            raise
+    return stored
+
+def record_quiz_bank_failure(pdf_id_obj, claim, fields=None):
+    """Marks a build failed and counts it, so background retries back off"""
+    pdfs_collection.update_one({"_id": pdf_id_obj, "quiz_bank_claim": claim}, {
+        "$set": dict(fields or {}, quiz_bank_status="failed", quiz_bank_failed_at=datetime.datetime.utcnow()),
+        "$inc": {"quiz_bank_failures": 1}
+    })
+
+@timed("db_fetch")
+def sample_quiz_from_bank(pdf_id_obj):
+    """
+    Draws a random quiz from the PDF's question bank.
+
+    Returns:
+        Quiz data in the generate_quiz shape, or None if the bank can't fill a quiz
+    """
+    quiz_data = {}
+    for qtype, count in QUIZ_SHAPE.items():
+        questions = list(quiz_questions_collection.aggregate([
+            {"$match": {"pdfId": pdf_id_obj, "type": qtype}},
+            {"$sample": {"size": count}},
+            {"$project": {"_id": 0, "question": 1, "options": 1, "correctAnswer": 1, "idealAnswer": 1}}
+        ]))
+        if len(questions) < count:
+            return None
+        quiz_data[f"{qtype}s"] = questions
+    return quiz_data
+
+def encode_cursor(doc):
+    """Opaque pagination token for the position just after doc in (uploaded_at, _id) order"""
+    payload = json.dumps({"t": doc["uploaded_at"].isoformat(), "id": str(doc["_id"])})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(token):
+    """Returns the (uploaded_at, ObjectId) position encoded in a cursor token, or None if invalid"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        doc_id = validate_object_id(payload["id"])
+        if doc_id:
+            return datetime.datetime.fromisoformat(payload["t"]), doc_id
+    except (ValueError, KeyError, TypeError):
+        pass
+    return None
+
 # --- API Endpoints ---
 
 @app.route('/api/upload', methods=['POST'])
@@ -114,6 +2487,7 @@ def upload_pdf():
     if not file.filename.endswith('.pdf'):
         return jsonify({"error": "Invalid file type. Please upload a PDF."}), 400
 
+    path = extractor = None
     try:
         original_filename = secure_filename(file.filename)
         
@@ -121,81 +2495,172 @@ def upload_pdf():
         if len(original_filename) > 255:
             return jsonify({"error": "Filename too long"}), 400
 
-        # Process the file in-memory without saving to disk
-        pdf_reader = PyPDF2.PdfReader(file.stream)
+        # Spool to a temporary file so extraction pages it in rather than holding the upload in memory
+        path, content_hash = spool_upload(file.stream)
+
+        # Identical files reuse the earlier extraction, index and cached responses
+        existing = pdfs_collection.find_one({"content_hash": content_hash}, {"_id": 1})
+        if existing:
+            return jsonify({
+                "success": True,
+                "message": "File already uploaded.",
+                "pdf_id": str(existing["_id"]),
+                "duplicate": True
+            }), 200
+
+        extractor = get_extractor()(path)
         
         # FIXED: Limit number of pages to prevent DoS
-        max_pages = 100
-        num_pages = len(pdf_reader.pages)
-        if num_pages > max_pages:
-            return jsonify({"error": f"PDF too large. Maximum {max_pages} pages allowed."}), 400
-        
-        extracted_text = ""
-        for i, page in enumerate(pdf_reader.pages):
-            if i >= max_pages:
-                break
-            page_text = page.extract_text()
-            if page_text:
-                extracted_text += page_text + "\n"
+        num_pages = extractor.page_count()
+        if num_pages > MAX_PDF_PAGES:
+            return jsonify({"error": f"PDF too large. Maximum {MAX_PDF_PAGES} pages allowed."}), 400
 
-        if not extracted_text.strip():
-            return jsonify({"error": "Could not extract text from PDF. The file may be image-based or corrupted."}), 400
+        if ASYNC_INGESTION:
+            # The same file may already be extracting for another request; dead jobs are retired first
+            fail_stale_upload_jobs({"content_hash": content_hash})
+            pending_job = upload_jobs_collection.find_one(
+                {"content_hash": content_hash, "status": {"$in": ["queued", "processing"]}},
+                {"_id": 1}
+            )
+            if pending_job:
+                return jsonify({
+                    "success": True,
+                    "message": "File is already being processed.",
+                    "job_id": pending_job["_id"],
+                    "status_url": f"/api/upload/{pending_job['_id']}",
+                    "duplicate": True
+                }), 202
 
-        # FIXED: Limit total text length to prevent storage issues
-        max_text_length = 500000  # 500KB of text
-        if len(extracted_text) > max_text_length:
-            extracted_text = extracted_text[:max_text_length]
+            # Accept immediately; extraction runs on the worker pool and is polled via /api/upload/<job_id>
+            job_id = uuid.uuid4().hex
+            upload_jobs_collection.insert_one({
+                "_id": job_id,
+                "filename": original_filename,
+                "content_hash": content_hash,
+                "status": "queued",
+                "pages_done": 0,
+                "pages_total": num_pages,
+                "pdf_id": None,
+                "error": None,
+                "created_at": datetime.datetime.utcnow(),
+                "updated_at": datetime.datetime.utcnow()
+            })
+            _, job_runner = get_ingestion_executors()
+            job_runner.submit(run_ingestion_job, job_id, original_filename, path, content_hash, num_pages)
+            path = None  # The job deletes the spool file when it finishes
 
-        pdf_doc = {
-            "filename": original_filename,
-            "extracted_text": extracted_text,
-            "page_count": num_pages,
-            "uploaded_at": datetime.datetime.utcnow()
-        }
-        result = pdfs_collection.insert_one(pdf_doc)
+            return jsonify({
+                "success": True,
+                "message": "File accepted for processing.",
+                "job_id": job_id,
+                "status_url": f"/api/upload/{job_id}"
+            }), 202
+
+        with stage("extract"):
+            page_texts = extractor.page_texts(0, num_pages)
+        with stage("db_write"):
+            pdf_id = store_pdf(original_filename, page_texts, content_hash)
+        if pdf_id is None:
+            return jsonify({"error": "Could not extract text from PDF. The file may be image-based or corrupted."}), 400
 
         return jsonify({
             "success": True,
             "message": "File uploaded and processed.",
-            "pdf_id": str(result.inserted_id)
+            "pdf_id": str(pdf_id)
         }), 201
         
-    except PyPDF2.errors.PdfReadError:
+    except InvalidPdf:
         return jsonify({"error": "Invalid or corrupted PDF file."}), 400
     except Exception as e:
         print(f"Upload error: {e}")
         return jsonify({"error": f"Failed to process PDF: {str(e)}"}), 500
+    finally:
+        if extractor:
+            extractor.close()
+        if path:
+            remove_spool(path)
+
+
+@app.route('/api/upload/<job_id>', methods=['GET'])
+def get_upload_status(job_id):
+    """Report progress of a background PDF ingestion job"""
+    try:
+        job_id = sanitize_text(job_id, max_length=64)
+        fail_stale_upload_jobs({"_id": job_id})
+        job = upload_jobs_collection.find_one({"_id": job_id})
+        if not job:
+            return jsonify({"error": "Upload job not found."}), 404
+
+        return jsonify({
+            "job_id": job["_id"],
+            "status": job["status"],
+            "pages_done": job["pages_done"],
+            "pages_total": job["pages_total"],
+            "pdf_id": job.get("pdf_id"),
+            "error": job.get("error")
+        }), 200
+    except Exception as e:
+        print(f"Upload status error: {e}")
+        return jsonify({"error": f"Failed to retrieve upload status: {str(e)}"}), 500
 
 
 @app.route('/api/pdfs', methods=['GET'])
 def get_pdfs():
-    """Get list of all uploaded PDFs"""
+    """Get list of all uploaded PDFs, newest first, paginated with an opaque cursor"""
     try:
-        # FIXED: Add pagination support
-        page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 50, type=int)
         
         # Limit per_page to prevent abuse
-        per_page = min(per_page, 100)
-        
-        skip = (page - 1) * per_page
-        
-        all_pdfs = list(pdfs_collection.find(
-            {},
-            {"extracted_text": 0}  # Don't return full text in list
-        ).sort("uploaded_at", -1).skip(skip).limit(per_page))
-        
-        total = pdfs_collection.count_documents({})
+        per_page = max(1, min(per_page, 100))
+
+        # Keyset pagination: seek past the last (uploaded_at, _id) seen instead of skipping rows
+        query = {}
+        cursor = request.args.get('cursor')
+        if cursor:
+            position = decode_cursor(cursor)
+            if not position:
+                return jsonify({"error": "Invalid cursor."}), 400
+            uploaded_at, last_id = position
+            query = {"$or": [
+                {"uploaded_at": {"$lt": uploaded_at}},
+                {"uploaded_at": uploaded_at, "_id": {"$lt": last_id}}
+            ]}
         
-        return jsonify({
-            "pdfs": [serialize_doc(pdf) for pdf in all_pdfs],
-            "total": total,
-            "page": page,
-            "per_page": per_page
-        }), 200
+        with stage("db_fetch"):
+            # Collection metadata count: constant time, unlike count_documents({})
+            total = pdfs_collection.estimated_document_count()
+
+            # Documents are encoded as they come off the cursor; the extra one tells us whether there is a next page
+            pdfs = pdfs_collection.find(
+                query,
+                # Only what the list shows: no text and no indexing/cache bookkeeping
+                {"filename": 1, "page_count": 1, "word_count": 1, "uploaded_at": 1}
+            ).sort([("uploaded_at", -1), ("_id", -1)]).limit(per_page + 1)
+            return json_list_response("pdfs", pdfs, fields={"total": total, "per_page": per_page}, limit=per_page,
+                                      after=lambda last, more: {"next_cursor": encode_cursor(last) if more else None})
+    except Exception as e:
+        print(f"Get PDFs error: {e}")
+        return jsonify({"error": f"Failed to retrieve PDFs: {str(e)}"}), 500
+
+
+@app.route('/api/pdfs/<pdf_id>/pages', methods=['GET'])
+def get_pages(pdf_id):
+    """Get the extracted text of a page range"""
+    pdf_id_obj = validate_object_id(pdf_id)
+    if not pdf_id_obj:
+        return jsonify({"error": "Invalid PDF ID."}), 400
+
+    try:
+        first_page = request.args.get('from', 1, type=int)
+        last_page = request.args.get('to', first_page + 9, type=int)
+        # Limit the range to keep responses small
+        last_page = min(last_page, first_page + 19)
+
+        pages = get_pdf_pages(pdf_id_obj, first_page, last_page)
+        return jsonify({"pages": pages, "from": first_page, "to": last_page}), 200
     except Exception as e:
-        print(f"Get PDFs error: {e}")
-        return jsonify({"error": f"Failed to retrieve PDFs: {str(e)}"}), 500
+        print(f"Get pages error: {e}")
+        return jsonify({"error": f"Failed to retrieve pages: {str(e)}"}), 500
 
 
 @app.route('/api/generate-quiz', methods=['POST'])
@@ -213,12 +2678,21 @@ def generate_quiz():
         return jsonify({"error": "Invalid PDF ID format."}), 400
 
     try:
-        pdf_doc = pdfs_collection.find_one({"_id": pdf_id_obj})
-        if not pdf_doc or not pdf_doc.get('extracted_text'):
+        pdf_doc = find_pdf(pdf_id_obj)
+        if not pdf_doc:
             return jsonify({"error": "PDF not found or has no text content."}), 404
 
-        # FIXED: Limit text sent to API to prevent token limit errors
-        text_content = " ".join(pdf_doc['extracted_text'].split()[:4000])
+        # Send passages spread across the whole book (or matching the topic) rather than a prefix
+        topic = sanitize_text(data.get('topic'), max_length=200)
+
+        # Serve general quizzes from the precomputed bank; topic quizzes and empty banks go live
+        if not topic:
+            quiz_data = sample_quiz_from_bank(pdf_id_obj)
+            if quiz_data:
+                quiz_data["source"] = "bank"
+                return jsonify(quiz_data), 200
+
+        text_content = retrieve_context(pdf_doc, query=topic, top_k=12, sample=True)
         
         prompt = f"""
         Based on the text from a coursebook, generate a quiz with 2 MCQs, 2 SAQs, and 1 LAQ.
@@ -228,6 +2702,7 @@ def generate_quiz():
 
         IMPORTANT: 
         - Return ONLY valid JSON, no markdown formatting, no backticks, no extra text
+        - "correctAnswer" must be copied exactly from "options" (no letter, no added punctuation)
         - Ensure all strings are properly escaped
         - All questions must be based on the provided text
 
@@ -239,108 +2714,504 @@ def generate_quiz():
         JSON Response:
         """
         
-        response = generate_with_retry(model, prompt)
-        
-        # FIXED: Better JSON extraction from response
-        cleaned_response = response.text.strip()
-        
-        # Remove markdown code blocks if present
-        if cleaned_response.startswith("```"):
-            lines = cleaned_response.split('\n')
-            cleaned_response = '\n'.join(lines[1:-1] if lines[-1].strip() == "```" else lines[1:])
-        
-        cleaned_response = cleaned_response.replace("```json", "").replace("```", "").strip()
-        
         try:
-            quiz_data = json.loads(cleaned_response)
-        except json.JSONDecodeError as je:
-            print(f"JSON parse error: {je}")
-            print(f"Response was: {cleaned_response[:500]}")
+            quiz_data = fill_quiz_lists(generate_structured(model, prompt, QUIZ_SCHEMA, namespace="generate-quiz"))
+            quiz_data["mcqs"] = repair_mcqs(quiz_data["mcqs"])
+        except ValueError:
             return jsonify({"error": "Failed to parse quiz data. Please try again."}), 500
-        
-        # FIXED: Validate quiz structure
-        if not isinstance(quiz_data.get('mcqs'), list):
-            quiz_data['mcqs'] = []
-        if not isinstance(quiz_data.get('saqs'), list):
-            quiz_data['saqs'] = []
-        if not isinstance(quiz_data.get('laqs'), list):
-            quiz_data['laqs'] = []
-            
+
+        if QUIZ_BANK_BACKGROUND and not topic and quiz_bank_due(pdf_doc):
+            # No bank yet (e.g. uploaded before banks existed) or its build died: build one for next time
+            schedule_quiz_bank(pdf_id_obj)
+
+        quiz_data["source"] = "live"
         return jsonify(quiz_data), 200
         
+    except UpstreamUnavailable as e:
+        return busy_response(e)
     except Exception as e:
         print(f"Generate quiz error: {e}")
         return jsonify({"error": f"Failed to generate quiz: {str(e)}"}), 500
 
 
-@app.route('/api/chat', methods=['POST'])
-def handle_chat():
-    """Handle chat messages with AI teacher"""
-    data = request.get_json()
-    user_message = data.get('message')
-    pdf_id = data.get('pdfId')
-    history = data.get('history', [])  # FIXED: Accept chat history
-
-    if not user_message or not pdf_id:
-        return jsonify({"error": "Message and PDF ID are required."}), 400
+@app.route('/api/pdfs/<pdf_id>/quiz-bank', methods=['POST'])
+def create_quiz_bank(pdf_id):
+    """
+    Build the next section of a PDF's quiz bank (for deployments without background work).
 
-    # FIXED: Validate inputs
-    user_message = sanitize_text(user_message, max_length=2000)
-    if not user_message:
-        return jsonify({"error": "Invalid message."}), 400
-    
+    One Gemini call per request keeps each invocation inside serverless time
+    limits; clients repeat the call while it answers 202.
+    """
     pdf_id_obj = validate_object_id(pdf_id)
     if not pdf_id_obj:
         return jsonify({"error": "Invalid PDF ID."}), 400
 
     try:
-        pdf_doc = pdfs_collection.find_one({"_id": pdf_id_obj})
-        if not pdf_doc or not pdf_doc.get('extracted_text'):
+        if not find_pdf(pdf_id_obj):
             return jsonify({"error": "PDF not found or has no text content."}), 404
-        
-        text_content = pdf_doc.get('extracted_text', '')
-        
-        # FIXED: Include conversation history in context
-        history_context = ""
-        if history and isinstance(history, list):
-            recent_history = history[-6:]  # Last 6 messages (3 exchanges)
-            for msg in recent_history:
-                if isinstance(msg, dict):
-                    role = msg.get('role', '')
-                    content = msg.get('content', '')
-                    if role == 'user':
-                        history_context += f"\nStudent: {content}"
-                    elif role == 'ai':
-                        history_context += f"\nTeacher: {content}"
-        
+
+        build_quiz_bank(pdf_id_obj, max_sections=1)
+        pdf_doc = pdfs_collection.find_one({"_id": pdf_id_obj}, {"quiz_bank_status": 1, "quiz_bank_size": 1})
+        status = pdf_doc.get("quiz_bank_status")
+        return jsonify({
+            "status": status,
+            "size": pdf_doc.get("quiz_bank_size", 0)
+        }), 200 if status in ("ready", "failed") else 202
+    except UpstreamUnavailable as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"Quiz bank error: {e}")
+        return jsonify({"error": f"Failed to build quiz bank: {str(e)}"}), 500
+
+
+# --- Document Context Cache ---
+CHAT_CONTEXT_CACHE = os.getenv("CHAT_CONTEXT_CACHE", "gemini")    # gemini, local (stand-in) or off
+CONTEXT_CACHE_MIN_WORDS = 1000    # Gemini refuses to cache much less than ~1k tokens
+CONTEXT_CACHE_MAX_WORDS = int(os.getenv("CONTEXT_CACHE_MAX_WORDS", "8000"))  # Bigger books are cheaper to retrieve from
+CONTEXT_CACHE_TTL = 3600
+CHAT_SYSTEM_INSTRUCTION = """You are a helpful AI teacher. A student is asking questions about the document you have been given.
+Provide clear and concise answers based ONLY on the document. Do not use any external knowledge.
+Cite specific parts of the document (with page numbers) when relevant."""
+
+_context_models = {}   # pdf id -> (expires at, model or None)
+_context_lock = threading.Lock()
+
+
+class LocalCachedModel:
+    """
+    Local stand-in for a Gemini model bound to cached content.
+
+    Prepends the cached context to every prompt, so chat behaves the same as
+    with Gemini context caching without calling the caching API. Used when
+    CHAT_CONTEXT_CACHE=local (benchmarks, offline development).
+    """
+    def __init__(self, base_model, name, context):
+        self.base_model = base_model
+        self.cached_content = name
+        self.context = context
+
+    @property
+    def model_name(self):
+        return self.base_model.model_name
+
+    def generate_content(self, prompt, **kwargs):
+        return self.base_model.generate_content(f"{self.context}\n\n{prompt}", **kwargs)
+
+
+def document_context_text(pdf_doc):
+    """The whole document as one context block, page-tagged like retrieved passages"""
+    page_texts, paged = load_page_texts(pdf_doc["_id"])
+    body = "\n\n".join(f"[Page {number}]\n{text}" if paged else text
+                       for number, text in enumerate(page_texts, start=1) if text)
+    return f"Document: {pdf_doc.get('filename', '')}\n\n{body}"
+
+def create_context_cache(pdf_doc):
+    """Creates Gemini cached content holding the document and records it on the PDF; returns its name"""
+    import google.generativeai as genai
+
+    cached = genai.caching.CachedContent.create(
+        model=f"models/{GEMINI_MODEL_NAME}",
+        display_name=f"pdf-{pdf_doc['_id']}",
+        system_instruction=CHAT_SYSTEM_INSTRUCTION,
+        contents=[document_context_text(pdf_doc)],
+        ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL)
+    )
+    # Expire our record a little early so nobody is handed a cache that is about to vanish
+    pdfs_collection.update_one({"_id": pdf_doc["_id"]}, {"$set": {"context_cache": {
+        "name": cached.name,
+        "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=CONTEXT_CACHE_TTL - 120)
+    }}})
+    return cached.name
+
+def get_context_model(pdf_doc):
+    """
+    Returns a model that already holds the whole document in cached context, or None to use retrieval.
+
+    Only mid-sized documents qualify: small ones are under Gemini's caching
+    minimum, and for large ones a few retrieved passages cost fewer tokens per
+    turn than the whole book, even at the cached-token rate. Gemini caches are
+    shared by all workers through the PDF's context_cache field.
+    """
+    if CHAT_CONTEXT_CACHE not in ("gemini", "local"):
+        return None
+    if not CONTEXT_CACHE_MIN_WORDS <= pdf_doc.get("word_count", 0) <= CONTEXT_CACHE_MAX_WORDS:
+        return None
+
+    pdf_id = pdf_doc["_id"]
+    now = time.time()
+    with _context_lock:
+        entry = _context_models.get(pdf_id)
+    if entry and entry[0] > now:
+        return entry[1]
+
+    try:
+        if CHAT_CONTEXT_CACHE == "local":
+            context_model = LocalCachedModel(model, f"local/{pdf_id}",
+                                             f"{CHAT_SYSTEM_INSTRUCTION}\n\n{document_context_text(pdf_doc)}")
+            expires = now + CONTEXT_CACHE_TTL
+        else:
+            import google.generativeai as genai
+
+            cache = pdf_doc.get("context_cache")
+            if cache and cache["expires_at"] > datetime.datetime.utcnow() + datetime.timedelta(seconds=60):
+                name = cache["name"]
+                remaining = (cache["expires_at"] - datetime.datetime.utcnow()).total_seconds()
+            else:
+                name = single_flight.do(("context-cache", pdf_id), lambda: create_context_cache(pdf_doc),
+                                        namespace="context-cache")
+                remaining = CONTEXT_CACHE_TTL - 120
+            context_model = genai.GenerativeModel.from_cached_content(cached_content=name)
+            expires = now + remaining
+        metrics.inc("context_cache_loads_total", mode=CHAT_CONTEXT_CACHE)
+    except Exception as e:
+        # Fall back to retrieval for a while rather than retrying on every turn
+        print(f"Context cache unavailable for {pdf_id}: {e}")
+        context_model, expires = None, now + 600
+
+    with _context_lock:
+        _context_models[pdf_id] = (expires, context_model)
+    return context_model
+
+
+# --- Chat Sessions ---
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1200"))  # Verbatim history per prompt
+CHAT_RECENT_MESSAGES = 4          # Latest messages that always stay verbatim
+CHAT_SEED_MESSAGES = 10           # Client-side history accepted when a session is created
+CHAT_MAX_PDFS = 10                # PDFs one conversation can draw passages from
+CHAT_SESSION_TTL = datetime.timedelta(days=7)
+SESSION_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token)"""
+    return len(text) // 4 + 1
+
+def load_chat_session(session_id, pdf_ids, seed_history=None):
+    """
+    Returns the chat session for these PDFs, creating one if the id is missing, unknown or for other PDFs.
+
+    New sessions are seeded with the client's own history, so conversations
+    started before sessions existed keep their context.
+    """
+    if session_id:
+        with stage("db_fetch"):
+            session = chat_sessions_collection.find_one({"_id": session_id, "pdfIds": pdf_ids})
+        if session:
+            return session
+
+    turns = []
+    if isinstance(seed_history, list):
+        for msg in seed_history[-CHAT_SEED_MESSAGES:]:
+            if isinstance(msg, dict) and msg.get('role') in ('user', 'ai') and isinstance(msg.get('content'), str):
+                turns.append({"role": msg['role'], "content": sanitize_text(msg['content'], max_length=4000)})
+    now = datetime.datetime.utcnow()
+    session = {
+        "_id": uuid.uuid4().hex,
+        "pdfIds": pdf_ids,
+        "summary": "",
+        "turns": turns,
+        "summarized_messages": 0,
+        "created_at": now,
+        "updated_at": now,
+        "expires_at": now + CHAT_SESSION_TTL
+    }
+    with stage("db_write"):
+        chat_sessions_collection.insert_one(session)
+    return session
+
+_summary_runner = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-summary")
+
+def over_history_budget(turns):
+    """Whether a session's turns no longer fit the verbatim history budget"""
+    return len(turns) > CHAT_RECENT_MESSAGES and \
+        sum(estimate_tokens(turn["content"]) for turn in turns) > CHAT_HISTORY_TOKEN_BUDGET
+
+def prompt_chat_turns(session):
+    """The turns sent verbatim: all of them within budget, otherwise the latest CHAT_RECENT_MESSAGES"""
+    turns = session["turns"]
+    return turns[-CHAT_RECENT_MESSAGES:] if over_history_budget(turns) else turns
+
+def schedule_chat_summary(session_id):
+    """Compacts a session after its turn, in the background when long-lived workers allow it"""
+    if CHAT_SUMMARY_BACKGROUND:
+        _summary_runner.submit(compact_chat_session, session_id)
+    else:
+        compact_chat_session(session_id)
+
+def compact_chat_session(session_id):
+    """
+    Folds older turns into the session's rolling summary once its history exceeds the token budget.
+
+    Runs after a turn is recorded, so the summary call never delays an answer;
+    until it lands, prompts carry the previous summary and the latest
+    CHAT_RECENT_MESSAGES, so prompt size stays roughly constant however long
+    the conversation runs.
+    """
+    try:
+        session = chat_sessions_collection.find_one({"_id": session_id})
+        if not session or not over_history_budget(session["turns"]):
+            return
+
+        turns = session["turns"]
+        older, recent = turns[:-CHAT_RECENT_MESSAGES], turns[-CHAT_RECENT_MESSAGES:]
+        transcript = "\n".join(f"{'Student' if turn['role'] == 'user' else 'Teacher'}: {turn['content']}"
+                               for turn in older)
         prompt = f"""
-        You are a helpful AI teacher. A student has asked a question about a document they've uploaded.
-        Your task is to provide a clear and concise answer based ONLY on the provided text from the document.
-        Do not use any external knowledge.
+    Update the running summary of a tutoring conversation about a document.
+    Keep what the student asked, what was explained, and anything they found difficult,
+    in at most 150 words. Return ONLY the summary.
 
-        Previous Conversation:
-        {history_context if history_context else "No previous conversation."}
+    Summary so far:
+    {session["summary"] or "None yet."}
 
-        Full Document Text:
-        ---
-        {text_content[:8000]}
-        ---
+    New messages:
+    {transcript}
+    """
+        # Summaries are low stakes, so they run on the fast tier
+        summary = generate_with_retry(fast_model, prompt).text.strip()
+
+        # Only if no turn was added meanwhile; otherwise the next turn compacts again
+        chat_sessions_collection.update_one({"_id": session_id, "turns": {"$size": len(turns)}}, {
+            "$set": {"summary": summary, "turns": recent, "updated_at": datetime.datetime.utcnow()},
+            "$inc": {"summarized_messages": len(older)}
+        })
+        metrics.inc("chat_summaries_total")
+    except Exception as e:
+        # The older turns remain stored for the next attempt
+        print(f"Chat summary error: {e}")
 
-        Student's Question: "{user_message}"
+def record_chat_turn(session_id, user_message, answer):
+    """Appends a question and its answer to a session, then compacts the session if it outgrew the budget"""
+    now = datetime.datetime.utcnow()
+    with stage("db_write"):
+        chat_sessions_collection.update_one({"_id": session_id}, {
+            "$push": {"turns": {"$each": [
+                {"role": "user", "content": user_message},
+                {"role": "ai", "content": answer}
+            ]}},
+            "$set": {"updated_at": now, "expires_at": now + CHAT_SESSION_TTL}
+        })
+    schedule_chat_summary(session_id)
 
-        Your Answer (be concise, helpful, and cite specific parts of the document when relevant):
-        """
-        
-        response = generate_with_retry(model, prompt)
+
+def build_chat_prompt(data):
+    """
+    Validates a chat request, loads its session and builds the AI teacher prompt.
+
+    Returns:
+        A (chat, None) tuple on success, where chat has the "prompt", the "model"
+        to send it to, the "session_id" and the cleaned "message";
+        or (None, (response, status)) on error
+    """
+    user_message = data.get('message')
+    # One PDF (pdfId) or several (pdfIds) for revising across chapters
+    pdf_ids = data.get('pdfIds') or ([data['pdfId']] if data.get('pdfId') else None)
+    session_id = data.get('sessionId')
+
+    if not user_message or not pdf_ids:
+        return None, (jsonify({"error": "Message and PDF ID are required."}), 400)
+    if not isinstance(pdf_ids, list) or len(pdf_ids) > CHAT_MAX_PDFS:
+        return None, (jsonify({"error": f"Chat with between 1 and {CHAT_MAX_PDFS} PDFs at a time."}), 400)
+
+    # FIXED: Validate inputs
+    user_message = sanitize_text(user_message, max_length=2000)
+    if not user_message:
+        return None, (jsonify({"error": "Invalid message."}), 400)
+
+    pdf_id_objs = [validate_object_id(pdf_id) if isinstance(pdf_id, str) else None for pdf_id in pdf_ids]
+    if not all(pdf_id_objs):
+        return None, (jsonify({"error": "Invalid PDF ID."}), 400)
+    pdf_id_objs = list(dict.fromkeys(pdf_id_objs))
+    if session_id is not None and not (isinstance(session_id, str) and SESSION_ID_PATTERN.fullmatch(session_id)):
+        return None, (jsonify({"error": "Invalid session ID."}), 400)
+
+    pdf_docs = [find_pdf(pdf_id_obj) for pdf_id_obj in pdf_id_objs]
+    if not all(pdf_docs):
+        return None, (jsonify({"error": "PDF not found or has no text content."}), 404)
+
+    # History lives server-side; older turns are folded into a rolling summary after each turn
+    session = load_chat_session(session_id, sorted(pdf_id_objs), data.get('history'))
+
+    history_context = ""
+    retrieval_query = user_message
+    for turn in prompt_chat_turns(session):
+        if turn["role"] == 'user':
+            history_context += f"\nStudent: {turn['content']}"
+            # Follow-ups like "explain more" need earlier questions to find passages
+            retrieval_query += f" {turn['content']}"
+        else:
+            history_context += f"\nTeacher: {turn['content']}"
+
+    conversation = f"""
+    Summary of the Earlier Conversation:
+    {session["summary"] or "None."}
+
+    Previous Conversation:
+    {history_context if history_context else "No previous conversation."}
+    """
+
+    # Documents held in Gemini cached content aren't resent; other documents send their best passages
+    context_model = get_context_model(pdf_docs[0]) if len(pdf_docs) == 1 else None
+    if context_model is not None:
+        prompt = f"""
+    {conversation}
+    Student's Question: "{user_message}"
+
+    Your Answer (be concise, helpful, and cite specific parts of the document when relevant):
+    """
+    else:
+        if len(pdf_docs) == 1:
+            text_content = retrieve_context(pdf_docs[0], query=retrieval_query, top_k=6)
+            sources = ""
+        else:
+            # Several PDFs share the single-PDF passage budget, so the prompt doesn't grow with the selection
+            text_content = retrieve_library_context(pdf_docs, retrieval_query)
+            sources = "The passages come from several documents; name the document as well as the page when citing."
+        prompt = f"""
+    {CHAT_SYSTEM_INSTRUCTION}
+    {sources}
+    {conversation}
+    Relevant Document Passages:
+    ---
+    {text_content}
+    ---
+
+    Student's Question: "{user_message}"
+
+    Your Answer (be concise, helpful, and cite specific parts of the document when relevant):
+    """
+    return {
+        "prompt": prompt,
+        "model": context_model if context_model is not None else model,
+        "session_id": session["_id"],
+        "message": user_message
+    }, None
+
+
+@app.route('/api/chat', methods=['POST'])
+def handle_chat():
+    """Handle chat messages with AI teacher"""
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return stream_chat()
+
+    data = request.get_json()
+
+    try:
+        chat, error = build_chat_prompt(data)
+        if error:
+            return error
+
+        # The prompt embeds the session's summary and recent turns, so repeats only hit within the same conversation state
+        response = generate_cached(chat["model"], chat["prompt"], namespace="chat")
         ai_response = response.text.strip()
+        record_chat_turn(chat["session_id"], chat["message"], ai_response)
 
-        return jsonify({"response": ai_response}), 200
+        return jsonify({"response": ai_response, "sessionId": chat["session_id"]}), 200
         
+    except UpstreamUnavailable as e:
+        return busy_response(e)
     except Exception as e:
         print(f"Chat API Error: {e}")
         return jsonify({"error": f"An error occurred while getting the AI response: {str(e)}"}), 500
 
 
+@app.route('/api/chat/stream', methods=['POST'])
+def stream_chat():
+    """Stream the AI teacher's answer as Server-Sent Events"""
+    data = request.get_json()
+    started = time.perf_counter()
+
+    try:
+        chat, error = build_chat_prompt(data)
+        if error:
+            return error
+
+        key = cache_key(chat["model"], chat["prompt"])
+        cached_text = response_cache.get(key, namespace="chat")
+        if cached_text is not None:
+            first_chunk, chunks = CachedResponse(cached_text), iter(())
+        else:
+            # Retries happen here, before any bytes are sent, so failures still get a JSON error
+            first_chunk, chunks = open_stream_with_retry(chat["model"], chat["prompt"])
+        ttft_ms = (time.perf_counter() - started) * 1000
+    except UpstreamUnavailable as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"Chat stream API Error: {e}")
+        return jsonify({"error": f"An error occurred while getting the AI response: {str(e)}"}), 500
+
+    def generate():
+        try:
+            parts = []
+            last_chunk = first_chunk
+            if first_chunk is not None:
+                text = chunk_text(first_chunk)
+                if text:
+                    parts.append(text)
+                    yield sse_event({"text": text})
+                for chunk in chunks:
+                    last_chunk = chunk
+                    text = chunk_text(chunk)
+                    if text:
+                        parts.append(text)
+                        yield sse_event({"text": text})
+            if cached_text is None:
+                # Token counts arrive on the final chunk of a stream
+                record_usage(last_chunk)
+                metrics.observe("llm_stream_seconds", time.perf_counter() - started, endpoint=current_endpoint())
+            if cached_text is None and parts:
+                response_cache.set(key, "".join(parts), namespace="chat")
+            if parts:
+                record_chat_turn(chat["session_id"], chat["message"], "".join(parts).strip())
+            total_ms = (time.perf_counter() - started) * 1000
+            yield sse_event({"ttft_ms": round(ttft_ms, 1), "total_ms": round(total_ms, 1),
+                             "sessionId": chat["session_id"]}, event="done")
+        except Exception as e:
+            print(f"Chat stream interrupted: {e}")
+            yield sse_event({"error": "The response was interrupted. Please try again."}, event="error")
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # Stop reverse proxies from buffering the stream
+        "Server-Timing": f"ttft;dur={ttft_ms:.1f}",
+    })
+
+
+@app.route('/api/chat/sessions/<session_id>', methods=['GET'])
+def get_chat_session(session_id):
+    """Get a chat session's rolling summary and recent turns"""
+    if not SESSION_ID_PATTERN.fullmatch(session_id):
+        return jsonify({"error": "Invalid session ID."}), 400
+    try:
+        session = chat_sessions_collection.find_one({"_id": session_id})
+        if not session:
+            return jsonify({"error": "Chat session not found."}), 404
+        return jsonify(session), 200
+    except Exception as e:
+        print(f"Get chat session error: {e}")
+        return jsonify({"error": f"Failed to retrieve chat session: {str(e)}"}), 500
+
+
+@app.route('/api/search', methods=['GET'])
+def search_pdfs():
+    """Search every uploaded PDF for a topic, e.g. to find which chapter covers it"""
+    query = sanitize_text(request.args.get('q'), max_length=200)
+    if not query:
+        return jsonify({"error": "Search query is required."}), 400
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+
+    try:
+        started = time.perf_counter()
+        results = search_library(query, limit)
+        return jsonify({
+            "query": query,
+            "results": results,
+            "took_ms": round((time.perf_counter() - started) * 1000, 1)
+        }), 200
+    except Exception as e:
+        print(f"Search error: {e}")
+        return jsonify({"error": f"Search failed: {str(e)}"}), 500
+
+
 @app.route('/api/recommend-videos', methods=['POST'])
 def recommend_videos():
     """Generate YouTube video recommendations based on PDF content"""
@@ -355,11 +3226,11 @@ def recommend_videos():
         return jsonify({"error": "Invalid PDF ID."}), 400
     
     try:
-        pdf_doc = pdfs_collection.find_one({"_id": pdf_id_obj})
-        if not pdf_doc or not pdf_doc.get('extracted_text'):
+        pdf_doc = find_pdf(pdf_id_obj)
+        if not pdf_doc:
             return jsonify({"error": "PDF not found or has no text content."}), 404
         
-        text_content = " ".join(pdf_doc['extracted_text'].split()[:3000])
+        text_content = retrieve_context(pdf_doc, top_k=10)
         
         prompt = f"""
         You are an expert educational content curator specializing in finding the best YouTube videos for students.
@@ -393,18 +3264,14 @@ def recommend_videos():
         JSON Response:
         """
         
-        response = generate_with_retry(model, prompt)
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-        
+        # Same PDF, same passages, same prompt: a whole class shares one generation.
+        # Low stakes, so it runs on the fast tier (falling back to the primary model if that is overloaded)
         try:
-            recommendations_data = json.loads(cleaned_response)
-        except json.JSONDecodeError:
-            print(f"Failed to parse video recommendations: {cleaned_response[:500]}")
+            recommendations_data = generate_structured(fast_model, prompt, RECOMMENDATIONS_SCHEMA,
+                                                       namespace="recommend-videos", cache_ttl=24 * 3600)
+        except ValueError:
             return jsonify({"error": "Failed to parse recommendations. Please try again."}), 500
         
-        if "recommendations" not in recommendations_data:
-            return jsonify({"error": "Invalid response format from AI."}), 500
-        
         # FIXED: Validate URLs
         validated_recommendations = []
         for rec in recommendations_data.get("recommendations", []):
@@ -416,17 +3283,242 @@ def recommend_videos():
         
         return jsonify({"recommendations": validated_recommendations}), 200
         
-    except json.JSONDecodeError as e:
-        print(f"JSON decode error: {e}")
-        return jsonify({"error": "Failed to parse AI response. Please try again."}), 500
+    except UpstreamUnavailable as e:
+        return busy_response(e)
     except Exception as e:
         print(f"Video recommendations error: {e}")
         return jsonify({"error": f"Failed to generate video recommendations: {str(e)}"}), 500
 
 
+# --- Quiz Scoring ---
+def flatten_quiz(quiz_questions):
+    """Lists (type, question) pairs in the order the quiz is rendered: MCQs, SAQs, then LAQs"""
+    questions = []
+    for qtype, key in (("mcq", "mcqs"), ("saq", "saqs"), ("laq", "laqs")):
+        for question in quiz_questions.get(key) or []:
+            if isinstance(question, dict):
+                questions.append((qtype, question))
+    return questions
+
+def normalize_answer(text):
+    """Lowercases and collapses whitespace so equivalent answers compare equal"""
+    return " ".join(str(text or "").lower().split())
+
+def option_key(text):
+    """Normalizes option text for matching: ignores a "B)"-style label, case, spacing and trailing punctuation"""
+    text = re.sub(r"^\(?[a-d][).:]\s+", "", normalize_answer(text))
+    return text.rstrip(" .!?;:")
+
+def resolve_correct_option(question):
+    """
+    Maps an MCQ's correctAnswer onto one of its options.
+
+    Handles the forms models drift into: the option text with a label or
+    trailing punctuation ("B) Velocity", "Velocity."), and bare letters
+    ("B", "(b)", "Option B").
+
+    Returns:
+        The matching option's exact text, or None if it matches no option
+    """
+    options = [str(option) for option in question.get("options") or []]
+    correct = str(question.get("correctAnswer") or "").strip()
+    keys = [option_key(option) for option in options]
+    if option_key(correct) and option_key(correct) in keys:
+        return options[keys.index(option_key(correct))]
+    match = re.match(r"^(?:option\s+)?\(?([a-d])(?:[).:]?$|[).:]\s)", correct, re.IGNORECASE)
+    if match:
+        index = ord(match.group(1).lower()) - ord("a")
+        if index < len(options):
+            return options[index]
+    return None
+
+def correct_option(question):
+    """The correct option's text, falling back to the raw correctAnswer for unresolvable questions"""
+    return resolve_correct_option(question) or str(question.get("correctAnswer") or "").strip()
+
+def repair_mcqs(mcqs):
+    """Rewrites each MCQ's correctAnswer to its exact option text and drops MCQs whose answer matches no option"""
+    repaired = []
+    for mcq in mcqs:
+        if not isinstance(mcq, dict) or not isinstance(mcq.get("options"), list):
+            continue
+        correct = resolve_correct_option(mcq)
+        if correct is None:
+            print(f"Dropping MCQ whose answer matches no option: {mcq.get('question', '')[:80]}")
+            continue
+        repaired.append(dict(mcq, correctAnswer=correct))
+    return repaired
+
+def mcq_is_correct(question, answer):
+    """Checks an MCQ answer against the question's correct option"""
+    correct = option_key(correct_option(question))
+    return bool(correct) and option_key(answer) == correct
+
+def evaluate_free_text(items, submission_summaries):
+    """
+    Evaluates SAQ/LAQ answers from one or more submissions in a single Gemini call.
+
+    Args:
+        items: Dicts with "id", "submission", "question", "idealAnswer" and "answer"
+        submission_summaries: Dicts with "submission", "mcqCorrect" and "mcqTotal"
+
+    Returns:
+        A (results, overall) tuple: per-item {"credit", "feedback"} keyed by item id,
+        and an overall feedback paragraph keyed by submission id
+
+    Raises:
+        ValueError: If the response cannot be parsed
+    """
+    prompt = f"""
+    Evaluate students' answers to short and long answer questions from a quiz.
+    Each item has an id, the submission it belongs to, the question, an ideal answer and the student's answer.
+
+    Items:
+    {json.dumps(items, separators=(",", ":"))}
+
+    Multiple choice results per submission (already graded):
+    {json.dumps(submission_summaries, separators=(",", ":"))}
+
+    Return ONLY a single valid JSON object (no markdown, no backticks) with:
+    - "results": array with one entry per item: {{"id", "credit", "feedback"}}
+      where "credit" is a number from 0 to 1 (partial credit allowed) and "feedback" says what is
+      correct or missing and why
+    - "overallFeedback": array with one entry per submission: {{"submission", "feedback"}} where
+      "feedback" is an encouraging paragraph covering all of that student's answers
+
+    Be encouraging but honest. If an answer is partially correct, acknowledge what they got right.
+
+    JSON Response:
+    """
+    evaluation = generate_structured(model, prompt, SCORING_SCHEMA, namespace="score-quiz")
+
+    results = {}
+    for result in evaluation["results"]:
+        if isinstance(result, dict) and "id" in result:
+            try:
+                credit = min(max(float(result.get("credit", 0)), 0.0), 1.0)
+            except (TypeError, ValueError):
+                credit = 0.0
+            results[str(result["id"])] = {"credit": credit, "feedback": str(result.get("feedback", ""))}
+    overall = {str(entry["submission"]): entry["feedback"] for entry in evaluation["overallFeedback"]}
+    return results, overall
+
+def score_submissions(quiz_questions, answer_sets):
+    """
+    Scores one or more students' answers to the same quiz.
+
+    MCQs are graded locally; SAQ/LAQ answers from all submissions are packed into
+    as few Gemini calls as possible, run with bounded concurrency. A batch that
+    fails leaves its answers marked as not evaluated rather than failing the rest;
+    those answers are left out of the score and the result has "evaluated": False.
+
+    Returns:
+        One {"score", "overallFeedback", "questionFeedback", "evaluated"} result per answer set, in order
+
+    Raises:
+        ValueError: If no batch's evaluation could be parsed
+        UpstreamUnavailable: If Gemini was unavailable for every batch
+    """
+    questions = flatten_quiz(quiz_questions)
+    feedback = [[None] * len(questions) for _ in answer_sets]
+    credits = [[0.0] * len(questions) for _ in answer_sets]
+    summaries = []
+    batches = [[]]
+
+    for s_index, user_answers in enumerate(answer_sets):
+        submission_id = f"s{s_index}"
+        mcq_correct = mcq_total = 0
+        submission_items = []
+        for q_index, (qtype, question) in enumerate(questions):
+            answer = user_answers.get(f"q{q_index + 1}", "")
+            if qtype == "mcq":
+                mcq_total += 1
+                if mcq_is_correct(question, answer):
+                    mcq_correct += 1
+                    credits[s_index][q_index] = 1.0
+                    feedback[s_index][q_index] = {"feedback": "Correct! Well done.", "correct": True}
+                else:
+                    feedback[s_index][q_index] = {
+                        "feedback": f"Not quite. The correct answer is: {correct_option(question)}",
+                        "correct": False
+                    }
+            else:
+                submission_items.append({
+                    "id": f"{submission_id}:q{q_index + 1}",
+                    "submission": submission_id,
+                    "question": question.get("question", ""),
+                    "idealAnswer": question.get("idealAnswer", ""),
+                    "answer": sanitize_text(answer, max_length=5000)
+                })
+        summaries.append({"submission": submission_id, "mcqCorrect": mcq_correct, "mcqTotal": mcq_total})
+
+        # Keep a submission's items in one call so its overall feedback sees all of them
+        if batches[-1] and len(batches[-1]) + len(submission_items) > SCORING_BATCH_ITEMS:
+            batches.append([])
+        batches[-1].extend(submission_items)
+
+    results, overall = {}, {}
+    batches = [batch for batch in batches if batch]
+    if batches:
+        def run_batch(batch):
+            batch_submissions = {item["submission"] for item in batch}
+            try:
+                return evaluate_free_text(batch, [s for s in summaries if s["submission"] in batch_submissions])
+            except (ValueError, UpstreamUnavailable) as e:
+                # Its items fall back to "could not be evaluated"; the other batches still count
+                print(f"Scoring batch error: {e}")
+                return e
+
+        # Each batch runs in a copy of this request's context so its metrics are attributed to it
+        contexts = [contextvars.copy_context() for _ in batches]
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(SCORING_CONCURRENCY, len(batches))) as executor:
+            for outcome in executor.map(lambda context, batch: context.run(run_batch, batch), contexts, batches):
+                if isinstance(outcome, Exception):
+                    errors.append(outcome)
+                    continue
+                batch_results, batch_overall = outcome
+                results.update(batch_results)
+                overall.update(batch_overall)
+        if len(errors) == len(batches):
+            # Nothing was evaluated: let the caller report the failure (e.g. busy) instead
+            raise errors[0]
+
+    scored = []
+    for s_index in range(len(answer_sets)):
+        graded = len(questions)
+        for q_index, (qtype, _) in enumerate(questions):
+            if qtype == "mcq":
+                continue
+            result = results.get(f"s{s_index}:q{q_index + 1}")
+            if result is None:
+                graded -= 1
+                feedback[s_index][q_index] = {"feedback": "This answer could not be evaluated. Please try again.",
+                                              "correct": False, "evaluated": False}
+                continue
+            credits[s_index][q_index] = result["credit"]
+            feedback[s_index][q_index] = {"feedback": result["feedback"], "correct": result["credit"] >= 0.5}
+
+        # Only answers that were actually graded count towards the score
+        percent = round(100 * sum(credits[s_index]) / graded) if graded else 0
+        summary = summaries[s_index]
+        overall_feedback = overall.get(f"s{s_index}")
+        if not overall_feedback:
+            overall_feedback = (f"You answered {summary['mcqCorrect']} of {summary['mcqTotal']} "
+                                f"multiple choice questions correctly. Keep practicing!")
+        scored.append({
+            "score": f"{percent}%",
+            "scorePercent": percent,
+            "overallFeedback": overall_feedback,
+            "questionFeedback": feedback[s_index],
+            "evaluated": graded == len(questions)
+        })
+    return scored
+
+
 @app.route('/api/score-quiz', methods=['POST'])
 def score_quiz():
-    """Score quiz submission using AI evaluation"""
+    """Score quiz submission: MCQs locally, written answers with AI evaluation"""
     data = request.get_json()
     pdf_id_str = data.get('pdfId')
     quiz_questions = data.get('quizQuestions')
@@ -435,69 +3527,103 @@ def score_quiz():
     # FIXED: Validate inputs
     if not quiz_questions or not user_answers:
         return jsonify({"error": "Quiz questions and user answers are required."}), 400
+    if not isinstance(quiz_questions, dict) or not isinstance(user_answers, dict):
+        return jsonify({"error": "Invalid quiz submission format."}), 400
 
-    prompt = f"""
-    Evaluate a student's quiz submission.
-    
-    Quiz Questions & Ideal Answers:
-    ---
-    {json.dumps(quiz_questions, indent=2)}
-    ---
-    
-    Student's Answers:
-    ---
-    {json.dumps(user_answers, indent=2)}
-    ---
-    
-    Return ONLY a single valid JSON object (no markdown, no backticks) with:
-    - "score": overall percentage (e.g., "85%")
-    - "overallFeedback": encouraging feedback paragraph
-    - "questionFeedback": array with feedback for each question in order
-    
-    For each question feedback, provide:
-    - "feedback": specific feedback on their answer (mention if correct/incorrect and why)
-    
-    Be encouraging but honest. If an answer is partially correct, acknowledge what they got right.
-    
-    JSON Response:
-    """
-    
     try:
-        response = generate_with_retry(model, prompt)
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-        
-        try:
-            scoring_result = json.loads(cleaned_response)
-        except json.JSONDecodeError:
-            print(f"Failed to parse scoring result: {cleaned_response[:500]}")
-            return jsonify({"error": "Failed to parse scoring results. Please try again."}), 500
-
-        # FIXED: Validate scoring structure
-        if not isinstance(scoring_result.get('questionFeedback'), list):
-            scoring_result['questionFeedback'] = []
-        if 'score' not in scoring_result:
-            scoring_result['score'] = "0%"
-        if 'overallFeedback' not in scoring_result:
-            scoring_result['overallFeedback'] = "Keep practicing!"
+        scoring_result = score_submissions(quiz_questions, [user_answers])[0]
 
         # Save to database
         pdf_id_obj = validate_object_id(pdf_id_str) if pdf_id_str else None
         
-        quiz_attempts_collection.insert_one({
-            "pdfId": pdf_id_obj,
-            "answers": user_answers,
-            "score": scoring_result.get("score"),
-            "feedback": scoring_result.get("overallFeedback"),
-            "timestamp": datetime.datetime.utcnow()
-        })
+        with stage("db_write"):
+            quiz_attempts_collection.insert_one({
+                "pdfId": pdf_id_obj,
+                "answers": user_answers,
+                "score": scoring_result.get("score"),
+                "score_percent": scoring_result.get("scorePercent"),
+                "feedback": scoring_result.get("overallFeedback"),
+                "evaluated": scoring_result.get("evaluated"),
+                "timestamp": datetime.datetime.utcnow()
+            })
 
         return jsonify(scoring_result), 200
         
+    except ValueError:
+        return jsonify({"error": "Failed to parse scoring results. Please try again."}), 500
+    except UpstreamUnavailable as e:
+        return busy_response(e)
     except Exception as e:
         print(f"Score quiz error: {e}")
         return jsonify({"error": f"Failed to score quiz: {str(e)}"}), 500
 
 
+@app.route('/api/score-quiz/batch', methods=['POST'])
+def score_quiz_batch():
+    """Score a whole class's submissions for the same quiz in one request"""
+    data = request.get_json()
+    pdf_id_str = data.get('pdfId')
+    quiz_questions = data.get('quizQuestions')
+    submissions = data.get('submissions')
+
+    if not quiz_questions or not submissions:
+        return jsonify({"error": "Quiz questions and submissions are required."}), 400
+    if not isinstance(quiz_questions, dict) or not isinstance(submissions, list):
+        return jsonify({"error": "Invalid quiz submission format."}), 400
+    if len(submissions) > 100:
+        return jsonify({"error": "Maximum 100 submissions per batch."}), 400
+    if not all(isinstance(sub, dict) and isinstance(sub.get('userAnswers'), dict) for sub in submissions):
+        return jsonify({"error": "Each submission needs a userAnswers object."}), 400
+
+    try:
+        scoring_results = score_submissions(quiz_questions, [sub['userAnswers'] for sub in submissions])
+
+        pdf_id_obj = validate_object_id(pdf_id_str) if pdf_id_str else None
+        timestamp = datetime.datetime.utcnow()
+        results = []
+        attempts = []
+        for submission, scoring_result in zip(submissions, scoring_results):
+            student_id = sanitize_text(str(submission.get('studentId', '')), max_length=100) or None
+            results.append(dict(scoring_result, studentId=student_id))
+            attempts.append({
+                "pdfId": pdf_id_obj,
+                "studentId": student_id,
+                "answers": submission['userAnswers'],
+                "score": scoring_result.get("score"),
+                "score_percent": scoring_result.get("scorePercent"),
+                "feedback": scoring_result.get("overallFeedback"),
+                "evaluated": scoring_result.get("evaluated"),
+                "timestamp": timestamp
+            })
+        with stage("db_write"):
+            quiz_attempts_collection.insert_many(attempts)
+
+        return jsonify({"results": results}), 200
+
+    except ValueError:
+        return jsonify({"error": "Failed to parse scoring results. Please try again."}), 500
+    except UpstreamUnavailable as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"Batch score quiz error: {e}")
+        return jsonify({"error": f"Failed to score quizzes: {str(e)}"}), 500
+
+
+# Numeric score of an attempt; attempts stored before score_percent existed only have "85%" strings
+ATTEMPT_SCORE_EXPR = {"$ifNull": ["$score_percent", {"$convert": {
+    "input": {"$trim": {"input": {"$toString": "$score"}, "chars": "% "}},
+    "to": "double", "onError": 0, "onNull": 0
+}}]}
+
+def progress_filter():
+    """Builds the quiz_attempts filter from the optional pdfId query parameter; None if it is invalid"""
+    pdf_id = request.args.get('pdfId')
+    if not pdf_id:
+        return {}
+    pdf_id_obj = validate_object_id(pdf_id)
+    return {"pdfId": pdf_id_obj} if pdf_id_obj else None
+
+
 @app.route('/api/progress', methods=['GET'])
 def get_progress():
     """Get user's quiz attempt history and progress"""
@@ -505,29 +3631,168 @@ def get_progress():
         # FIXED: Add pagination and limit
         limit = request.args.get('limit', 50, type=int)
         limit = min(limit, 100)  # Max 100 attempts
+
+        query = progress_filter()
+        if query is None:
+            return jsonify({"error": "Invalid PDF ID."}), 400
+
+        # Stored answers can be large; only ship them when asked for
+        projection = None if request.args.get('include_answers') == 'true' else {"answers": 0}
         
-        attempts = list(quiz_attempts_collection.find({})
-                       .sort("timestamp", -1)
-                       .limit(limit))
-        
-        return jsonify({"attempts": [serialize_doc(attempt) for attempt in attempts]}), 200
+        with stage("db_fetch"):
+            attempts = quiz_attempts_collection.find(query, projection).sort("timestamp", -1).limit(limit)
+            return json_list_response("attempts", attempts)
         
     except Exception as e:
         print(f"Get progress error: {e}")
         return jsonify({"error": f"Failed to retrieve progress: {str(e)}"}), 500
 
 
+@app.route('/api/progress/summary', methods=['GET'])
+def get_progress_summary():
+    """Dashboard statistics computed in one aggregation: totals, per-PDF stats and daily trend"""
+    try:
+        query = progress_filter()
+        if query is None:
+            return jsonify({"error": "Invalid PDF ID."}), 400
+        days = min(request.args.get('days', 30, type=int), 365)
+
+        pipeline = [
+            # Partly graded attempts (a scoring batch failed) would drag averages down; older attempts lack the flag
+            {"$match": dict(query, evaluated={"$ne": False})},
+            {"$project": {"pdfId": 1, "timestamp": 1, "score_value": ATTEMPT_SCORE_EXPR}},
+            {"$facet": {
+                "overall": [
+                    {"$group": {"_id": None, "attempts": {"$sum": 1},
+                                "average": {"$avg": "$score_value"}, "best": {"$max": "$score_value"}}}
+                ],
+                "recent": [
+                    {"$sort": {"timestamp": -1}},
+                    {"$limit": 6},
+                    {"$project": {"_id": 0, "score_value": 1}}
+                ],
+                "by_pdf": [
+                    {"$group": {"_id": "$pdfId", "attempts": {"$sum": 1},
+                                "average": {"$avg": "$score_value"}, "best": {"$max": "$score_value"},
+                                "last_attempt": {"$max": "$timestamp"}}},
+                    {"$sort": {"last_attempt": -1}},
+                    {"$limit": 50},
+                    {"$lookup": {"from": "pdfs", "localField": "_id", "foreignField": "_id",
+                                 "pipeline": [{"$project": {"filename": 1}}], "as": "pdf"}}
+                ],
+                "trend": [
+                    {"$match": {"timestamp": {"$gte": datetime.datetime.utcnow() - datetime.timedelta(days=days)}}},
+                    {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}},
+                                "attempts": {"$sum": 1}, "average": {"$avg": "$score_value"}}},
+                    {"$sort": {"_id": 1}}
+                ]
+            }}
+        ]
+        with stage("db_fetch"):
+            result = next(quiz_attempts_collection.aggregate(pipeline))
+
+        overall = result["overall"][0] if result["overall"] else {"attempts": 0, "average": 0, "best": 0}
+        # Same trend definition the dashboard used: last 3 attempts vs the 3 before them
+        recent_scores = [attempt["score_value"] for attempt in result["recent"]]
+        trend = 0.0
+        if len(recent_scores) >= 4:
+            previous = recent_scores[3:6]
+            trend = sum(recent_scores[:3]) / 3 - sum(previous) / len(previous)
+
+        return jsonify({
+            "attempts": overall["attempts"],
+            "average": round(overall["average"] or 0, 1),
+            "best": round(overall["best"] or 0, 1),
+            "trend": round(trend, 1),
+            "by_pdf": [{
+                "pdfId": str(entry["_id"]) if entry["_id"] else None,
+                "filename": entry["pdf"][0]["filename"] if entry["pdf"] else None,
+                "attempts": entry["attempts"],
+                "average": round(entry["average"] or 0, 1),
+                "best": round(entry["best"] or 0, 1),
+                "last_attempt": entry["last_attempt"].isoformat() if entry["last_attempt"] else None
+            } for entry in result["by_pdf"]],
+            "trend_by_day": [{
+                "date": entry["_id"],
+                "attempts": entry["attempts"],
+                "average": round(entry["average"] or 0, 1)
+            } for entry in result["trend"]]
+        }), 200
+
+    except Exception as e:
+        print(f"Get progress summary error: {e}")
+        return jsonify({"error": f"Failed to retrieve progress summary: {str(e)}"}), 500
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Report response cache hit/miss counters per endpoint"""
+    return jsonify(response_cache.stats()), 200
+
+
+@app.route('/api/structured-output/stats', methods=['GET'])
+def get_structured_output_stats():
+    """Report how often JSON responses parsed cleanly or needed repair, per endpoint"""
+    with _structured_stats_lock:
+        stats = {name: dict(counters) for name, counters in structured_output_stats.items()}
+    for counters in stats.values():
+        total = sum(counters.values())
+        counters["repair_rate"] = round((counters["local_repair"] + counters["model_repair"]) / total, 3) if total else 0.0
+        counters["failure_rate"] = round(counters["failed"] / total, 3) if total else 0.0
+    return jsonify(stats), 200
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Export request, stage, LLM and cache metrics in Prometheus text format"""
+    extra = []
+    for namespace, counters in response_cache.stats()["namespaces"].items():
+        for result in ("hits", "mongo_hits", "misses", "stores"):
+            extra.append(("llm_cache_events_total", {"namespace": namespace, "result": result}, counters[result]))
+    with _structured_stats_lock:
+        for namespace, counters in structured_output_stats.items():
+            for outcome, value in counters.items():
+                extra.append(("structured_output_total", {"namespace": namespace, "outcome": outcome}, value))
+    # Hedging effectiveness: how often the duplicate won, and how many calls it added
+    gauges = []
+    calls = {}
+    for labels, value in metrics.counter_values("llm_calls_total").items():
+        endpoint = dict(labels)["endpoint"]
+        calls[endpoint] = calls.get(endpoint, 0) + value
+    wins = {}
+    for labels, value in metrics.counter_values("llm_hedge_wins_total").items():
+        labels = dict(labels)
+        if labels["winner"] == "hedge":
+            wins[labels["endpoint"]] = wins.get(labels["endpoint"], 0) + value
+    for labels, hedges in metrics.counter_values("llm_hedges_total").items():
+        endpoint = dict(labels)["endpoint"]
+        gauges.append(("llm_hedge_win_ratio", {"endpoint": endpoint}, round(wins.get(endpoint, 0) / hedges, 4)))
+        if calls.get(endpoint):
+            gauges.append(("llm_hedge_extra_call_ratio", {"endpoint": endpoint}, round(hedges / calls[endpoint], 4)))
+    return Response(metrics.render(extra, gauges), mimetype="text/plain; version=0.0.4")
+
+
 # FIXED: Add health check endpoint
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint for monitoring"""
     try:
         # Test database connection
-        client.admin.command('ping')
+        started = time.perf_counter()
+        get_mongo_client().admin.command('ping')
+        ping_ms = (time.perf_counter() - started) * 1000
         return jsonify({
             "status": "healthy",
             "database": "connected",
-            "timestamp": datetime.datetime.utcnow().isoformat()
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            # Percentiles over this worker's recent samples; None until there are some
+            "latency_ms": {
+                "db_ping": round(ping_ms, 1),
+                "db_fetch": metrics.percentiles("stage_duration_seconds", stage="db_fetch"),
+                "db_write": metrics.percentiles("stage_duration_seconds", stage="db_write"),
+                "llm_call": metrics.percentiles("llm_call_seconds", outcome="ok")
+            },
+            "gemini": {label: guard.status() for label, guard in list(gemini_guards.items())}
         }), 200
     except Exception as e:
         return jsonify({
@@ -0,0 +1 @@
+"""Offline benchmarks for the BeyondQuiz backend. Run from the repository root, e.g. `python -m benchmarks.serving_modes`."""
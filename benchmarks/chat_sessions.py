@@ -0,0 +1,83 @@
+"""
+Shows that per-turn chat prompt size stays flat over a long conversation.
+
+Runs --turns questions through /api/chat in one server-side session, once with
+retrieval (CHAT_CONTEXT_CACHE=off) and once with the document held in cached
+context (the app's local stand-in for Gemini context caching). For each turn it
+records the tokens sent that are not covered by the cached context, and counts
+the fast-tier calls spent on rolling summaries.
+
+    python -m benchmarks.chat_sessions --turns 30
+"""
+import argparse
+import json
+import statistics
+
+from benchmarks.fakes import FakeModel, install_fakes, seed_pdf
+
+import app as app_module
+
+
+class RecordingModel(FakeModel):
+    """A fake model that records uncached prompt tokens per call"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.answer_tokens = []
+        self.summary_calls = 0
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        if "running summary" in prompt:
+            self.summary_calls += 1
+        else:
+            for _, context_model in app_module._context_models.values():
+                if context_model is not None and prompt.startswith(context_model.context):
+                    prompt = prompt[len(context_model.context):]
+            self.answer_tokens.append(app_module.estimate_tokens(prompt))
+        return super().generate_content(prompt, stream=stream, **kwargs)
+
+
+def run(mode, turns):
+    model = RecordingModel(latency=0, chunk_delay=0)
+    install_fakes(app_module, model)
+    app_module.CHAT_CONTEXT_CACHE = mode
+    pdf_id = seed_pdf(app_module)
+    client = app_module.app.test_client()
+
+    session_id = None
+    for turn in range(turns):
+        payload = {"message": f"Question {turn}: how does momentum relate to force in part {turn}?", "pdfId": pdf_id}
+        if session_id:
+            payload["sessionId"] = session_id
+        response = client.post("/api/chat", json=payload)
+        assert response.status_code == 200, response.get_json()
+        session_id = response.get_json()["sessionId"]
+
+    tokens = model.answer_tokens
+    return {
+        "context": mode,
+        "turns": turns,
+        "first_turn_tokens": tokens[0],
+        "median_tokens": statistics.median(tokens),
+        "max_tokens": max(tokens),
+        "last_turn_tokens": tokens[-1],
+        "summary_calls": model.summary_calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--turns", type=int, default=30)
+    args = parser.parse_args()
+
+    results = []
+    for mode in ("off", "local"):
+        result = run(mode, args.turns)
+        results.append(result)
+        print(f"context {mode:>5}: turn 1 {result['first_turn_tokens']:>5} tokens, "
+              f"max {result['max_tokens']:>5}, turn {args.turns} {result['last_turn_tokens']:>5} "
+              f"({result['summary_calls']} summary calls)")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Shows that a burst of identical requests costs one Gemini call.
+
+Fires --clients simultaneous "Recommend videos" requests for the same PDF, the
+way a class does right after a teacher shares it, with the response cache
+cleared so every request misses it. With coalescing, one request generates
+and the rest wait for its result; the fake model's call count shows the
+upstream load.
+
+    python -m benchmarks.coalescing --clients 50 --latency 1.0
+"""
+import argparse
+import json
+import threading
+import time
+
+from benchmarks.fakes import FakeModel, install_fakes, seed_pdf
+
+import app as app_module
+
+
+def burst(client, pdf_id, clients):
+    barrier = threading.Barrier(clients)
+    statuses = []
+
+    def one_request():
+        barrier.wait()
+        statuses.append(client.post("/api/recommend-videos", json={"pdfId": pdf_id}).status_code)
+
+    threads = [threading.Thread(target=one_request) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=1.0, help="fake Gemini latency in seconds")
+    args = parser.parse_args()
+
+    model = FakeModel(latency=args.latency)
+    install_fakes(app_module, model)
+    pdf_id = seed_pdf(app_module)
+    client = app_module.app.test_client()
+
+    statuses, seconds = burst(client, pdf_id, args.clients)
+    result = {
+        "clients": args.clients,
+        "ok": statuses.count(200),
+        "gemini_calls": model.calls,
+        "seconds": round(seconds, 2),
+    }
+    print(f"{result['clients']} identical requests -> {result['gemini_calls']} Gemini call(s) "
+          f"in {result['seconds']}s ({result['ok']} succeeded)")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
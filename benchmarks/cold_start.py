@@ -0,0 +1,101 @@
+"""
+Measures cold-start cost: how long `import app` takes and how long the first request after it takes.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter, sums the
+self time per top-level package and prints the slowest ones, then times the
+first `/` request from another fresh interpreter. Gemini, pymongo, PyPDF2 and
+numpy should not appear: they are only imported when a route needs them.
+Pass --max-ms to fail (exit code 1) when the import regresses past a budget.
+
+    python -m benchmarks.cold_start --runs 5 --max-ms 400
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+FIRST_REQUEST_SNIPPET = """
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get("/")
+finished = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print((imported - started) * 1000, (finished - imported) * 1000)
+"""
+
+# Imported on first use only; seeing one at startup means laziness regressed
+DEFERRED_PACKAGES = ("google", "pymongo", "PyPDF2", "numpy")
+
+
+def fresh_env():
+    env = dict(os.environ)
+    env.setdefault("MONGO_URI", "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100")
+    env.setdefault("GEMINI_API_KEY", "benchmark")
+    # The per-request log line would end up in the timings printed on stdout
+    env.setdefault("LOG_REQUESTS", "0")
+    return env
+
+
+def import_profile():
+    """Returns (total import ms, {top-level package: self ms}) for one cold `import app`"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            capture_output=True, text=True, env=fresh_env(), check=True)
+    packages = defaultdict(float)
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        packages[name.strip().split(".")[0]] += int(self_us) / 1000
+        if name == "app":
+            total_us = int(cumulative_us)
+    return total_us / 1000, packages
+
+
+def first_request():
+    """Returns (import ms, first request ms) measured inside a fresh interpreter"""
+    result = subprocess.run([sys.executable, "-c", FIRST_REQUEST_SNIPPET],
+                            capture_output=True, text=True, env=fresh_env(), check=True)
+    imported_ms, request_ms = result.stdout.split()
+    return float(imported_ms), float(request_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest packages to list")
+    parser.add_argument("--max-ms", type=float, help="fail when the median import time exceeds this")
+    args = parser.parse_args()
+
+    import_times, packages = [], defaultdict(list)
+    for _ in range(args.runs):
+        total_ms, per_package = import_profile()
+        import_times.append(total_ms)
+        for name, ms in per_package.items():
+            packages[name].append(ms)
+    request_times = [first_request()[1] for _ in range(args.runs)]
+
+    slowest = sorted(((statistics.median(times), name) for name, times in packages.items()), reverse=True)
+    print("slowest packages at import (median self time):")
+    for ms, name in slowest[:args.top]:
+        print(f"  {name:<24} {ms:8.1f} ms")
+
+    result = {
+        "import_ms": round(statistics.median(import_times), 1),
+        "first_request_ms": round(statistics.median(request_times), 1),
+        "deferred_packages_loaded": [name for name in DEFERRED_PACKAGES if name in packages],
+    }
+    print(json.dumps(result, indent=2))
+
+    if args.max_ms is not None and result["import_ms"] > args.max_ms:
+        print(f"import time {result['import_ms']} ms exceeds budget of {args.max_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Deterministic stand-ins for Gemini and MongoDB so benchmarks never touch real quota.
+
+Import this module before `app`: it points MONGO_URI at an unreachable server
+with a short timeout (so nothing waits on a real database if a fake is missed)
+and turns off the MongoDB cache tier, cross-worker coalescing and background
+ingestion. Document context caching uses the app's local stand-in.
+"""
+import os
+import json
+import random
+import threading
+import time
+from collections import deque
+
+os.environ.setdefault("MONGO_URI", "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100")
+os.environ.setdefault("RESPONSE_CACHE_MONGO", "0")
+os.environ.setdefault("SINGLE_FLIGHT_MONGO", "0")
+os.environ.setdefault("ASYNC_INGESTION", "0")
+os.environ.setdefault("CHAT_CONTEXT_CACHE", "local")
+
+# Collections the app keeps as module globals, by attribute name
+APP_COLLECTIONS = {
+    "pdfs_collection": "pdfs",
+    "quiz_attempts_collection": "quiz_attempts",
+    "pdf_pages_collection": "pdf_pages",
+    "pdf_chunks_collection": "pdf_chunks",
+    "quiz_questions_collection": "quiz_questions",
+    "upload_jobs_collection": "upload_jobs",
+    "chat_sessions_collection": "chat_sessions",
+    "search_postings_collection": "search_postings",
+}
+
+WORDS = ("force motion energy velocity mass acceleration momentum friction gravity work power "
+         "displacement vector scalar inertia torque equilibrium pressure density wave").split()
+
+
+class FakeUsage:
+    """Mimics Gemini usage metadata, estimating four characters per token"""
+    def __init__(self, prompt, text):
+        self.prompt_token_count = len(prompt) // 4
+        self.candidates_token_count = len(text) // 4
+
+
+class FakeResponse:
+    """Mimics the parts of a Gemini response the app reads"""
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeModel:
+    """
+    Mimics genai.GenerativeModel.generate_content with configurable behaviour.
+
+    Args:
+        latency: Seconds to wait before answering (time to first chunk when streaming)
+        failure_rate: Probability that a call raises before producing anything
+        chunk_delay: Seconds between streamed chunks
+        seed: Seed for the failure draws, so runs are repeatable
+        quota_per_second: Calls accepted per second; calls beyond it get a 429 with a retry hint
+    """
+    model_name = "models/fake-gemini"
+
+    def __init__(self, latency=0.5, failure_rate=0.0, chunk_delay=0.02, seed=0, quota_per_second=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.chunk_delay = chunk_delay
+        self.quota_per_second = quota_per_second
+        self.calls = 0
+        self.rejected = 0
+        self._accepted = deque()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+            if self.quota_per_second and not fail:
+                now = time.monotonic()
+                while self._accepted and now - self._accepted[0] >= 1.0:
+                    self._accepted.popleft()
+                if len(self._accepted) >= self.quota_per_second:
+                    self.rejected += 1
+                    retry_in = 1.0 - (now - self._accepted[0])
+                    raise RuntimeError(f"429 Resource has been exhausted (fake quota). Please retry in {retry_in:.2f}s.")
+                self._accepted.append(now)
+        time.sleep(self.latency)
+        if fail:
+            raise RuntimeError("429 Resource has been exhausted (fake)")
+
+        text = respond_to(prompt)
+        if not stream:
+            return FakeResponse(text, FakeUsage(prompt, text))
+        return self._stream(prompt, text)
+
+    def _stream(self, prompt, text):
+        words = text.split(" ")
+        for start in range(0, len(words), 8):
+            # Like Gemini, only the final chunk carries the usage totals
+            last = start + 8 >= len(words)
+            yield FakeResponse(" ".join(words[start:start + 8]) + " ", FakeUsage(prompt, text) if last else None)
+            time.sleep(self.chunk_delay)
+
+
+def respond_to(prompt):
+    """Builds a well-formed answer for whichever app prompt this is"""
+    if '"mcqs"' in prompt:
+        return json.dumps({
+            "mcqs": [{"question": f"Which quantity is a vector? ({i})",
+                      "options": ["Mass", "Velocity", "Energy", "Power"],
+                      "correctAnswer": "Velocity"} for i in range(2)],
+            "saqs": [{"question": f"Define momentum. ({i})", "idealAnswer": "Mass times velocity."} for i in range(2)],
+            "laqs": [{"question": "Explain Newton's laws of motion.", "idealAnswer": "Inertia, F = ma, action-reaction."}]
+        })
+    if '"recommendations"' in prompt:
+        return json.dumps({"recommendations": [
+            {"title": f"Physics topic {i}", "url": f"https://www.youtube.com/results?search_query=physics+topic+{i}"}
+            for i in range(5)
+        ]})
+    if '"results"' in prompt and "Items:" in prompt:
+        items = json.loads(prompt.split("Items:", 1)[1].split("Multiple choice results", 1)[0].strip())
+        return json.dumps({
+            "results": [{"id": item["id"], "credit": 0.5, "feedback": "Partially correct."} for item in items],
+            "overallFeedback": [{"submission": submission, "feedback": "Good effort, keep going!"}
+                                for submission in sorted({item["submission"] for item in items})]
+        })
+    return "Momentum is the product of mass and velocity, as explained on page 3 of your book. " * 4
+
+
+def install_fakes(app_module, model=None):
+    """
+    Points the app at an in-memory mongomock database and a fake model.
+
+    Returns:
+        The mongomock database, for seeding
+    """
+    import mongomock
+
+    client = mongomock.MongoClient()
+    db = client.school_reviser_db
+    for attribute, name in APP_COLLECTIONS.items():
+        setattr(app_module, attribute, db[name])
+    # Fill the lazy singletons too, so get_mongo_client()/get_model() never build real clients
+    app_module._mongo_client = client
+    app_module.model = app_module.fast_model = model or FakeModel()
+    app_module._gemini_models.update({app_module.GEMINI_MODEL_NAME: app_module.model,
+                                      app_module.GEMINI_FAST_MODEL_NAME: app_module.model})
+    app_module.response_cache = app_module.ResponseCache()
+    app_module._context_models.clear()
+    return db
+
+
+def fake_page_texts(pages=20, words_per_page=350, seed=0):
+    """Generates page texts drawn from a small physics vocabulary"""
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(words_per_page)) for _ in range(pages)]
+
+
+def seed_pdf(app_module, pages=20, filename="benchmark.pdf", seed=0):
+    """Stores a synthetic PDF through the app's own ingestion path and returns its id string"""
+    page_texts = fake_page_texts(pages, seed=seed)
+    content_hash = f"benchmark-{filename}-{pages}-{seed}"
+    return str(app_module.store_pdf(filename, page_texts, content_hash))
@@ -0,0 +1,100 @@
+"""
+Shows how the Gemini rate limiter and circuit breaker behave under overload.
+
+Two scenarios against the fake model, each run with the limiter/breaker on and off:
+
+  quota   --clients threads call generate_with_retry against a fake model that
+          only accepts --quota calls per second and answers the rest with 429s.
+          Without the limiter every client retries on its own schedule and most
+          calls are wasted on 429s; with it, calls queue for a token instead.
+  outage  every call fails with a 503. The breaker opens after a few failures,
+          so the remaining requests fail fast instead of each sitting through
+          its retries.
+
+    python -m benchmarks.gemini_overload --clients 16 --calls 64 --quota 5
+"""
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import FakeModel, install_fakes
+
+import app as app_module
+
+
+class OutageModel(FakeModel):
+    """A fake model whose upstream is down"""
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        raise RuntimeError("503 The service is currently unavailable (fake)")
+
+
+def configure(model, protected, rate_per_minute):
+    if protected:
+        guard = app_module.GeminiGuard(rate_per_minute, burst=2, max_waiters=1000, failure_threshold=5, cooldown=30)
+    else:
+        guard = app_module.GeminiGuard(0, failure_threshold=10 ** 9, cooldown=0)
+    app_module.gemini_guards[app_module.model_label(model)] = guard
+
+
+def run(model, args):
+    def one_call(i):
+        started = time.perf_counter()
+        try:
+            app_module.generate_with_retry(model, f"Explain topic {i}", retries=args.retries, delay=args.delay)
+            ok = True
+        except Exception:
+            ok = False
+        return ok, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        outcomes = list(executor.map(one_call, range(args.calls)))
+    latencies = sorted(seconds for _, seconds in outcomes)
+    return {
+        "succeeded": sum(1 for ok, _ in outcomes if ok),
+        "failed": sum(1 for ok, _ in outcomes if not ok),
+        "upstream_calls": model.calls,
+        "upstream_429s": getattr(model, "rejected", 0),
+        "seconds": round(time.perf_counter() - started, 2),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--calls", type=int, default=64)
+    parser.add_argument("--quota", type=float, default=5, help="fake upstream calls accepted per second")
+    parser.add_argument("--latency", type=float, default=0.1, help="fake Gemini latency in seconds")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--delay", type=float, default=0.5, help="base backoff delay in seconds")
+    args = parser.parse_args()
+
+    install_fakes(app_module)
+    app_module.GEMINI_DEADLINE = 120
+
+    results = []
+    for scenario in ("quota", "outage"):
+        for protected in (False, True):
+            if scenario == "quota":
+                model = FakeModel(latency=args.latency, quota_per_second=args.quota)
+            else:
+                model = OutageModel(latency=args.latency)
+            configure(model, protected, rate_per_minute=args.quota * 60)
+            result = dict(scenario=scenario, limiter_and_breaker=protected, **run(model, args))
+            results.append(result)
+            print(f"{scenario:>6} {'protected' if protected else 'unprotected':>11}: "
+                  f"{result['succeeded']:>3} ok, {result['failed']:>3} failed, "
+                  f"{result['upstream_calls']:>4} upstream calls ({result['upstream_429s']} 429s), "
+                  f"p95 {result['p95_ms']} ms")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
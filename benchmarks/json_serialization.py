@@ -0,0 +1,136 @@
+"""
+Measures the cost of turning a 100-item page of MongoDB documents into a JSON response body.
+
+Compares the old path (rebuild every document with the recursive serialize_doc,
+then jsonify with Flask's default provider) against the app's JSON provider,
+which encodes ObjectId and datetime itself, with and without orjson, and
+against the streamed list response the list endpoints now use. Pages look
+like /api/pdfs and /api/progress (with answers) results.
+
+    python -m benchmarks.json_serialization --items 100 --repeats 200
+"""
+import argparse
+import datetime
+import json
+import statistics
+import time
+
+from benchmarks.fakes import install_fakes
+
+import app as app_module
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+
+def serialize_doc(doc):
+    """The recursive converter list endpoints used before the JSON provider (kept here as the baseline)"""
+    if isinstance(doc, list):
+        return [serialize_doc(item) for item in doc]
+    if isinstance(doc, dict):
+        serialized = {}
+        for key, value in doc.items():
+            if isinstance(value, ObjectId):
+                serialized[key] = str(value)
+            elif isinstance(value, datetime.datetime):
+                serialized[key] = value.isoformat()
+            elif isinstance(value, (dict, list)):
+                serialized[key] = serialize_doc(value)
+            else:
+                serialized[key] = value
+        return serialized
+    if isinstance(doc, ObjectId):
+        return str(doc)
+    if isinstance(doc, datetime.datetime):
+        return doc.isoformat()
+    return doc
+
+
+def pdf_page(items):
+    start = datetime.datetime(2024, 1, 1)
+    return [{
+        "_id": ObjectId(),
+        "filename": f"chapter-{i}.pdf",
+        "content_hash": f"{i:064x}",
+        "page_count": 20,
+        "word_count": 7000,
+        "quiz_bank_status": "ready",
+        "uploaded_at": start + datetime.timedelta(seconds=i, microseconds=i * 1000)
+    } for i in range(items)]
+
+
+def attempt_page(items):
+    start = datetime.datetime(2024, 1, 1)
+    return [{
+        "_id": ObjectId(),
+        "pdfId": ObjectId(),
+        "answers": {f"q{q}": f"Momentum is mass times velocity ({i}, {q})" for q in range(1, 6)},
+        "score": "3/5",
+        "score_percent": 60.0,
+        "feedback": {
+            "overallFeedback": "Good effort, keep going!",
+            "results": [{"question": f"q{q}", "credit": 0.5, "feedback": "Partially correct."} for q in range(1, 6)]
+        },
+        "timestamp": start + datetime.timedelta(minutes=i)
+    } for i in range(items)]
+
+
+def median_ms(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    install_fakes(app_module)
+    flask_app = app_module.app
+    default_provider = DefaultJSONProvider(flask_app)
+    provider = app_module.MongoJSONProvider(flask_app)
+    orjson = app_module.orjson
+
+    results = []
+    with flask_app.test_request_context():
+        for name, docs in (("pdfs", pdf_page(args.items)), ("attempts", attempt_page(args.items))):
+            def before():
+                return default_provider.response({name: [serialize_doc(doc) for doc in docs]}).get_data()
+
+            def provider_stdlib():
+                app_module.orjson = None
+                try:
+                    return provider.response({name: docs}).get_data()
+                finally:
+                    app_module.orjson = orjson
+
+            def provider_orjson():
+                return provider.response({name: docs}).get_data()
+
+            def streamed():
+                return "".join(app_module.json_list_response(name, iter(docs)).response)
+
+            # Same JSON whichever way it was produced
+            expected = json.loads(before())
+            assert json.loads(provider_stdlib()) == expected and json.loads(streamed()) == expected
+
+            result = {"page": name, "items": args.items, "bytes": len(before()),
+                      "before_ms": median_ms(before, args.repeats),
+                      "provider_stdlib_ms": median_ms(provider_stdlib, args.repeats)}
+            if orjson is not None:
+                result["provider_orjson_ms"] = median_ms(provider_orjson, args.repeats)
+            result["streamed_ms"] = median_ms(streamed, args.repeats)
+            results.append(result)
+            print(f"{name:>8}: serialize_doc+jsonify {result['before_ms']:>7} ms   "
+                  f"provider {result['provider_stdlib_ms']:>7} ms   "
+                  f"orjson {result.get('provider_orjson_ms', 'n/a'):>7} ms   "
+                  f"streamed {result['streamed_ms']:>7} ms")
+    print(json.dumps({"orjson": orjson is not None, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
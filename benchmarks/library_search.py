@@ -0,0 +1,95 @@
+"""
+Shows that library-wide search latency stays flat as the number of PDFs grows.
+
+Seeds --docs PDFs through the app's own chunk indexing (which writes the
+search postings), drawing words Zipf-style from a --vocabulary-word vocabulary
+so that some terms are common across the library and most are rare, then
+times /api/search for random one- to three-term queries. Use --mongo-uri to
+run against a local mongod, where the (term, weight) index is what keeps
+searches fast; the default in-memory mongomock stand-in has no indexes.
+
+    python -m benchmarks.library_search --docs 30000 --mongo-uri mongodb://localhost:27017
+"""
+import argparse
+import datetime
+import json
+import random
+import statistics
+import time
+
+from benchmarks.fakes import install_fakes
+
+import app as app_module
+from bson import ObjectId
+
+
+def seed(docs, pages, words_per_page, vocabulary, rng):
+    app_module.pdfs_collection.delete_many({})
+    app_module.pdf_chunks_collection.delete_many({})
+    app_module.search_postings_collection.delete_many({})
+    words = [f"term{i}" for i in range(vocabulary)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary)]
+    start = datetime.datetime(2024, 1, 1)
+    for i in range(docs):
+        pdf_id = app_module.pdfs_collection.insert_one({
+            "_id": ObjectId(),
+            "filename": f"chapter-{i}.pdf",
+            "page_count": pages,
+            "word_count": pages * words_per_page,
+            "uploaded_at": start + datetime.timedelta(seconds=i)
+        }).inserted_id
+        page_texts = [" ".join(rng.choices(words, weights, k=words_per_page)) for _ in range(pages)]
+        app_module.index_pdf_chunks(pdf_id, page_texts)
+    return words
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--docs", type=int, default=300)
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--words-per-page", type=int, default=150)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-uri", help="benchmark against a real MongoDB instead of mongomock")
+    args = parser.parse_args()
+
+    install_fakes(app_module)
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        db = MongoClient(args.mongo_uri).beyondquiz_benchmark
+        app_module.pdfs_collection = db.pdfs
+        app_module.pdf_chunks_collection = db.pdf_chunks
+        app_module.search_postings_collection = db.search_postings
+        app_module.ensure_indexes(db)
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    words = seed(args.docs, args.pages, args.words_per_page, args.vocabulary, rng)
+    print(f"indexed {args.docs} PDFs in {time.perf_counter() - started:.1f}s "
+          f"({app_module.search_postings_collection.estimated_document_count()} postings)")
+
+    client = app_module.app.test_client()
+    timings = []
+    for _ in range(args.queries):
+        # Mix common head terms with rarer ones, as real questions do
+        query = " ".join(rng.choice(words[:2000]) for _ in range(rng.randint(1, 3)))
+        request_started = time.perf_counter()
+        response = client.get(f"/api/search?q={query}")
+        timings.append((time.perf_counter() - request_started) * 1000)
+        assert response.status_code == 200, response.get_json()
+
+    timings.sort()
+    result = {
+        "docs": args.docs,
+        "queries": args.queries,
+        "p50_ms": round(statistics.median(timings), 1),
+        "p95_ms": round(timings[int(0.95 * (len(timings) - 1))], 1),
+        "max_ms": round(timings[-1], 1),
+    }
+    print(f"search over {args.docs} PDFs: p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
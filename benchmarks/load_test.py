@@ -0,0 +1,286 @@
+"""
+Drives a mixed endpoint workload against the app and reports latency percentiles per endpoint.
+
+Serves the real Flask app (threaded) on a local port with a fake Gemini model
+and an in-memory mongomock database, then sends --requests requests from
+--concurrency clients, picking each request's endpoint from the weighted
+--mix. Chat, quiz and scoring messages are unique per request, so the
+response cache only helps where --repeat-rate asks for repeats. Failed
+calls (--failure-rate) exercise the retry path. The client-side Gemini rate
+limit is off unless --gemini-rpm is set, so results measure the app rather
+than the quota.
+
+Throughput and p50/p95/p99 per endpoint go to --output as JSON; pass an
+earlier file as --baseline to print the change against it.
+
+    python -m benchmarks.load_test --mix chat=4,chat_stream=2,quiz=2,score=2,upload=1,pdfs=2,progress=1,search=2 \\
+        --concurrency 16 --requests 400 --latency 0.2 --output results.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# A log line per request would be part of what gets timed
+os.environ.setdefault("LOG_REQUESTS", "0")
+
+from benchmarks.fakes import FakeModel, fake_page_texts, install_fakes, respond_to, seed_pdf
+from benchmarks.pdf_extraction import write_pdf
+
+import app as app_module
+from werkzeug.serving import make_server
+
+DEFAULT_MIX = "chat=4,chat_stream=2,quiz=2,score=2,upload=1,pdfs=2,progress=1,search=2"
+QUIZ = json.loads(respond_to('"mcqs"'))
+
+
+def parse_mix(mix):
+    """Parses "name=weight,..." into {name: weight}, rejecting unknown endpoints"""
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise SystemExit(f"unknown endpoint {name!r}; choose from {', '.join(OPERATIONS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values, quantile):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(quantile / 100 * len(sorted_values)) - 1))]
+
+
+class Client:
+    """Minimal HTTP client for the load test; returns (status, body bytes, seconds to first byte)"""
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def send(self, method, path, body=None, headers=None):
+        request = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                first = response.read(1)
+                first_byte = time.perf_counter() - started
+                return response.status, first + response.read(), first_byte
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), time.perf_counter() - started
+
+    def post_json(self, path, payload, accept="application/json"):
+        return self.send("POST", path, json.dumps(payload).encode(),
+                         {"Content-Type": "application/json", "Accept": accept})
+
+    def post_file(self, path, filename, data):
+        boundary = uuid.uuid4().hex
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+                f"Content-Type: application/pdf\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+        return self.send("POST", path, body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+
+def message(rng, args, i):
+    """A unique question, or (at --repeat-rate) one drawn from a small shared pool"""
+    if rng.random() < args.repeat_rate:
+        return f"What is momentum? (common question {rng.randrange(5)})"
+    return f"What is momentum? (request {i})"
+
+
+def chat(client, context, rng, args, i):
+    return client.post_json("/api/chat", {"message": message(rng, args, i), "pdfId": context["pdf_id"]})
+
+
+def chat_stream(client, context, rng, args, i):
+    return client.post_json("/api/chat/stream", {"message": message(rng, args, i), "pdfId": context["pdf_id"]},
+                            accept="text/event-stream")
+
+
+def quiz(client, context, rng, args, i):
+    topic = message(rng, args, i).replace("What is momentum?", "momentum")
+    return client.post_json("/api/generate-quiz", {"pdfId": context["pdf_id"], "topic": topic})
+
+
+def score(client, context, rng, args, i):
+    answers = {"q1": "Velocity", "q2": "Mass", "q3": f"Mass times velocity ({i})",
+               "q4": f"Mass times velocity ({i})", "q5": f"Inertia, F = ma and action-reaction ({i})"}
+    return client.post_json("/api/score-quiz", {"pdfId": context["pdf_id"], "quizQuestions": QUIZ,
+                                                "userAnswers": answers})
+
+
+def upload(client, context, rng, args, i):
+    # A fresh file each time, so uploads are extracted instead of deduplicated by content hash
+    return client.post_file("/api/upload", f"book-{i}.pdf", context["pdf_files"][i % len(context["pdf_files"])])
+
+
+def pdfs(client, context, rng, args, i):
+    return client.send("GET", "/api/pdfs?per_page=20")
+
+
+def progress(client, context, rng, args, i):
+    return client.send("GET", f"/api/progress?pdfId={context['pdf_id']}&limit=20")
+
+
+def search(client, context, rng, args, i):
+    terms = rng.sample(("momentum", "friction", "torque", "pressure", "density", "inertia"), 2)
+    return client.send("GET", f"/api/search?q={'+'.join(terms)}")
+
+
+OPERATIONS = {
+    "chat": chat,
+    "chat_stream": chat_stream,
+    "quiz": quiz,
+    "score": score,
+    "upload": upload,
+    "pdfs": pdfs,
+    "progress": progress,
+    "search": search,
+}
+
+
+def build_pdf_files(count, pages):
+    """Pre-renders distinct PDFs for the upload endpoint so rendering isn't timed"""
+    files = []
+    with tempfile.TemporaryDirectory(prefix="load-test-") as directory:
+        for seed in range(count):
+            path = f"{directory}/book-{seed}.pdf"
+            write_pdf(path, fake_page_texts(pages, seed=1000 + seed))
+            with open(path, "rb") as pdf:
+                files.append(pdf.read())
+    return files
+
+
+def run(args):
+    model = FakeModel(latency=args.latency, failure_rate=args.failure_rate,
+                      chunk_delay=args.chunk_delay, seed=args.seed)
+    install_fakes(app_module, model)
+    app_module.GEMINI_PROCESS_RPM = args.gemini_rpm
+    app_module.gemini_guards.clear()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    context = {"pdf_id": seed_pdf(app_module, pages=args.pages)}
+
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    plan = rng.choices(list(weights), weights=list(weights.values()), k=args.requests)
+    uploads = plan.count("upload")
+    context["pdf_files"] = build_pdf_files(uploads, args.pages) if uploads else []
+
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Client(f"http://127.0.0.1:{server.server_port}")
+
+    samples = defaultdict(list)
+    lock = threading.Lock()
+
+    def one_request(i):
+        name = plan[i]
+        # Per-request generators keep payloads identical across runs whatever the thread timing
+        request_rng = random.Random(args.seed * 1_000_003 + i)
+        started = time.perf_counter()
+        try:
+            status, _, first_byte = OPERATIONS[name](client, context, request_rng, args, i)
+        except Exception as e:
+            print(f"{name} request failed: {e}")
+            status, first_byte = None, None
+        elapsed = time.perf_counter() - started
+        with lock:
+            samples[name].append((status, elapsed, first_byte))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one_request, range(args.requests)))
+    wall_seconds = time.perf_counter() - started
+    server.shutdown()
+
+    endpoints = {}
+    for name in weights:
+        if name not in samples:
+            continue
+        latencies = sorted(seconds * 1000 for _, seconds, _ in samples[name])
+        first_bytes = sorted(seconds * 1000 for _, _, seconds in samples[name] if seconds is not None)
+        endpoints[name] = {
+            "requests": len(latencies),
+            "errors": sum(1 for status, _, _ in samples[name] if status is None or status >= 400),
+            "throughput_rps": round(len(latencies) / wall_seconds, 2),
+            "mean_ms": round(sum(latencies) / len(latencies), 1),
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "ttfb_p50_ms": round(percentile(first_bytes, 50), 1) if first_bytes else None,
+        }
+    return {
+        "commit": current_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_rps": round(args.requests / wall_seconds, 2),
+        "gemini_calls": model.calls,
+        "endpoints": endpoints,
+    }
+
+
+def current_commit():
+    """The checked-out commit, so result files say what they measured"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result, baseline=None):
+    print(f"{result['throughput_rps']} req/s overall over {result['wall_seconds']}s "
+          f"({result['gemini_calls']} Gemini calls), commit {result['commit']}")
+    print(f"{'endpoint':<12} {'reqs':>5} {'errs':>5} {'rps':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in result["endpoints"].items():
+        line = (f"{name:<12} {stats['requests']:>5} {stats['errors']:>5} {stats['throughput_rps']:>7} "
+                f"{stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+        before = (baseline or {}).get("endpoints", {}).get(name)
+        if before:
+            changes = [f"{key[:3]} {(stats[key] - before[key]) / before[key] * 100:+.0f}%"
+                       for key in ("p50_ms", "p95_ms", "p99_ms") if before[key]]
+            line += f"   vs {baseline['commit']}: " + ", ".join(changes)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted endpoints, e.g. chat=4,score=1")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake Gemini latency in seconds")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of Gemini calls that fail")
+    parser.add_argument("--repeat-rate", type=float, default=0.0,
+                        help="fraction of chat/quiz requests drawn from a few common questions")
+    parser.add_argument("--gemini-rpm", type=float, default=0, help="client-side Gemini rate limit (0 = off)")
+    parser.add_argument("--pages", type=int, default=20, help="pages in the seeded and uploaded PDFs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    result = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+        print(f"wrote {args.output}")
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
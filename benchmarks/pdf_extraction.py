@@ -0,0 +1,127 @@
+"""
+Compares PDF extraction backends on pages/second and peak memory.
+
+Writes a corpus of --docs synthetic text PDFs of --pages pages each, then
+extracts every page with each backend in a fresh interpreter, so peak RSS
+(resident set size) reflects that backend alone. Backends that aren't
+installed are reported as skipped.
+
+    python -m benchmarks.pdf_extraction --docs 5 --pages 100
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import fake_page_texts
+
+BACKENDS = ("pypdf2", "pdfium", "pdfminer")
+
+
+def write_pdf(path, page_texts, words_per_line=12):
+    """Writes a minimal, valid PDF with one Helvetica text page per entry"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for text in page_texts:
+        words = text.split()
+        lines = [" ".join(words[i:i + words_per_line]) for i in range(0, len(words), words_per_line)]
+        content = "BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({line}) '" for line in lines) + " ET"
+        stream = content.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids))
+
+    with open(path, "wb") as pdf:
+        pdf.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(pdf.tell())
+            pdf.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref = pdf.tell()
+        pdf.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            pdf.write(b"%010d 00000 n \n" % offset)
+        pdf.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+
+def extract_corpus(backend, paths):
+    """Runs in the child interpreter: extracts every file and reports throughput and memory"""
+    import app as app_module
+
+    extractor_class = app_module.get_extractor(backend)
+    if extractor_class.name != backend:
+        return {"backend": backend, "skipped": "not installed"}
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    pages = words = 0
+    started = time.perf_counter()
+    for path in paths:
+        with extractor_class(path) as extractor:
+            texts = extractor.page_texts(0, extractor.page_count())
+        pages += len(texts)
+        words += sum(len(text.split()) for text in texts)
+    seconds = time.perf_counter() - started
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "backend": backend,
+        "pages": pages,
+        "words": words,
+        "seconds": round(seconds, 3),
+        "pages_per_second": round(pages / seconds, 1),
+        "peak_rss_mb": round(peak_kb / 1024, 1),
+        "extraction_rss_mb": round((peak_kb - baseline_kb) / 1024, 1),
+    }
+
+
+def run_backend(backend, paths):
+    env = dict(os.environ)
+    env.setdefault("MONGO_URI", "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100")
+    result = subprocess.run([sys.executable, "-m", "benchmarks.pdf_extraction", "--worker", backend, *paths],
+                            capture_output=True, text=True, env=env, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--docs", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("paths", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(extract_corpus(args.worker, args.paths)))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="pdf-corpus-") as corpus:
+        paths = []
+        for doc in range(args.docs):
+            path = os.path.join(corpus, f"book-{doc}.pdf")
+            write_pdf(path, fake_page_texts(args.pages, seed=doc))
+            paths.append(path)
+        corpus_mb = sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+        print(f"corpus: {args.docs} PDFs x {args.pages} pages ({corpus_mb:.1f} MB)")
+
+        results = []
+        for backend in args.backends.split(","):
+            result = run_backend(backend, paths)
+            results.append(result)
+            if "skipped" in result:
+                print(f"{backend:>9}: skipped ({result['skipped']})")
+            else:
+                print(f"{backend:>9}: {result['pages_per_second']:>8} pages/s, "
+                      f"peak RSS {result['peak_rss_mb']} MB (+{result['extraction_rss_mb']} MB extracting)")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Shows that /api/pdfs page latency stays flat with cursor pagination.
+
+Seeds --docs PDF metadata documents, then times fetching deep pages two ways:
+the old skip/limit query plus count_documents, and the cursor-based endpoint.
+Use --mongo-uri to run against a local mongod (indexes matter there); the
+default in-memory mongomock stand-in has no indexes, so it only shows the
+relative cost of skipping.
+
+    python -m benchmarks.pdf_pagination --docs 50000 --mongo-uri mongodb://localhost:27017
+"""
+import argparse
+import datetime
+import json
+import statistics
+import time
+
+from benchmarks.fakes import install_fakes
+
+import app as app_module
+from bson import ObjectId
+
+
+def seed(collection, docs):
+    collection.delete_many({})
+    start = datetime.datetime(2024, 1, 1)
+    batch = []
+    for i in range(docs):
+        batch.append({
+            "_id": ObjectId(),
+            "filename": f"chapter-{i}.pdf",
+            "page_count": 20,
+            "word_count": 7000,
+            "uploaded_at": start + datetime.timedelta(seconds=i)
+        })
+        if len(batch) == 5000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+
+def median_ms(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--per-page", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--mongo-uri", help="benchmark against a real MongoDB instead of mongomock")
+    args = parser.parse_args()
+
+    install_fakes(app_module)
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        app_module.pdfs_collection = MongoClient(args.mongo_uri).beyondquiz_benchmark.pdfs
+    collection = app_module.pdfs_collection
+    seed(collection, args.docs)
+    collection.create_index([("uploaded_at", -1), ("_id", -1)])
+
+    client = app_module.app.test_client()
+    ordered = list(collection.find({}, {"uploaded_at": 1}).sort([("uploaded_at", -1), ("_id", -1)]))
+    last_page = max(1, args.docs // args.per_page)
+    pages = sorted({1, 10, 100, last_page // 2, last_page} & set(range(1, last_page + 1)))
+
+    results = []
+    for page in pages:
+        def offset_query():
+            list(collection.find({}).sort("uploaded_at", -1).skip((page - 1) * args.per_page).limit(args.per_page))
+            collection.count_documents({})
+
+        url = f"/api/pdfs?per_page={args.per_page}"
+        if page > 1:
+            url += "&cursor=" + app_module.encode_cursor(ordered[(page - 1) * args.per_page - 1])
+
+        def cursor_request():
+            response = client.get(url)
+            assert response.status_code == 200, response.get_json()
+
+        results.append({
+            "page": page,
+            "offset_ms": median_ms(offset_query, args.repeats),
+            "cursor_ms": median_ms(cursor_request, args.repeats)
+        })
+        print(f"page {page:>6}: skip+count {results[-1]['offset_ms']:>9} ms   cursor {results[-1]['cursor_ms']:>9} ms")
+
+    print(json.dumps({"docs": args.docs, "per_page": args.per_page, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Compares requests/second for the sync and threaded serving modes.
+
+Each mode serves the real Flask app on a local port with a fake Gemini model
+that sleeps for --latency seconds, then fires --requests chat requests from
+--concurrency clients. In sync mode a worker handles one request at a time, so
+throughput is capped near 1/latency; in threaded mode a worker keeps many
+Gemini calls in flight. The client-side Gemini rate limit is off unless
+--gemini-rpm is set, so results measure the serving mode rather than the quota.
+
+    python -m benchmarks.serving_modes --latency 0.5 --concurrency 16 --requests 64
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# A log line per request would be part of what gets timed
+os.environ.setdefault("LOG_REQUESTS", "0")
+
+from benchmarks.fakes import FakeModel, install_fakes, seed_pdf
+
+import app as app_module
+from werkzeug.serving import make_server
+
+
+def post_json(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return response.status
+
+
+def run_mode(threaded, pdf_id, model, args):
+    # Neither mode may answer from work the other one did
+    app_module.response_cache = app_module.ResponseCache()
+    app_module.single_flight = app_module.SingleFlight()
+    mode = "threaded" if threaded else "sync"
+    calls_before = model.calls
+
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=threaded)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_port}/api/chat"
+
+    # Distinct messages so the response cache never short-circuits the fake model
+    payloads = [{"message": f"What is momentum? ({mode} {i})", "pdfId": pdf_id} for i in range(args.requests)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        statuses = list(executor.map(lambda payload: post_json(url, payload), payloads))
+    elapsed = time.perf_counter() - started
+
+    server.shutdown()
+    assert model.calls - calls_before == len(payloads), f"{mode}: expected one model call per request"
+    return {
+        "mode": mode,
+        "requests": len(statuses),
+        "errors": sum(1 for status in statuses if status != 200),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(statuses) / elapsed, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.5, help="fake Gemini latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--gemini-rpm", type=float, default=0, help="client-side Gemini rate limit (0 = off)")
+    args = parser.parse_args()
+
+    model = FakeModel(latency=args.latency)
+    install_fakes(app_module, model)
+    app_module.GEMINI_PROCESS_RPM = args.gemini_rpm
+    app_module.gemini_guards.clear()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app_module.HEDGE_ENDPOINTS = set()  # Hedged duplicates would break one model call per request
+    pdf_id = seed_pdf(app_module)
+
+    results = [run_mode(False, pdf_id, model, args), run_mode(True, pdf_id, model, args)]
+    for result in results:
+        print(f"{result['mode']:>8}: {result['requests_per_second']:8.2f} req/s "
+              f"({result['requests']} requests in {result['seconds']}s, {result['errors']} errors)")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
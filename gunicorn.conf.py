@@ -0,0 +1,22 @@
+"""
+Gunicorn settings for running outside Vercel: `gunicorn app:app`.
+
+Requests spend nearly all their time waiting on Gemini and MongoDB, so the
+default "threaded" serving mode runs gthread workers that keep many of those
+calls in flight per process. SERVING_MODE=sync restores one request per worker.
+"""
+import os
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# Workers inherit this, so the app splits its Gemini quota across the real worker count
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+if os.getenv("SERVING_MODE", "threaded") == "threaded":
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", "32"))
+else:
+    worker_class = "sync"
+
+# Streamed chat answers and retried Gemini calls can outlast the 30s default
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
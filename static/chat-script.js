@@ -117,26 +117,49 @@ async function sendMessage() {
     showTypingIndicator();
 
     try {
-        // FIXED: Implement sliding window for chat history
-        const history = currentChat.messages.slice(-10);
+        // The server keeps the conversation; earlier messages only seed a new session
+        const payload = { message: message, pdfId: window.currentPdfId };
+        if (currentChat.sessionId && currentChat.pdfId === window.currentPdfId) {
+            payload.sessionId = currentChat.sessionId;
+        } else {
+            payload.history = currentChat.messages.slice(0, -1).slice(-10);
+        }
 
-        const response = await fetch('/api/chat', {
+        const response = await fetch('/api/chat/stream', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                message: message,
-                pdfId: window.currentPdfId,
-                history: history, // Send only the last 10 messages
-            }),
+            headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+            body: JSON.stringify(payload),
         });
 
-        const data = await response.json();
-        if (!response.ok) throw new Error(data.error || 'Failed to get response');
+        if (!response.ok) {
+            const data = await response.json();
+            throw new Error(data.error || 'Failed to get response');
+        }
+
+        // Render tokens as they arrive instead of waiting for the whole answer
+        let aiResponse = '';
+        let bubble = null;
+        await readEventStream(response, (event, data) => {
+            if (event === 'error') throw new Error(data.error || 'Failed to get response');
+            if (event === 'done' && data.sessionId) {
+                currentChat.sessionId = data.sessionId;
+                currentChat.pdfId = window.currentPdfId;
+            }
+            if (event !== 'message' || !data.text) return;
+            if (!bubble) {
+                hideTypingIndicator();
+                chatState.isTyping = true;
+                bubble = addMessageToUI('ai', '');
+            }
+            aiResponse += data.text;
+            bubble.innerHTML = escapeHtml(aiResponse).replace(/\n/g, '<br>');
+            scrollToBottom();
+        });
 
         hideTypingIndicator();
-        addMessageToUI('ai', data.response);
+        if (!bubble) addMessageToUI('ai', aiResponse);
 
-        currentChat.messages.push({ role: 'ai', content: data.response, timestamp: new Date().toISOString() });
+        currentChat.messages.push({ role: 'ai', content: aiResponse, timestamp: new Date().toISOString() });
         if (currentChat.messages.length === 2) {
             currentChat.title = generateChatTitle(message);
             updateChatHistoryUI();
@@ -162,6 +185,33 @@ function addMessageToUI(role, content) {
     messageDiv.innerHTML = avatar + bubble;
     chatElements.messagesContainer.appendChild(messageDiv);
     scrollToBottom();
+    return messageDiv.querySelector('.chat-message-bubble');
+}
+
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            if (data) onEvent(event, JSON.parse(data));
+        }
+    }
 }
 
 function showTypingIndicator() {
@@ -13,6 +13,7 @@ const toast = document.getElementById('toast');
 const themeToggle = document.getElementById('themeToggle');
 const uploadProgress = document.getElementById('uploadProgress');
 const progressFill = document.querySelector('.progress-fill');
+const progressText = document.querySelector('.progress-text');
 const navBtns = document.querySelectorAll('.nav-btn[data-view]');
 const contentViews = document.querySelectorAll('.content-view');
 const scoreModal = document.getElementById('scoreModal');
@@ -128,18 +129,31 @@ function switchView(viewName) {
 // PDF Management
 async function loadPDFs() {
     try {
-        const response = await fetch('/api/pdfs');
-        const data = await response.json();
-        if (!response.ok) throw new Error(data.error || 'Failed to fetch');
+        // Follow the pagination cursor so large libraries still fill the selector
+        const pdfs = [];
+        let cursor = null;
+        let total = 0;
+        for (let page = 0; page < 10; page++) {
+            const params = new URLSearchParams({ per_page: 100 });
+            if (cursor) params.set('cursor', cursor);
+            const response = await fetch(`/api/pdfs?${params}`);
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.error || 'Failed to fetch');
+
+            pdfs.push(...data.pdfs);
+            total = data.total;
+            cursor = data.next_cursor;
+            if (!cursor) break;
+        }
 
         pdfSelect.innerHTML = '<option value="">Choose a PDF...</option>';
-        data.pdfs.forEach(pdf => {
+        pdfs.forEach(pdf => {
             const option = document.createElement('option');
             option.value = pdf._id;
             option.textContent = pdf.filename;
             pdfSelect.appendChild(option);
         });
-        document.getElementById('totalQuizzes').textContent = data.pdfs.length;
+        document.getElementById('totalQuizzes').textContent = total;
     } catch (error) {
         showToast(`Error loading PDFs: ${error.message}`, 'error');
     }
@@ -164,10 +178,15 @@ async function handleFileUpload(event) {
     uploadProgress.classList.add('active');
     try {
         const response = await fetch('/api/upload', { method: 'POST', body: formData });
-        const data = await response.json();
+        let data = await response.json();
         if (!response.ok) throw new Error(data.error || 'Upload failed');
 
-        showToast('PDF uploaded successfully!', 'success');
+        // 202 means the server accepted the file and is extracting it in the background
+        if (response.status === 202) {
+            data = await waitForUploadJob(data.status_url);
+        }
+
+        showToast(data.duplicate ? 'This PDF was already uploaded. Reusing it.' : 'PDF uploaded successfully!', 'success');
         await loadPDFs();
         pdfSelect.value = data.pdf_id;
         
@@ -188,10 +207,32 @@ async function handleFileUpload(event) {
         showToast(error.message, 'error');
     } finally {
         uploadProgress.classList.remove('active');
+        progressFill.style.width = '0%';
+        progressText.textContent = 'Uploading...';
         fileInput.value = '';
     }
 }
 
+const UPLOAD_POLL_INTERVAL_MS = 1000;
+const UPLOAD_POLL_LIMIT = 15 * 60;  // Give up after ~15 minutes, past the server's stale-job cutoff
+
+async function waitForUploadJob(statusUrl) {
+    for (let attempt = 0; attempt < UPLOAD_POLL_LIMIT; attempt++) {
+        const response = await fetch(statusUrl);
+        const job = await response.json();
+        if (!response.ok) throw new Error(job.error || 'Upload failed');
+
+        if (job.status === 'done') return job;
+        if (job.status === 'failed') throw new Error(job.error || 'Upload failed');
+
+        const percent = job.pages_total ? Math.round((job.pages_done / job.pages_total) * 100) : 0;
+        progressFill.style.width = `${percent}%`;
+        progressText.textContent = `Processing pages ${job.pages_done}/${job.pages_total}...`;
+        await new Promise(resolve => setTimeout(resolve, UPLOAD_POLL_INTERVAL_MS));
+    }
+    throw new Error('Processing is taking too long. Please try uploading again.');
+}
+
 // FIXED: Complete rewrite of handlePdfSelect
 async function handlePdfSelect() {
     const selectedOption = pdfSelect.options[pdfSelect.selectedIndex];
@@ -454,8 +495,9 @@ function displayScore(result) {
             <div class="score-circle">
                 <span class="score-percentage">${escapeHtml(result.score)}</span>
             </div>
-            <h3 class="score-message">Great Effort!</h3>
+            <h3 class="score-message">${result.evaluated === false ? 'Partly Graded' : 'Great Effort!'}</h3>
             <p class="score-details">${escapeHtml(result.overallFeedback)}</p>
+            ${result.evaluated === false ? '<p class="score-details">Some answers could not be evaluated and are not counted in this score or your progress.</p>' : ''}
         </div>`;
     scoreModal.classList.add('active');
 }
@@ -470,7 +512,9 @@ function displayFeedback(feedbackData) {
     feedbackData.forEach((fb, index) => {
         if (questionCards[index]) {
             const feedbackCard = questionCards[index].querySelector('.feedback-card');
-            const isCorrect = fb.feedback.toLowerCase().includes('correct') || fb.feedback.toLowerCase().includes('good');
+            const isCorrect = typeof fb.correct === 'boolean'
+                ? fb.correct
+                : fb.feedback.toLowerCase().includes('correct') || fb.feedback.toLowerCase().includes('good');
 
             feedbackCard.innerHTML = `
                 <div class="feedback-header">
@@ -585,13 +629,18 @@ function displayVideoRecommendations(recommendations) {
 async function loadProgress() {
     showLoading('Loading your progress...');
     try {
-        const response = await fetch('/api/progress');
+        const [response, summaryResponse] = await Promise.all([
+            fetch('/api/progress?limit=20'),
+            fetch('/api/progress/summary'),
+        ]);
         const data = await response.json();
+        const summary = await summaryResponse.json();
         
         if (!response.ok) throw new Error(data.error || 'Failed to load progress');
+        if (!summaryResponse.ok) throw new Error(summary.error || 'Failed to load progress');
 
-        displayProgressData(data.attempts);
-        updateQuickStats();
+        displayProgressData(data.attempts, summary);
+        updateQuickStats(summary);
     } catch (error) {
         showToast(`Error loading progress: ${error.message}`, 'error');
         console.error('Progress loading error:', error);
@@ -601,7 +650,7 @@ async function loadProgress() {
 }
 
 // FIXED: Better empty state with CTA
-function displayProgressData(attempts) {
+function displayProgressData(attempts, summary) {
     if (!attempts || attempts.length === 0) {
         attemptsList.innerHTML = `
             <div class="empty-state">
@@ -623,18 +672,10 @@ function displayProgressData(attempts) {
         return;
     }
 
-    // Calculate statistics
-    const totalAttempts = attempts.length;
-    const scores = attempts.map(a => parseFloat(a.score) || 0);
-    const avgScore = scores.length > 0 ? (scores.reduce((a, b) => a + b, 0) / scores.length).toFixed(1) : 0;
-    
-    // Calculate trend (compare last 3 vs previous)
-    let trend = 0;
-    if (scores.length >= 4) {
-        const recentAvg = scores.slice(0, 3).reduce((a, b) => a + b, 0) / 3;
-        const previousAvg = scores.slice(3, 6).reduce((a, b) => a + b, 0) / Math.min(3, scores.length - 3);
-        trend = (recentAvg - previousAvg).toFixed(1);
-    }
+    // Statistics are aggregated server-side over every attempt, not just this page
+    const totalAttempts = summary.attempts;
+    const avgScore = summary.average.toFixed(1);
+    const trend = summary.trend.toFixed(1);
 
     // Update stats
     progressAttempts.textContent = totalAttempts;
@@ -657,7 +698,7 @@ function displayProgressData(attempts) {
                     <div class="attempt-number">#${totalAttempts - index}</div>
                     <div class="attempt-score ${scoreClass}">
                         <i class="fas fa-star"></i>
-                        ${escapeHtml(attempt.score)}
+                        ${escapeHtml(attempt.score)}${attempt.evaluated === false ? ' (partly graded)' : ''}
                     </div>
                 </div>
                 <div class="attempt-body">
@@ -679,24 +720,22 @@ function displayProgressData(attempts) {
 }
 
 // FIXED: Update quick stats in sidebar
-async function updateQuickStats() {
+async function updateQuickStats(summary) {
     try {
-        const response = await fetch('/api/progress');
-        const data = await response.json();
-        
-        if (response.ok && data.attempts) {
-            const scores = data.attempts.map(a => parseFloat(a.score) || 0);
-            const avgScore = scores.length > 0 ? (scores.reduce((a, b) => a + b, 0) / scores.length).toFixed(0) : 0;
-            
-            const avgScoreEl = document.getElementById('avgScore');
-            if (avgScoreEl) {
-                avgScoreEl.textContent = `${avgScore}%`;
-                // FIXED: Add subtle animation
-                avgScoreEl.parentElement.style.animation = 'none';
-                setTimeout(() => {
-                    avgScoreEl.parentElement.style.animation = 'fadeIn 0.5s ease';
-                }, 10);
-            }
+        if (!summary) {
+            const response = await fetch('/api/progress/summary');
+            summary = await response.json();
+            if (!response.ok) return;
+        }
+
+        const avgScoreEl = document.getElementById('avgScore');
+        if (avgScoreEl) {
+            avgScoreEl.textContent = `${summary.average.toFixed(0)}%`;
+            // FIXED: Add subtle animation
+            avgScoreEl.parentElement.style.animation = 'none';
+            setTimeout(() => {
+                avgScoreEl.parentElement.style.animation = 'fadeIn 0.5s ease';
+            }, 10);
         }
     } catch (error) {
         console.error('Error updating quick stats:', error);
@@ -0,0 +1,37 @@
+"""
+Shared fixtures: the app wired to the benchmark fakes (mongomock and a fake Gemini model).
+
+benchmarks.fakes is imported before app so its environment defaults (no real
+MongoDB, no background ingestion) apply at import time.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_REQUESTS", "0")
+
+from benchmarks.fakes import FakeModel, install_fakes  # noqa: E402
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def fake_model():
+    return FakeModel(latency=0, chunk_delay=0)
+
+
+@pytest.fixture
+def app(fake_model, monkeypatch):
+    """The app module with fresh fakes, guards and metrics for each test"""
+    install_fakes(app_module, fake_model)
+    monkeypatch.setattr(app_module, "metrics", app_module.Metrics())
+    monkeypatch.setattr(app_module, "gemini_guards", {})
+    monkeypatch.setattr(app_module, "single_flight", app_module.SingleFlight())
+    return app_module
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
@@ -0,0 +1,65 @@
+from benchmarks.fakes import FakeModel, install_fakes, seed_pdf
+
+
+class RecordingModel(FakeModel):
+    """Records whether each call was a rolling-summary call"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.kinds = []
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.kinds.append("summary" if "running summary" in prompt else "answer")
+        return super().generate_content(prompt, stream=stream, **kwargs)
+
+
+def chat(client, pdf_id, session_id, turn):
+    payload = {"message": f"Question {turn}: how does momentum relate to force? " + "detail " * 60, "pdfId": pdf_id}
+    if session_id:
+        payload["sessionId"] = session_id
+    return client.post("/api/chat", json=payload).get_json()["sessionId"]
+
+
+def test_summaries_run_after_the_answer_not_before(app, client, monkeypatch):
+    monkeypatch.setattr(app, "CHAT_SUMMARY_BACKGROUND", False)
+    model = RecordingModel(latency=0, chunk_delay=0)
+    install_fakes(app, model)
+    pdf_id = seed_pdf(app)
+
+    session_id = None
+    for turn in range(8):
+        session_id = chat(client, pdf_id, session_id, turn)
+
+    assert "summary" in model.kinds
+    # Every summary follows an answer within the same turn; none precedes a turn's answer
+    assert model.kinds[0] == "answer"
+    for index, kind in enumerate(model.kinds):
+        if kind == "summary":
+            assert model.kinds[index - 1] == "answer"
+    session = app.chat_sessions_collection.find_one({"_id": session_id})
+    assert session["summary"] and not app.over_history_budget(session["turns"])
+
+
+def test_prompt_stays_within_budget_while_a_summary_is_pending(app):
+    long_turn = {"role": "user", "content": "word " * 400}
+    session = {"summary": "", "turns": [long_turn] * 10}
+
+    assert len(app.prompt_chat_turns(session)) == app.CHAT_RECENT_MESSAGES
+    assert app.prompt_chat_turns({"summary": "", "turns": [long_turn] * 2}) == [long_turn] * 2
+
+
+def test_a_turn_added_during_summarizing_is_kept(app, monkeypatch):
+    install_fakes(app, FakeModel(latency=0, chunk_delay=0))
+    session_id = "a" * 32
+    turns = [{"role": "user", "content": "word " * 400}] * 6
+    app.chat_sessions_collection.insert_one({"_id": session_id, "summary": "", "turns": turns, "summarized_messages": 0})
+    real = app.generate_with_retry
+
+    def summarize_while_a_turn_lands(model, prompt, **kwargs):
+        app.chat_sessions_collection.update_one({"_id": session_id}, {"$push": {"turns": {"role": "ai", "content": "new"}}})
+        return real(model, prompt, **kwargs)
+
+    monkeypatch.setattr(app, "generate_with_retry", summarize_while_a_turn_lands)
+    app.compact_chat_session(session_id)
+
+    session = app.chat_sessions_collection.find_one({"_id": session_id})
+    assert len(session["turns"]) == 7 and session["turns"][-1]["content"] == "new"
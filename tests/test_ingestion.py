@@ -0,0 +1,49 @@
+import datetime
+
+from benchmarks.fakes import fake_page_texts
+from benchmarks.pdf_extraction import write_pdf
+
+
+def insert_job(app, job_id, status, age_seconds, content_hash="abc"):
+    updated_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=age_seconds)
+    app.upload_jobs_collection.insert_one({
+        "_id": job_id, "filename": "notes.pdf", "content_hash": content_hash, "status": status,
+        "pages_done": 0, "pages_total": 10, "pdf_id": None, "error": None,
+        "created_at": updated_at, "updated_at": updated_at
+    })
+
+
+def test_status_reports_stale_job_as_failed(app, client):
+    insert_job(app, "dead", "processing", app.UPLOAD_JOB_STALE_SECONDS + 60)
+
+    job = client.get("/api/upload/dead").get_json()
+    assert job["status"] == "failed"
+    assert job["error"]
+
+
+def test_active_jobs_are_left_alone(app, client):
+    insert_job(app, "live", "processing", 5)
+
+    assert client.get("/api/upload/live").get_json()["status"] == "processing"
+
+
+def test_stale_jobs_stop_deduplicating_uploads(app):
+    insert_job(app, "dead", "queued", app.UPLOAD_JOB_STALE_SECONDS + 60)
+    insert_job(app, "other", "queued", app.UPLOAD_JOB_STALE_SECONDS + 60, content_hash="xyz")
+
+    app.fail_stale_upload_jobs({"content_hash": "abc"})
+
+    assert app.upload_jobs_collection.find_one({"_id": "dead"})["status"] == "failed"
+    assert app.upload_jobs_collection.find_one({"_id": "other"})["status"] == "queued"
+
+
+def test_ingestion_job_extracts_pages_in_worker_processes(app, tmp_path):
+    path = str(tmp_path / "notes.pdf")
+    write_pdf(path, fake_page_texts(pages=6, words_per_page=40))
+    insert_job(app, "job", "queued", 0)
+
+    app.run_ingestion_job("job", "notes.pdf", path, "abc", 6)
+
+    job = app.upload_jobs_collection.find_one({"_id": "job"})
+    assert job["status"] == "done" and job["pages_done"] == 6
+    assert app.pdf_pages_collection.count_documents({"pdfId": app.validate_object_id(job["pdf_id"])}) == 6
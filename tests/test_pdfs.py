@@ -0,0 +1,21 @@
+from benchmarks.fakes import seed_pdf
+
+
+def test_pdf_list_returns_only_listing_fields(app, client):
+    pdf_id = seed_pdf(app, pages=3)
+    app.build_quiz_bank(app.validate_object_id(pdf_id))
+
+    pdfs = client.get("/api/pdfs").get_json()["pdfs"]
+
+    assert [pdf["_id"] for pdf in pdfs] == [pdf_id]
+    assert set(pdfs[0]) == {"_id", "filename", "page_count", "word_count", "uploaded_at"}
+
+
+def test_pdf_list_pages_with_a_cursor(app, client):
+    pdf_ids = [seed_pdf(app, pages=1, filename=f"chapter-{i}.pdf", seed=i) for i in range(3)]
+
+    first = client.get("/api/pdfs", query_string={"per_page": 2}).get_json()
+    second = client.get("/api/pdfs", query_string={"per_page": 2, "cursor": first["next_cursor"]}).get_json()
+
+    assert first["total"] == 3 and second["next_cursor"] is None
+    assert sorted(pdf["_id"] for pdf in first["pdfs"] + second["pdfs"]) == sorted(pdf_ids)
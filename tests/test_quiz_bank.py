@@ -0,0 +1,112 @@
+import datetime
+import threading
+
+import pytest
+
+from benchmarks.fakes import seed_pdf
+
+
+def bank_state(app, pdf_id):
+    return app.pdfs_collection.find_one({"_id": app.validate_object_id(pdf_id)})
+
+
+def test_bank_builds_one_section_per_request(app, client):
+    pdf_id = seed_pdf(app, pages=30)
+
+    responses = [client.post(f"/api/pdfs/{pdf_id}/quiz-bank") for _ in range(app.QUIZ_BANK_SECTIONS)]
+
+    assert [r.status_code for r in responses] == [202] * (app.QUIZ_BANK_SECTIONS - 1) + [200]
+    assert responses[-1].get_json()["status"] == "ready"
+    assert bank_state(app, pdf_id)["quiz_bank_next_section"] == app.QUIZ_BANK_SECTIONS
+    assert app.quiz_questions_collection.count_documents({}) == bank_state(app, pdf_id)["quiz_bank_size"]
+
+
+def test_stale_building_claim_is_taken_over(app):
+    pdf_id = seed_pdf(app, pages=30)
+    pdf_id_obj = app.validate_object_id(pdf_id)
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.QUIZ_BANK_CLAIM_SECONDS + 60)
+    app.pdfs_collection.update_one({"_id": pdf_id_obj}, {"$set": {
+        "quiz_bank_status": "building", "quiz_bank_claim": "dead", "quiz_bank_claimed_at": stale,
+        "quiz_bank_next_section": 2, "quiz_bank_size": 0
+    }})
+    assert app.quiz_bank_due(bank_state(app, pdf_id))
+
+    app.build_quiz_bank(pdf_id_obj)
+
+    state = bank_state(app, pdf_id)
+    assert state["quiz_bank_status"] == "ready"
+    assert state["quiz_bank_next_section"] == app.QUIZ_BANK_SECTIONS
+
+
+def test_live_building_claim_is_respected(app):
+    pdf_id = seed_pdf(app, pages=30)
+    pdf_id_obj = app.validate_object_id(pdf_id)
+    app.pdfs_collection.update_one({"_id": pdf_id_obj}, {"$set": {
+        "quiz_bank_status": "building", "quiz_bank_claim": "live", "quiz_bank_claimed_at": datetime.datetime.utcnow()
+    }})
+
+    assert app.build_quiz_bank(pdf_id_obj) == 0
+    assert bank_state(app, pdf_id)["quiz_bank_claim"] == "live"
+
+
+def mark_failed(app, pdf_id_obj, failures, seconds_ago):
+    app.pdfs_collection.update_one({"_id": pdf_id_obj}, {"$set": {
+        "quiz_bank_status": "failed", "quiz_bank_failures": failures,
+        "quiz_bank_failed_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds_ago)
+    }})
+    return bank_state(app, str(pdf_id_obj))
+
+
+def test_failed_banks_are_retried_with_backoff(app):
+    pdf_id_obj = app.validate_object_id(seed_pdf(app, pages=30))
+
+    assert not app.quiz_bank_due(mark_failed(app, pdf_id_obj, 1, 60))
+    assert app.quiz_bank_due(mark_failed(app, pdf_id_obj, 1, app.QUIZ_BANK_RETRY_SECONDS + 1))
+    # The wait doubles with each failure, and stops after QUIZ_BANK_MAX_FAILURES
+    assert not app.quiz_bank_due(mark_failed(app, pdf_id_obj, 2, app.QUIZ_BANK_RETRY_SECONDS + 1))
+    assert not app.quiz_bank_due(mark_failed(app, pdf_id_obj, app.QUIZ_BANK_MAX_FAILURES, 10 ** 6))
+
+
+def test_failed_banks_wait_while_gemini_is_shedding_load(app):
+    pdf_id_obj = app.validate_object_id(seed_pdf(app, pages=30))
+    state = mark_failed(app, pdf_id_obj, 1, app.QUIZ_BANK_RETRY_SECONDS + 1)
+
+    breaker = app.guard_for(app.model).breaker
+    for _ in range(app.GEMINI_BREAKER_FAILURES):
+        breaker.record_failure()
+
+    assert not app.quiz_bank_due(state)
+
+
+def test_busy_upstream_fails_the_build_and_counts_it(app, monkeypatch):
+    pdf_id = seed_pdf(app, pages=30)
+
+    def busy(*args, **kwargs):
+        raise app.UpstreamUnavailable("busy", retry_after=5)
+
+    monkeypatch.setattr(app, "generate_structured", busy)
+    with pytest.raises(app.UpstreamUnavailable):
+        app.build_quiz_bank(app.validate_object_id(pdf_id))
+
+    state = bank_state(app, pdf_id)
+    assert state["quiz_bank_status"] == "failed" and state["quiz_bank_failures"] == 1
+    assert not app.quiz_bank_due(state)
+
+
+def test_a_pdf_is_queued_for_a_build_only_once(app, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    builds = []
+
+    def slow_build(pdf_id_obj):
+        builds.append(pdf_id_obj)
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(app, "build_quiz_bank", slow_build)
+    app.schedule_quiz_bank("pdf")
+    started.wait(5)
+    app.schedule_quiz_bank("pdf")
+    release.set()
+    app._bank_runner.submit(lambda: None).result()
+
+    assert builds == ["pdf"]
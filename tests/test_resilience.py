@@ -0,0 +1,114 @@
+import time
+
+import pytest
+
+from benchmarks.fakes import FakeModel
+
+
+def send(model):
+    return model.generate_content("Explain momentum")
+
+
+def install_guard(app, model, **kwargs):
+    guard = app.GeminiGuard(**kwargs)
+    app.gemini_guards[app.model_label(model)] = guard
+    return guard
+
+
+def test_breaker_opens_after_consecutive_failures(app):
+    model = FakeModel(latency=0, failure_rate=1.0)
+    guard = install_guard(app, model, rate_per_minute=0, failure_threshold=2, cooldown=60)
+
+    with pytest.raises(RuntimeError):
+        app.call_model(model, send, "test", retries=2, delay=0)
+    assert guard.breaker.state == "open"
+
+    # Open breaker fails fast without reaching upstream
+    with pytest.raises(app.UpstreamUnavailable):
+        app.call_model(model, send, "test", retries=2, delay=0)
+    assert model.calls == 2
+
+
+def test_half_open_allows_one_trial_and_closes_on_success(app, fake_model):
+    breaker = install_guard(app, fake_model, rate_per_minute=0, failure_threshold=1, cooldown=0.05).breaker
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+
+    assert breaker.before_call() is True
+    with pytest.raises(app.UpstreamUnavailable):
+        breaker.before_call()  # Only one trial at a time
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.before_call() is False
+
+
+def test_limiter_rejection_releases_half_open_trial(app, fake_model):
+    guard = install_guard(app, fake_model, rate_per_minute=600, burst=1, failure_threshold=1, cooldown=0.05)
+    guard.breaker.record_failure()
+    time.sleep(0.06)
+
+    # A 429 paused the bucket past the deadline, so the trial call never reaches upstream
+    guard.limiter.throttled(retry_after=1000)
+    with pytest.raises(app.UpstreamUnavailable):
+        app.call_model(fake_model, send, "test", retries=1)
+    assert fake_model.calls == 0
+    assert not guard.breaker.trial_in_flight
+
+    guard.limiter.paused_until = 0.0
+    guard.limiter.tokens = 1.0
+    assert app.call_model(fake_model, send, "test", retries=1).text
+    assert guard.breaker.state == "closed"
+
+
+def test_token_bucket_waits_for_tokens_after_burst(app):
+    bucket = app.TokenBucket(rate_per_minute=600, burst=2, max_waiters=4)
+    started = time.monotonic()
+    for _ in range(3):
+        bucket.acquire(deadline=time.monotonic() + 5)
+    # Two burst tokens are free; the third arrives after 1/10 s
+    assert 0.05 < time.monotonic() - started < 1.0
+
+
+def test_token_bucket_rejects_past_deadline_and_when_queue_full(app):
+    bucket = app.TokenBucket(rate_per_minute=6, burst=1, max_waiters=0)
+    with pytest.raises(app.UpstreamUnavailable):
+        bucket.acquire(deadline=time.monotonic() + 5)
+
+    bucket = app.TokenBucket(rate_per_minute=6, burst=1, max_waiters=4)
+    bucket.acquire(deadline=time.monotonic() + 1)
+    with pytest.raises(app.UpstreamUnavailable) as excinfo:
+        bucket.acquire(deadline=time.monotonic() + 1)  # Next token is 10 s away
+    assert excinfo.value.retry_after >= 9
+
+
+def test_token_bucket_halves_rate_on_429_and_recovers(app):
+    bucket = app.TokenBucket(rate_per_minute=600, burst=1, max_waiters=4)
+    bucket.throttled(retry_after=0.5)
+    assert bucket.rate == pytest.approx(5.0)
+    assert not bucket.try_acquire()  # Paused for the hint
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == pytest.approx(10.0)
+
+
+def test_limiter_keeps_calls_under_fake_quota(app):
+    model = FakeModel(latency=0, quota_per_second=5)
+    install_guard(app, model, rate_per_minute=5 * 60, burst=1, failure_threshold=100, cooldown=1)
+    for _ in range(8):
+        app.call_model(model, send, "test", retries=3, delay=0.1)
+    assert model.rejected == 0
+
+
+def test_fake_quota_429_is_retried_after_its_hint(app):
+    model = FakeModel(latency=0, quota_per_second=1)
+    install_guard(app, model, rate_per_minute=0, failure_threshold=100, cooldown=1)
+    send(model)
+    with pytest.raises(RuntimeError) as excinfo:
+        send(model)
+    assert app.classify_error(excinfo.value) == "rate_limited"
+    assert 0 < app.retry_after_hint(excinfo.value) <= 1.0
+
+    # The retry waits out the hint instead of hammering the quota
+    assert app.call_model(model, send, "test", retries=3, delay=0.01).text
+    assert model.rejected == 2
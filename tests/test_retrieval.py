@@ -0,0 +1,75 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from benchmarks.fakes import fake_page_texts
+
+
+def legacy_pdf(app, pages=10):
+    """A PDF stored before the chunk index existed: pages only"""
+    pdf_id_obj = app.pdfs_collection.insert_one({"filename": "legacy.pdf", "page_count": pages}).inserted_id
+    app.pdf_pages_collection.insert_many([
+        {"pdfId": pdf_id_obj, "page": number, "text": text}
+        for number, text in enumerate(fake_page_texts(pages), start=1)
+    ])
+    return pdf_id_obj
+
+
+def test_concurrent_lazy_indexing_stores_passages_once(app, monkeypatch):
+    pdf_id_obj = legacy_pdf(app)
+    store = app.store_pdf_chunks
+
+    def slow_store(*args):
+        time.sleep(0.2)  # Every reader finds no passages while the first one is still indexing
+        return store(*args)
+
+    monkeypatch.setattr(app, "store_pdf_chunks", slow_store)
+    barrier = threading.Barrier(4)
+
+    def read():
+        barrier.wait()
+        app.ensure_chunk_index(pdf_id_obj)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = len(app.split_into_chunks(fake_page_texts(10)))
+    assert app.pdf_chunks_collection.count_documents({"pdfId": pdf_id_obj}) == expected
+    assert len(app.ensure_chunk_index(pdf_id_obj)) == expected
+    assert app.pdfs_collection.find_one({"_id": pdf_id_obj})["chunk_index_status"] == "ready"
+
+
+def test_stale_indexing_claim_is_taken_over(app):
+    pdf_id_obj = legacy_pdf(app)
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.CHUNK_INDEX_CLAIM_SECONDS + 60)
+    app.pdfs_collection.update_one({"_id": pdf_id_obj}, {"$set": {
+        "chunk_index_status": "building", "chunk_index_claimed_at": stale
+    }})
+
+    assert app.ensure_chunk_index(pdf_id_obj)
+
+
+def test_failed_postings_leave_no_chunks_and_backfill_retries(app, monkeypatch):
+    pdf_id_obj = legacy_pdf(app)
+    index_terms = app.index_pdf_terms
+
+    def failing(*args, **kwargs):
+        raise RuntimeError("postings write failed")
+
+    monkeypatch.setattr(app, "index_pdf_terms", failing)
+    with pytest.raises(RuntimeError):
+        app.index_pdf_chunks(pdf_id_obj, fake_page_texts(10))
+
+    state = app.pdfs_collection.find_one({"_id": pdf_id_obj})
+    assert state["chunk_index_status"] == "failed" and state["search_index_status"] == "failed"
+    assert app.pdf_chunks_collection.count_documents({"pdfId": pdf_id_obj}) == 0
+
+    monkeypatch.setattr(app, "index_pdf_terms", index_terms)
+    assert app.backfill_search_index() == 1
+    assert app.search_postings_collection.count_documents({"pdfId": pdf_id_obj}) > 0
+    assert [result["filename"] for result in app.search_library("momentum")] == ["legacy.pdf"]
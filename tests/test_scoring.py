@@ -0,0 +1,87 @@
+import pytest
+
+OPTIONS = ["Speed", "Velocity", "Mass", "Energy"]
+
+
+@pytest.mark.parametrize("correct", ["Velocity", "velocity", "B) Velocity", "Velocity.", "(b)", "B", "Option B", "b. Velocity"])
+def test_correct_answer_forms_resolve_to_the_option(app, correct):
+    question = {"options": OPTIONS, "correctAnswer": correct}
+
+    assert app.resolve_correct_option(question) == "Velocity"
+    assert app.mcq_is_correct(question, "Velocity")
+    assert not app.mcq_is_correct(question, "Speed")
+
+
+def test_labelled_options_match_plain_answers(app):
+    question = {"options": ["A) Speed", "B) Velocity", "C) Mass", "D) Energy"], "correctAnswer": "Velocity"}
+
+    assert app.resolve_correct_option(question) == "B) Velocity"
+    assert app.mcq_is_correct(question, "B) Velocity")
+
+
+def test_repair_drops_mcqs_matching_no_option(app):
+    mcqs = [
+        {"question": "Vector quantity?", "options": OPTIONS, "correctAnswer": "Option B"},
+        {"question": "Unit of force?", "options": OPTIONS, "correctAnswer": "Newton"},
+        {"question": "Starts with a?", "options": ["a car", "a bus"], "correctAnswer": "a train"},
+    ]
+
+    repaired = app.repair_mcqs(mcqs)
+
+    assert [mcq["correctAnswer"] for mcq in repaired] == ["Velocity"]
+
+
+def test_failed_batch_falls_back_without_failing_the_others(app, monkeypatch):
+    monkeypatch.setattr(app, "SCORING_BATCH_ITEMS", 1)
+    real = app.evaluate_free_text
+
+    def flaky(items, summaries):
+        if items[0]["submission"] == "s1":
+            raise ValueError("unparseable")
+        return real(items, summaries)
+
+    monkeypatch.setattr(app, "evaluate_free_text", flaky)
+    quiz = {"mcqs": [], "saqs": [{"question": "Define momentum.", "idealAnswer": "Mass times velocity."}], "laqs": []}
+
+    scored = app.score_submissions(quiz, [{"q1": "Mass times velocity."}, {"q1": "No idea"}])
+
+    assert "could not be evaluated" not in scored[0]["questionFeedback"][0]["feedback"]
+    assert "could not be evaluated" in scored[1]["questionFeedback"][0]["feedback"]
+    assert [result["evaluated"] for result in scored] == [True, False]
+
+
+def test_unevaluated_answers_are_left_out_of_stored_scores(app, client, monkeypatch):
+    monkeypatch.setattr(app, "SCORING_BATCH_ITEMS", 1)
+    real = app.evaluate_free_text
+
+    def flaky(items, summaries):
+        if items[0]["submission"] == "s1":
+            raise app.UpstreamUnavailable("busy", retry_after=1)
+        return real(items, summaries)
+
+    monkeypatch.setattr(app, "evaluate_free_text", flaky)
+    quiz = {"mcqs": [{"question": "Vector quantity?", "options": OPTIONS, "correctAnswer": "Velocity"}],
+            "saqs": [{"question": "Define momentum.", "idealAnswer": "Mass times velocity."}], "laqs": []}
+
+    response = client.post("/api/score-quiz/batch", json={"quizQuestions": quiz, "submissions": [
+        {"studentId": "a", "userAnswers": {"q1": "Velocity", "q2": "Mass times velocity."}},
+        {"studentId": "b", "userAnswers": {"q1": "Velocity", "q2": "No idea"}},
+    ]})
+
+    results = response.get_json()["results"]
+    assert [result["evaluated"] for result in results] == [True, False]
+    # The unevaluated answer is left out rather than scored as zero
+    assert results[1]["scorePercent"] == 100 and results[1]["questionFeedback"][1]["evaluated"] is False
+    stored = app.quiz_attempts_collection.find_one({"studentId": "b"})
+    assert stored["evaluated"] is False and stored["score_percent"] == 100
+
+
+def test_all_batches_failing_raises(app, monkeypatch):
+    def unavailable(items, summaries):
+        raise app.UpstreamUnavailable("busy", retry_after=1)
+
+    monkeypatch.setattr(app, "evaluate_free_text", unavailable)
+    quiz = {"mcqs": [], "saqs": [{"question": "Define momentum.", "idealAnswer": "Mass times velocity."}], "laqs": []}
+
+    with pytest.raises(app.UpstreamUnavailable):
+        app.score_submissions(quiz, [{"q1": "Mass times velocity."}])
@@ -0,0 +1,79 @@
+import re
+
+from benchmarks.fakes import FakeModel, fake_page_texts, install_fakes, seed_pdf
+
+
+def store(app, filename, page_texts):
+    return app.store_pdf(filename, page_texts, content_hash=filename)
+
+
+def passages(context):
+    """Splits retrieve_library_context output into (header, text) pairs"""
+    return re.findall(r"^\[([^\]]+)\]\n(.*)$", context, re.MULTILINE)
+
+
+def test_search_ranks_the_pdf_covering_the_topic_first(app, client):
+    store(app, "mechanics.pdf", fake_page_texts(pages=5, seed=1))
+    store(app, "optics.pdf", fake_page_texts(pages=4, seed=2)[:3] + ["refraction lens refraction prism " * 20])
+
+    response = client.get("/api/search", query_string={"q": "refraction"})
+
+    results = response.get_json()["results"]
+    assert [result["filename"] for result in results] == ["optics.pdf"]
+    assert results[0]["pages"] == [4]
+    assert "refraction" in results[0]["snippet"]["text"]
+
+
+def test_search_requires_a_query(client):
+    assert client.get("/api/search").status_code == 400
+
+
+def test_library_context_stays_within_budget_when_nothing_matches(app):
+    pdf_docs = [app.pdfs_collection.find_one({"_id": store(app, f"chapter-{i}.pdf", fake_page_texts(pages=3, seed=i))})
+                for i in range(10)]
+
+    found = passages(app.retrieve_library_context(pdf_docs, "xylophone"))
+
+    assert 0 < len(found) <= app.CHAT_PASSAGE_WORD_BUDGET // app.CHUNK_WORDS
+    assert sum(len(text.split()) for _, text in found) <= app.CHAT_PASSAGE_WORD_BUDGET
+
+
+def test_library_context_ranks_passages_across_pdfs(app):
+    first = store(app, "mechanics.pdf", fake_page_texts(pages=3, seed=1))
+    second = store(app, "optics.pdf", ["refraction lens prism " * 30] + fake_page_texts(pages=2, seed=2))
+    pdf_docs = list(app.pdfs_collection.find({"_id": {"$in": [first, second]}}))
+
+    found = passages(app.retrieve_library_context(pdf_docs, "refraction"))
+
+    assert found and all(header.startswith("optics.pdf") for header, _ in found)
+
+
+class RecordingModel(FakeModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prompts = []
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.prompts.append(prompt)
+        return super().generate_content(prompt, stream=stream, **kwargs)
+
+
+def test_chat_across_several_pdfs_cites_each_document(app, client):
+    model = RecordingModel(latency=0, chunk_delay=0)
+    install_fakes(app, model)
+    pdf_ids = [seed_pdf(app, pages=3, filename=f"chapter-{i}.pdf", seed=i) for i in range(2)]
+
+    response = client.post("/api/chat", json={"message": "Explain momentum and friction", "pdfIds": pdf_ids})
+
+    assert response.status_code == 200
+    prompt = model.prompts[-1]
+    assert "several documents" in prompt
+    assert "[chapter-0.pdf" in prompt and "[chapter-1.pdf" in prompt
+
+
+def test_chat_rejects_too_many_pdfs(app, client):
+    pdf_ids = [seed_pdf(app, pages=1, filename=f"chapter-{i}.pdf", seed=i) for i in range(app.CHAT_MAX_PDFS + 1)]
+
+    response = client.post("/api/chat", json={"message": "Summarize", "pdfIds": pdf_ids})
+
+    assert response.status_code == 400
@@ -0,0 +1,132 @@
+import datetime
+import hashlib
+import threading
+import time
+
+import mongomock
+import pytest
+from pymongo.errors import PyMongoError
+
+
+@pytest.fixture
+def leases():
+    return mongomock.MongoClient().db.llm_leases
+
+
+def workers(app, leases, count=2, lease_seconds=5):
+    """SingleFlight instances standing in for separate worker processes sharing one lease collection"""
+    return [app.SingleFlight(leases, lease_seconds=lease_seconds) for _ in range(count)]
+
+
+def test_other_workers_reuse_the_leaders_result(app, leases, monkeypatch):
+    monkeypatch.setattr(app, "SINGLE_FLIGHT_POLL_SECONDS", 0.01)
+    leader, follower = workers(app, leases)
+    calls = []
+    started = threading.Event()
+
+    def slow_call():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return "answer"
+
+    results = {}
+    thread = threading.Thread(target=lambda: results.update(leader=leader.do("key", slow_call)))
+    thread.start()
+    started.wait()
+    results["follower"] = follower.do("key", slow_call)
+    thread.join()
+
+    assert results == {"leader": "answer", "follower": "answer"}
+    assert len(calls) == 1
+    assert app.metrics.counter_values("single_flight_total")[(("namespace", "default"), ("role", "remote_follower"))] == 1
+
+
+def test_failed_leader_releases_its_lease(app, leases, monkeypatch):
+    monkeypatch.setattr(app, "SINGLE_FLIGHT_POLL_SECONDS", 0.01)
+    leader, follower = workers(app, leases)
+    started = threading.Event()
+
+    def failing_call():
+        started.set()
+        time.sleep(0.1)
+        raise RuntimeError("upstream error")
+
+    errors = []
+
+    def lead():
+        try:
+            leader.do("key", failing_call)
+        except RuntimeError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    started.wait()
+    began = time.monotonic()
+    # The follower takes over once the lease is released instead of waiting out lease_seconds
+    assert follower.do("key", lambda: "retried") == "retried"
+    thread.join()
+
+    assert errors and time.monotonic() - began < 2
+    assert leases.count_documents({"status": "running"}) == 0
+
+
+def test_results_finished_before_a_call_started_are_not_reused(app, leases):
+    first, second = workers(app, leases)
+
+    assert first.do("key", lambda: "old") == "old"
+    assert second.do("key", lambda: "fresh") == "fresh"
+
+
+def test_abandoned_lease_is_taken_over(app, leases):
+    worker, = workers(app, leases, count=1, lease_seconds=1)
+    leases.insert_one({"_id": hashlib.sha256(b"key").hexdigest(), "owner": "dead", "status": "running",
+                       "expires_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=1)})
+
+    assert worker.do("key", lambda: "answer") == "answer"
+
+
+class FailingLeases:
+    """A lease collection whose chosen operations fail as if MongoDB went away"""
+    def __init__(self, collection, failing):
+        self.collection = collection
+        self.failing = set(failing)
+
+    def __getattr__(self, name):
+        if name in self.failing:
+            def fail(*args, **kwargs):
+                raise PyMongoError(f"{name}: connection refused")
+            return fail
+        return getattr(self.collection, name)
+
+
+@pytest.mark.parametrize("failing", [{"insert_one"}, {"find_one"}, {"find_one_and_replace"}])
+def test_lease_store_errors_fall_back_to_running_locally(app, leases, failing):
+    # A lease another worker holds, so following it needs find_one (and taking it over find_one_and_replace)
+    leases.insert_one({"_id": hashlib.sha256(b"key").hexdigest(), "owner": "other", "status": "running",
+                       "expires_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=1)})
+    worker = app.SingleFlight(FailingLeases(leases, failing), lease_seconds=1)
+
+    assert worker.do("key", lambda: "answer") == "answer"
+
+
+def test_result_survives_failing_to_publish_it(app, leases):
+    worker = app.SingleFlight(FailingLeases(leases, {"update_one"}), lease_seconds=1)
+    calls = []
+
+    assert worker.do("key", lambda: calls.append(1) or "answer") == "answer"
+    assert len(calls) == 1
+
+
+def test_leader_error_survives_failing_to_release_the_lease(app, leases):
+    worker = app.SingleFlight(FailingLeases(leases, {"delete_one"}), lease_seconds=1)
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ValueError("bad response")
+
+    with pytest.raises(ValueError):
+        worker.do("key", fail)
+    assert len(calls) == 1  # Not called again as if the lease store had failed before the call
@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+from benchmarks.fakes import FakeModel, install_fakes, seed_pdf
+
+
+class MidStreamFailure(FakeModel):
+    """Streams one chunk, then drops the connection"""
+    def _stream(self, prompt, text):
+        stream = super()._stream(prompt, text)
+        yield next(stream)
+        raise RuntimeError("503 connection reset mid-stream")
+
+
+class FailsFirstCall(FakeModel):
+    """Fails before producing anything on the first call only"""
+    def generate_content(self, prompt, stream=False, **kwargs):
+        if self.calls == 0:
+            self.calls += 1
+            raise RuntimeError("503 The model is overloaded")
+        return super().generate_content(prompt, stream=stream, **kwargs)
+
+
+def stream_events(client, pdf_id):
+    response = client.post("/api/chat/stream", json={"message": "What is momentum?", "pdfId": pdf_id},
+                           headers={"Accept": "text/event-stream"})
+    assert response.status_code == 200
+    events = []
+    for message in response.get_data(as_text=True).strip().split("\n\n"):
+        lines = message.split("\n")
+        event = lines[0][len("event: "):] if lines[0].startswith("event: ") else "message"
+        events.append((event, json.loads(lines[-1][len("data: "):])))
+    return response, events
+
+
+def test_done_event_reports_time_to_first_token(app, client):
+    pdf_id = seed_pdf(app)
+
+    response, events = stream_events(client, pdf_id)
+
+    assert [event for event, _ in events][-1] == "done"
+    assert events[0][0] == "message" and events[0][1]["text"]
+    done = events[-1][1]
+    assert 0 <= done["ttft_ms"] <= done["total_ms"]
+    assert response.headers["Server-Timing"].startswith("ttft;dur=")
+
+
+def test_failure_after_first_chunk_is_not_retried(app, client):
+    model = MidStreamFailure(latency=0, chunk_delay=0)
+    install_fakes(app, model)
+    pdf_id = seed_pdf(app)
+
+    _, events = stream_events(client, pdf_id)
+
+    assert [event for event, _ in events] == ["message", "error"]
+    assert model.calls == 1
+
+
+def test_failure_before_first_chunk_is_retried(app):
+    model = FailsFirstCall(latency=0, chunk_delay=0)
+    install_fakes(app, model)
+
+    first_chunk, chunks = app.open_stream_with_retry(model, "Explain momentum", delay=0)
+
+    assert first_chunk.text
+    assert model.calls == 2
+
+
+def test_stream_errors_before_first_chunk_surface_to_the_caller(app):
+    model = FakeModel(latency=0, failure_rate=1.0)
+
+    with pytest.raises(Exception):
+        app.open_stream_with_retry(model, "Explain momentum", retries=2, delay=0)
+    assert model.calls == 2
+
+
+def test_streams_are_never_hedged(app, client, monkeypatch):
+    model = FakeModel(latency=0.1, chunk_delay=0)
+    install_fakes(app, model)
+    pdf_id = seed_pdf(app)
+    # Every chat call counts as slow, so non-streaming calls are hedged straight away
+    monkeypatch.setattr(app, "HEDGE_MIN_DELAY", 0.0)
+    for _ in range(app.HEDGE_MIN_SAMPLES):
+        app.metrics.observe("llm_call_seconds", 0.001, endpoint="handle_chat", outcome="ok")
+
+    client.post("/api/chat", json={"message": "What is force?", "pdfId": pdf_id})
+    assert model.calls == 2
+
+    # The same endpoint asked for a stream through the Accept header
+    response = client.post("/api/chat", json={"message": "What is momentum?", "pdfId": pdf_id},
+                           headers={"Accept": "text/event-stream"})
+    assert "event: done" in response.get_data(as_text=True)
+    assert model.calls == 3
+    assert app.metrics.counter_values("llm_hedges_total") == {(("endpoint", "handle_chat"),): 1}